@@ -1,7 +1,14 @@
-from .augmenting import augment as augment
-from .interpreting import interpret as interpret
-from .lexing import lex as lex
-from .parsing import parse as parse
+from importlib import import_module
+
+# Not imported from typing, which alone would dominate the import time. Type checkers treat it as true.
+TYPE_CHECKING = False
+
+if TYPE_CHECKING:
+    from .augmenting import augment as augment
+    from .interpreting import interpret as interpret
+    from .lexing import lex as lex
+    from .parsing import parse as parse
+    from .program import Program as Program
 
 name = "Behagolit"
 
@@ -10,3 +17,26 @@ __copyright__ = "Copyright 2024, Tobias Hermann"
 __email__ = "editgym@gmail.com"
 __license__ = "MIT"
 __version__ = "0.0.1"
+
+# Submodules are only imported on first access, which keeps short-lived CLI invocations cheap.
+_LAZY_ATTRIBUTES = {
+    "augment": ".augmenting",
+    "interpret": ".interpreting",
+    "lex": ".lexing",
+    "parse": ".parsing",
+    "Program": ".program",
+}
+
+__all__ = list(_LAZY_ATTRIBUTES)
+
+
+def __getattr__(attribute: str) -> object:
+    if attribute not in _LAZY_ATTRIBUTES:
+        raise AttributeError(f"module {__name__!r} has no attribute {attribute!r}")
+    value = getattr(import_module(_LAZY_ATTRIBUTES[attribute], __name__), attribute)
+    globals()[attribute] = value
+    return value
+
+
+def __dir__() -> list[str]:
+    return sorted(list(globals()) + __all__)
@@ -0,0 +1,631 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from dataclasses import replace
+from pathlib import Path
+from typing import Callable, List, Dict, Tuple, cast
+
+from .augmenting import augment
+from .built_ins import RuntimeMode, plus, equal, UNCHECKED_IMPLEMENTATIONS, default_environment
+from .common_subexpressions import eliminate_common_subexpressions
+from .expressions import PrimitiveExpression, Expression, Call, Variable, Definition, CompoundClosure, \
+    PrimitiveFunction, type_tag, value_tag
+from .fusion import fuse_pipelines
+from .hash_tries import HashTrie
+from .inlining import inline_functions, InliningOutcome
+from .interpreting import evaluate, definitions_to_expressions, inline_caching, strip_definition_type
+from .lexing import lex
+from .modules import build_modules, load_program, MODULE_SUFFIX
+from .parsing import parse, create_struct
+from .program import Program, parse_source_expression
+from .scaling import measure_scaling, check_scaling, KNOB_SCALINGS
+from .type_checking import check_types, TypeRelations, definition_types
+from .type_signatures import TypeSignaturePrimitive, CustomPrimitiveType
+from .ubiquefix import Cell, Resolver, chain_parses, combine, definition_type
+
+FIB_SOURCE = """
+fib:Integer n:Integer = ifElse (less n 2) n (plus (fib (minus n 1)) (fib (minus n 2)))
+TwoDigitNumber := struct tens:Integer ones:Integer
+digitSum:Integer n:Integer = plus (TwoDigitNumber.tens number) (TwoDigitNumber.ones number)
+    number:TwoDigitNumber = TwoDigitNumber (divide n 10) (modulo n 10)
+"""
+
+
+def best_time(function: Callable[[], object], repeat: int = 5) -> float:
+    times: List[float] = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def report(name: str, baseline_name: str, baseline: float, candidate_name: str, candidate: float) -> None:
+    print(f"{name}: {baseline_name} {baseline * 1000:.1f} ms, {candidate_name} {candidate * 1000:.1f} ms, "
+          f"speedup {baseline / candidate:.2f}x")
+
+
+def benchmark_runtime_modes() -> None:
+    debug = Program.from_source(FIB_SOURCE, RuntimeMode.DEBUG)
+    release = Program.from_source(FIB_SOURCE, RuntimeMode.RELEASE)
+    for expression in ["fib 18", "digitSum 42"]:
+        report(expression, "debug", best_time(lambda: debug.evaluate(expression)),
+               "release", best_time(lambda: release.evaluate(expression)))
+    a, b = PrimitiveExpression(40), PrimitiveExpression(2)
+    unchecked_plus = UNCHECKED_IMPLEMENTATIONS[plus]
+    report("100000 x plus builtin", "debug", best_time(lambda: [plus(a, b) for _ in range(100000)]),
+           "release", best_time(lambda: [unchecked_plus(a, b) for _ in range(100000)]))
+
+
+REPETITIVE_SOURCE = """
+f:Integer n:Integer = plus (multiply (minus n 1) (minus n 1)) (multiply (minus n 1) (minus n 1))
+loop:Integer n:Integer acc:Integer = ifElse (less n 1) acc (loop (minus n 1) (plus acc (f n)))
+"""
+
+
+def unshared(exp: Expression) -> Expression:
+    if isinstance(exp, Call):
+        return Call(unshared(exp.operator), list(map(unshared, exp.operands)))
+    if isinstance(exp, Variable):
+        return Variable(exp.name)
+    if isinstance(exp, PrimitiveExpression):
+        return PrimitiveExpression(exp.value)
+    return exp
+
+
+def allocated_bytes(build: Callable[[], object]) -> int:
+    tracemalloc.start()
+    kept = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del kept
+    return size
+
+
+def benchmark_common_subexpressions() -> None:
+    term = "(plus (IntListElem.head xs) (minus n 1))"
+    for _ in range(6):
+        term = f"(multiply {term} {term})"
+    source = f"e:Integer = {term}"
+    shared = allocated_bytes(lambda: parse_source_expression(term))
+    copied = allocated_bytes(lambda: unshared(parse_source_expression(term)))
+    print(f"AST of {len(source)} characters: hash-consed {shared} bytes, unshared {copied} bytes")
+
+    definitions: Dict[str, Definition] = default_environment() | parse(lex(augment(REPETITIVE_SOURCE)))[0]
+    plain = definitions_to_expressions(definitions)
+    optimized = definitions_to_expressions(eliminate_common_subexpressions(definitions))
+    exp = parse_source_expression("loop 150 0")
+    report("repetitive body", "without CSE", best_time(lambda: evaluate(plain, exp)),
+           "with CSE", best_time(lambda: evaluate(optimized, exp)))
+
+
+LIST_SOURCE = """
+IntListElem := struct head:Integer tail:IntList
+IntList := union None | IntListElem
+sum:Integer xs:IntList = foldr plus 0 xs
+foldr:Integer f:(Integer, Integer -> Integer) acc:Integer xs:IntList = ifElse (equal xs none) acc (f (IntListElem.head xs) (foldr f acc (IntListElem.tail xs)))
+map:IntList xs:IntList f:(Integer -> Integer) = ifElse (equal xs none) none (IntListElem (f (IntListElem.head xs)) (map (IntListElem.tail xs) f))
+filter:IntList xs:IntList p:(Integer -> Boolean) = ifElse (equal xs none) none (ifElse (p (IntListElem.head xs)) (IntListElem (IntListElem.head xs) (filter (IntListElem.tail xs) p)) (filter (IntListElem.tail xs) p))
+isOdd:Boolean x:Integer = equal (modulo x 2) 1
+square:Integer x:Integer = multiply x x
+inc:Integer x:Integer = plus x 1
+pipeline:Integer xs:IntList = sum (map (filter (map xs square) isOdd) inc)
+"""
+
+
+# Built like the constructor of IntListElem in LIST_SOURCE builds it.
+def int_list(values: List[int]) -> PrimitiveExpression:
+    tag = type_tag(TypeSignaturePrimitive(CustomPrimitiveType("IntListElem")))
+    result = PrimitiveExpression(None)
+    for value in reversed(values):
+        result = create_struct(["head", "tail"], tag, PrimitiveExpression(value), result)
+    return result
+
+
+def benchmark_fusion() -> None:
+    definitions: Dict[str, Definition] = default_environment() | parse(lex(augment(LIST_SOURCE)))[0]
+    fused_definitions, fusions = fuse_pipelines(definitions)
+    print("fusions: " + ", ".join(f"{f.definition}: {' -> '.join(f.functions)}" for f in fusions))
+    plain = definitions_to_expressions(definitions)
+    fused = definitions_to_expressions(fused_definitions)
+    exp = Call(Variable("pipeline"), [int_list(list(range(1000)))])
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(100000)
+    try:
+        report("map/filter/map/sum over 1000 elements", "unfused", best_time(lambda: evaluate(plain, exp)),
+               "fused", best_time(lambda: evaluate(fused, exp)))
+        print(f"peak memory: unfused {peak_bytes(lambda: evaluate(plain, exp))} bytes, "
+              f"fused {peak_bytes(lambda: evaluate(fused, exp))} bytes")
+    finally:
+        sys.setrecursionlimit(limit)
+
+
+def peak_bytes(run: Callable[[], object]) -> int:
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def union_hierarchy_source(depth: int, fan_out: int) -> str:
+    lines = [f"Leaf{i} := struct value:Integer" for i in range(fan_out ** depth)]
+    for level in range(depth - 1, -1, -1):
+        children = "Leaf" if level == depth - 1 else f"Level{level + 1}_"
+        lines += [f"Level{level}_{i} := union " + " | ".join(f"{children}{i * fan_out + j}" for j in range(fan_out))
+                  for i in range(fan_out ** level)]
+    lines.append("accept:Integer x:Level0_0 = plus 1 1")
+    lines += [f"use{i}:Integer = accept (Leaf{i} {i})" for i in range(fan_out ** depth)]
+    return "\n".join(lines)
+
+
+def benchmark_type_checking() -> None:
+    user_definitions, type_aliases = parse(lex(augment(union_hierarchy_source(4, 4))))
+    definitions = default_environment() | user_definitions
+    relations = check_types(definitions, type_aliases)
+    leaf = TypeSignaturePrimitive(CustomPrimitiveType("Leaf255"))
+    root = TypeSignaturePrimitive(CustomPrimitiveType("Level0_0"))
+    build_time = best_time(lambda: TypeRelations(type_aliases, definition_types(definitions)))
+    check_time = best_time(lambda: check_types(definitions, type_aliases))
+    query_time = best_time(lambda: relations.is_assignable(leaf, root))
+    print(f"union hierarchy with {len(relations.types)} types: building relations {build_time * 1000:.1f} ms, "
+          f"checking {check_time * 1000:.1f} ms, is_assignable {query_time * 1e6:.2f} us")
+
+
+HELPERS_SOURCE = """
+square:Integer x:Integer = multiply x x
+add:Integer a:Integer b:Integer = plus a b
+sumSquares:Integer n:Integer = ifElse (less n 1) 0 (add (square n) (sumSquares (minus n 1)))
+"""
+
+
+def benchmark_inlining() -> None:
+    definitions: Dict[str, Definition] = default_environment() | parse(lex(augment(HELPERS_SOURCE)))[0]
+    inlined_definitions, decisions = inline_functions(definitions)
+    print("inlined: " + ", ".join(f"{d.callee} into {d.caller}" for d in decisions
+                                  if d.outcome == InliningOutcome.INLINED))
+    plain = definitions_to_expressions(definitions)
+    inlined = definitions_to_expressions(inlined_definitions)
+    exp = Call(Variable("sumSquares"), [PrimitiveExpression(300)])
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(100000)
+    try:
+        times = [(best_time(lambda: evaluate(plain, exp), 1), best_time(lambda: evaluate(inlined, exp), 1))
+                 for _ in range(10)]
+        report("sumSquares 300", "plain", min(t for t, _ in times), "inlined", min(t for _, t in times))
+    finally:
+        sys.setrecursionlimit(limit)
+
+
+def benchmark_tree_shaking() -> None:
+    unused = "\n".join(f"helper{i}:Integer x:Integer = plus (multiply x {i}) (fib {i % 5})" for i in range(2000))
+    definitions, type_aliases = parse(lex(augment(FIB_SOURCE + unused + "\nmain:Integer = digitSum 42")))
+    report("preparing a program with 2000 unused functions", "everything",
+           best_time(lambda: Program(definitions, type_aliases)),
+           "reachable from main", best_time(lambda: Program(definitions, type_aliases, entry_points=["main"])))
+    print(f"dropped {len(Program(definitions, type_aliases, entry_points=['main']).dropped_definitions)} definitions")
+
+
+HELLO_WORLD_SOURCE = 'main:None = printLine "Hello, world!"'
+
+# Budget for a cold start of the interpreter on top of the bare Python start.
+STARTUP_BUDGET = 0.075
+
+
+def run_python(code: str) -> None:
+    subprocess.run([sys.executable, "-c", code], check=True, capture_output=True,
+                   cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def benchmark_startup() -> None:
+    python_time = best_time(lambda: run_python("pass"))
+    import_time = best_time(lambda: run_python("import compiler"))
+    hello_world = "import compiler\n" \
+                  f"compiler.interpret(compiler.parse(compiler.lex(compiler.augment({HELLO_WORLD_SOURCE!r})))[0])"
+    hello_world_time = best_time(lambda: run_python(hello_world))
+    overhead = hello_world_time - python_time
+    print(f"startup: python {python_time * 1000:.1f} ms, import compiler {import_time * 1000:.1f} ms, "
+          f"hello world {hello_world_time * 1000:.1f} ms, overhead {overhead * 1000:.1f} ms "
+          f"({'within' if overhead <= STARTUP_BUDGET else 'over'} the budget of {STARTUP_BUDGET * 1000:.0f} ms)")
+
+
+def uncached(run: Callable[[], object]) -> Callable[[], object]:
+    def run_uncached() -> object:
+        with inline_caching(False):
+            return run()
+
+    return run_uncached
+
+
+def benchmark_inline_caches() -> None:
+    program = Program.from_source(FIB_SOURCE + LIST_SOURCE)
+    numbers = int_list(list(range(300)))
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(100000)
+    try:
+        for name, run in [("fib 16", lambda: program.evaluate("fib 16")),
+                          ("sum over 300 elements", lambda: program.call("sum", numbers))]:
+            # Alternating the variants keeps machine noise from favoring either of them.
+            times = [(best_time(uncached(run), 1), best_time(run, 1)) for _ in range(10)]
+            report(name, "uncached", min(t for t, _ in times), "cached", min(t for _, t in times))
+    finally:
+        sys.setrecursionlimit(limit)
+    for site in sorted(program.call_site_statistics(), key=lambda site: site.hits + site.misses, reverse=True)[:3]:
+        print(f"call site in {site.definition}: {site.hits} hits, {site.misses} misses, {site.targets} targets, "
+              f"hit rate {site.hit_rate:.4f}")
+
+
+CLOSURE_SOURCE = LIST_SOURCE + """
+adder:(Integer -> Integer) n:Integer = add
+    add:Integer x:Integer = plus x n
+addToAll:IntList xs:IntList n:Integer = map xs (adder n)
+"""
+
+
+def benchmark_closures() -> None:
+    for size in [0, 500]:
+        filler = "".join(f"\nunrelated{i}:Integer x:Integer = plus x {i}" for i in range(size))
+        definitions: Dict[str, Definition] = default_environment() | parse(lex(augment(CLOSURE_SOURCE + filler)))[0]
+        capturing_all = {name: strip_definition_type(name, d) for name, d in definitions.items()}
+        capturing_free = definitions_to_expressions(definitions)
+        exp = Call(Variable("addToAll"), [int_list(list(range(300))), PrimitiveExpression(1)])
+        limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(100000)
+        try:
+            times = [(best_time(lambda: evaluate(capturing_all, exp), 1),
+                      best_time(lambda: evaluate(capturing_free, exp), 1)) for _ in range(10)]
+            report(f"mapping a returned closure over 300 elements with {len(definitions)} definitions",
+                   "capturing everything", min(t for t, _ in times),
+                   "capturing free variables", min(t for _, t in times))
+        finally:
+            sys.setrecursionlimit(limit)
+        adders = [evaluate(environment, Call(Variable("adder"), [PrimitiveExpression(1)]))
+                  for environment in [capturing_all, capturing_free]]
+        print("bindings kept alive by the returned closure: " +
+              " vs. ".join(str(len(adder.environment)) for adder in adders if isinstance(adder, CompoundClosure)))
+
+
+NUMERIC_SOURCE = """
+sumTo:Integer n:Integer = ifElse (equal n 0) 0 (plus (minus n 1) (sumTo (minus n 1)))
+sumToInt64:Int64 n:Integer = int64ArraySum (int64ArrayRange (int64 0) (int64 n))
+meanSquare:Float64 n:Integer = divideFloat64 (float64ArrayDot values values) (int64ToFloat64 (int64 n))
+    values:Float64Array = int64ArrayToFloat64Array (int64ArrayRange (int64 0) (int64 n))
+"""
+
+
+def benchmark_fixed_width_numbers() -> None:
+    program = Program.from_source(NUMERIC_SOURCE, RuntimeMode.RELEASE)
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(100000)
+    try:
+        report("summing 0 to 999", "recursion on Integer", best_time(lambda: program.call("sumTo", 1000)),
+               "Int64Array", best_time(lambda: program.call("sumToInt64", 1000)))
+    finally:
+        sys.setrecursionlimit(limit)
+    mean_square_time = best_time(lambda: program.call("meanSquare", 100000))
+    print(f"mean square of 0 to 99999 on Float64Array: {mean_square_time * 1000:.1f} ms")
+    print(f"storing 10000 numbers: Integer list {allocated_bytes(lambda: int_list(list(range(10000))))} bytes, "
+          f"Int64Array {allocated_bytes(lambda: program.evaluate('int64ArrayRange (int64 0) (int64 10000)'))} bytes")
+
+
+REPEATED_SOURCE = """
+repeated:String piece:String n:Integer = ifElse (equal n 0) "" (concat (repeated piece (minus n 1)) piece)
+"""
+
+
+def flat_concat(*args: PrimitiveExpression) -> PrimitiveExpression:
+    return PrimitiveExpression("".join(str(arg.value) for arg in args))
+
+
+def benchmark_ropes() -> None:
+    definitions: Dict[str, Definition] = default_environment() | parse(lex(augment(REPEATED_SOURCE)))[0]
+    concat_definition = definitions["concat"]
+    assert isinstance(concat_definition, PrimitiveFunction)
+    ropes = definitions_to_expressions(definitions)
+    flat = definitions_to_expressions(definitions | {"concat": replace(concat_definition, impl=flat_concat)})
+    piece = PrimitiveExpression("x" * 10000)
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(100000)
+    try:
+        # Converting the result to a Python string includes flattening the rope.
+        for megabytes in [2.5, 5, 10]:
+            exp = Call(Variable("repeated"), [piece, PrimitiveExpression(int(megabytes * 100))])
+            report(f"building a {megabytes} MB string with concat", "flat strings",
+                   best_time(lambda: str(cast(PrimitiveExpression, evaluate(flat, exp)).value), 3),
+                   "ropes", best_time(lambda: str(cast(PrimitiveExpression, evaluate(ropes, exp)).value), 3))
+    finally:
+        sys.setrecursionlimit(limit)
+
+
+def insert_copying(entries: Dict[str, int], key: str, value: int) -> Dict[str, int]:
+    copied = dict(entries)
+    copied[key] = value
+    return copied
+
+
+def benchmark_hash_tries() -> None:
+    for size in [1000, 4000, 16000]:
+        keys = [f"key{i}" for i in range(size)]
+
+        def build_dicts() -> List[Dict[str, int]]:
+            versions: List[Dict[str, int]] = [{}]
+            for i, key in enumerate(keys):
+                versions.append(insert_copying(versions[-1], key, i))
+            return versions
+
+        def build_tries() -> List[HashTrie]:
+            versions = [HashTrie()]
+            for i, key in enumerate(keys):
+                versions.append(versions[-1].insert(key, i))
+            return versions
+
+        report(f"{size} inserts keeping every version", "copied dicts", best_time(build_dicts, 3),
+               "hash tries", best_time(build_tries, 3))
+        # The copied dicts of the largest size would take gigabytes.
+        if size == 4000:
+            print(f"memory of all versions: copied dicts {allocated_bytes(build_dicts)} bytes, "
+                  f"hash tries {allocated_bytes(build_tries)} bytes")
+    program = Program.from_source("""
+build:Map n:Integer = ifElse (equal n 0) mapEmpty (mapInsert (build (minus n 1)) (intToStr n) n)
+""", RuntimeMode.RELEASE)
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(100000)
+    try:
+        build_time = best_time(lambda: program.call("build", 2000))
+        print(f"building a map of 2000 entries in Behagolit: {build_time * 1000:.1f} ms")
+    finally:
+        sys.setrecursionlimit(limit)
+
+
+SUM_TO_SOURCE = """
+sumTo:Integer acc:Integer n:Integer = ifElse (equal n 0) acc (sumTo (plus acc n) (minus n 1))
+"""
+
+
+def benchmark_tail_recursion() -> None:
+    recursive = Program.from_source(SUM_TO_SOURCE, RuntimeMode.RELEASE)
+    looping = Program.from_source(f"tailrec {SUM_TO_SOURCE.strip()}", RuntimeMode.RELEASE)
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(100000)
+    try:
+        for n in [1000, 5000]:
+            report(f"sumTo 0 {n}", "recursion", best_time(lambda: recursive.call("sumTo", 0, n)),
+                   "loop", best_time(lambda: looping.call("sumTo", 0, n)))
+    finally:
+        sys.setrecursionlimit(limit)
+    # Far beyond what the recursion limit and the C stack allow for the recursive version.
+    print(f"sumTo 0 100000: loop {best_time(lambda: looping.call('sumTo', 0, 100000), 1) * 1000:.1f} ms")
+
+
+CURRIED_SOURCE = """
+add3:Integer a:Integer b:Integer c:Integer = plus a (plus b c)
+addOne:Integer x:Integer = plus 1 x
+double:Integer x:Integer = multiply 2 x
+offset:Integer x:Integer = add3 1 2 x
+named:Integer xs:IntList = sum (map (map (map xs addOne) double) offset)
+curried:Integer xs:IntList = sum (map (map (map xs (plus 1)) (multiply 2)) ((add3 1) 2))
+"""
+
+
+def benchmark_partial_application() -> None:
+    program = Program.from_source(LIST_SOURCE + CURRIED_SOURCE, RuntimeMode.RELEASE)
+    xs = int_list(list(range(1000)))
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(100000)
+    try:
+        report("map/map/map/sum over 1000 elements", "named functions",
+               best_time(lambda: program.evaluate(Call(Variable("named"), [xs]))),
+               "partial applications", best_time(lambda: program.evaluate(Call(Variable("curried"), [xs]))))
+    finally:
+        sys.setrecursionlimit(limit)
+
+
+# Tries every bracketing, without sharing the parses of common spans.
+def all_bracketings(relations: TypeRelations, elements: List[Cell]) -> Cell:
+    if len(elements) == 1:
+        return elements[0]
+    cell: Cell = []
+    for split in range(len(elements) - 1, 0, -1):
+        combine(relations, all_bracketings(relations, elements[:split]), all_bracketings(relations, elements[split:]),
+                cell)
+    return cell
+
+
+def benchmark_ubiquefix() -> None:
+    definitions = default_environment()
+    relations = TypeRelations({}, definition_types(definitions))
+    resolver = Resolver(relations)
+    scope = {name: type_sig for name, d in definitions.items() if (type_sig := definition_type(d)) is not None}
+
+    # Alternating values and binary functions have a number of parses growing exponentially with the length.
+    def chain_elements(length: int) -> List[Cell]:
+        chain = parse_source_expression(" plus ".join(["1"] * ((length + 1) // 2)))
+        assert isinstance(chain, Call)
+        return [cast(Cell, resolver.element("chain", element, scope)) for element in [chain.operator, *chain.operands]]
+
+    for length in [9, 11, 13]:
+        elements = chain_elements(length)
+        report(f"resolving a chain of {length} elements", "all bracketings",
+               best_time(lambda: all_bracketings(relations, elements), 3),
+               "chart", best_time(lambda: chain_parses(relations, elements), 3))
+    for length in [26, 51, 101]:
+        elements = chain_elements(length)
+        parses = sum(parses.count for parses in chain_parses(relations, elements))
+        print(f"resolving a chain of {length} elements with {parses:.2e} parses: chart "
+              f"{best_time(lambda: chain_parses(relations, elements), 3) * 1000:.1f} ms")
+
+
+def library_module_source(index: int, size: int) -> str:
+    return "\n".join(f"f{index}_{i}:Integer x:Integer = plus (multiply x {i}) (minus x {index})" for i in range(size))
+
+
+def benchmark_modules() -> None:
+    libraries = 8
+    with tempfile.TemporaryDirectory() as directory:
+        source_dir = Path(directory) / "source"
+        source_dir.mkdir()
+        for index in range(libraries):
+            (source_dir / f"library{index}{MODULE_SUFFIX}").write_text(library_module_source(index, 300))
+        (source_dir / f"main{MODULE_SUFFIX}").write_text(
+            "\n".join(f"import library{index}" for index in range(libraries)) +
+            "\nmain:Integer = " + " (".join(f"f{index}_1" for index in range(libraries)) + " 1" +
+            ")" * (libraries - 1))
+
+        def cold_build(workers: int) -> None:
+            cache_dir = Path(directory) / f"cache{workers}"
+            shutil.rmtree(cache_dir, ignore_errors=True)
+            build_modules(source_dir, cache_dir, ["main"], workers)
+
+        # Parallel builds only pay off with more than one core.
+        report(f"building {libraries} modules of 300 definitions on {os.cpu_count()} cores", "1 worker",
+               best_time(lambda: cold_build(1), 3), "4 workers", best_time(lambda: cold_build(4), 3))
+        cache_dir = Path(directory) / "cache"
+        build_modules(source_dir, cache_dir, ["main"], 1)
+        report("rebuilding them", "from scratch", best_time(lambda: cold_build(1), 3),
+               "up to date", best_time(lambda: build_modules(source_dir, cache_dir, ["main"], 1), 3))
+        (source_dir / f"library0{MODULE_SUFFIX}").write_text(library_module_source(0, 300) + "\n# changed")
+        report("rebuilding after changing one library", "from scratch", best_time(lambda: cold_build(1), 3),
+               "incrementally", best_time(lambda: build_modules(source_dir, cache_dir, ["main"], 1), 1))
+        report("loading main", "checking all sources", best_time(lambda: Program.from_source(
+            "\n".join(library_module_source(index, 300) for index in range(libraries))), 3),
+               "linking compiled modules", best_time(lambda: load_program(cache_dir, "main"), 3))
+
+
+MATCH_SOURCE = LIST_SOURCE + """
+sumIf:Integer xs:IntList = ifElse (equal xs none) 0 (plus (IntListElem.head xs) (sumIf (IntListElem.tail xs)))
+sumMatch:Integer xs:IntList = match xs | None -> 0 | IntListElem x -> plus (IntListElem.head x) (sumMatch (IntListElem.tail x))
+"""
+
+
+def benchmark_match() -> None:
+    program = Program.from_source(MATCH_SOURCE, RuntimeMode.RELEASE)
+    xs = int_list(list(range(1000)))
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(100000)
+    try:
+        report("sum over 1000 elements", "ifElse equal", best_time(lambda: program.call("sumIf", xs)),
+               "match", best_time(lambda: program.call("sumMatch", xs)))
+        # Comparing structs compares all their fields, so telling two lists apart by value can take O(n).
+        ys = int_list(list(range(1000)))
+        report("1000 x telling a list apart", "equal", best_time(lambda: [equal(xs, ys) for _ in range(1000)]),
+               "tag", best_time(lambda: [value_tag(xs) for _ in range(1000)]))
+    finally:
+        sys.setrecursionlimit(limit)
+
+
+ARRAY_SOURCE = """
+tailrec setAll:Array xs:Array i:Integer = ifElse (less i (arrayLength xs)) (setAll (arraySet xs i (int64 i)) (plus i 1)) xs
+tailrec setAllCopying:Int64Array xs:Int64Array i:Integer = ifElse (less i (int64ArrayLength xs)) \
+(setAllCopying (int64ArraySet xs i (int64 i)) (plus i 1)) xs
+tailrec pushAll:Array xs:Array n:Integer = ifElse (less n 1) xs (pushAll (arrayPush xs (int64 n)) (minus n 1))
+filled:Int64 n:Integer = arraySum (setAll (arrayFill n (int64 0)) 0)
+filledCopying:Int64 n:Integer = int64ArraySum (setAllCopying (int64ArrayFill n (int64 0)) 0)
+pushed:Int64 n:Integer = arraySum (pushAll (arrayFill 0 (int64 0)) n)
+tailrec update:Array xs:Array n:Integer k:Integer = ifElse (less k 1) xs \
+(update (arraySet xs (modulo k n) (int64 k)) n (minus k 1))
+tailrec updateCopying:Int64Array xs:Int64Array n:Integer k:Integer = ifElse (less k 1) xs \
+(updateCopying (int64ArraySet xs (modulo k n) (int64 k)) n (minus k 1))
+updated:Int64 n:Integer k:Integer = arrayGet (update (arrayFill n (int64 0)) n k) 0
+updatedCopying:Int64 n:Integer k:Integer = int64ArrayGet (updateCopying (int64ArrayFill n (int64 0)) n k) 0
+"""
+
+
+# The cost of k updates on an array of n elements, without the cost of filling and reading it.
+def update_cost(program: Program, name: str, n: int, k: int) -> float:
+    return (best_time(lambda: program.call(name, n, k), 3) - best_time(lambda: program.call(name, n, 0), 3)) / k
+
+
+def benchmark_arrays() -> None:
+    program = Program.from_source(ARRAY_SOURCE, RuntimeMode.RELEASE)
+    for n in [1000, 10000, 30000]:
+        report(f"setting all {n} elements", "copying Int64Array", best_time(lambda: program.call("filledCopying", n), 1),
+               "Array in place", best_time(lambda: program.call("filled", n), 1))
+    print(f"pushing 10000 elements onto an Array: {best_time(lambda: program.call('pushed', 10000), 1) * 1000:.1f} ms")
+    # The number of updates is fixed, so the evaluator does the same work for every size and the copies dominate.
+    for n in [1000, 10000, 100000, 1000000]:
+        copying = update_cost(program, "updatedCopying", n, 200)
+        in_place = update_cost(program, "updated", n, 200)
+        print(f"updating an array of {n} elements: copying Int64Array {copying * 1e6:.1f} us per update, "
+              f"Array in place {in_place * 1e6:.1f} us per update, speedup {copying / in_place:.1f}x")
+
+
+STREAM_SOURCE = """
+addLine:Integer total:Integer line:String = plus total (strToInt line)
+total:Integer path:String = streamFold addLine 0 (readLines path)
+"""
+
+
+# Folding a stream keeps only one chunk of the file in memory, however large the file is.
+def benchmark_streams() -> None:
+    program = Program.from_source(STREAM_SOURCE, RuntimeMode.RELEASE)
+    with tempfile.TemporaryDirectory() as directory:
+        for lines in [10000, 100000]:
+            path = Path(directory) / f"{lines}.txt"
+            path.write_text("".join(f"{i}\n" for i in range(lines)))
+            seconds = best_time(lambda: program.call("total", str(path)), 1)
+            print(f"folding {lines} lines ({path.stat().st_size} bytes): {seconds * 1000:.1f} ms, "
+                  f"peak memory {peak_bytes(lambda: program.call('total', str(path)))} bytes")
+
+
+# Integer loops profit most, while the list sums box the elements their struct fields hold.
+def benchmark_unboxing() -> None:
+    source = FIB_SOURCE + MATCH_SOURCE + f"tailrec {SUM_TO_SOURCE.strip()}\n"
+    release = Program.from_source(source, RuntimeMode.RELEASE)
+    unboxed = Program.from_source(source, RuntimeMode.UNBOXED)
+    xs = int_list(list(range(1000)))
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(100000)
+    try:
+        runs: List[Tuple[str, Callable[[Program], Expression]]] = [
+            ("fib 18", lambda program: program.evaluate("fib 18")),
+            ("sumTo 0 20000", lambda program: program.call("sumTo", 0, 20000)),
+            ("sum over 1000 elements", lambda program: program.call("sumMatch", xs))]
+        for name, run in runs:
+            report(name, "boxed", best_time(lambda: run(release)), "unboxed", best_time(lambda: run(unboxed)))
+    finally:
+        sys.setrecursionlimit(limit)
+
+
+# The wall-clock checks of the scaling harness are too noisy for the unit tests, so they run here.
+def benchmark_scaling() -> None:
+    sizes = {"definitions": [200, 400, 800, 1600], "sub-definition depth": [16, 32, 64, 128],
+             "structs": [50, 100, 200, 400], "recursion depth": [250, 500, 1000, 2000]}
+    for knob, settings, bounds in KNOB_SCALINGS:
+        scalings = measure_scaling(settings, sizes[knob], bounds=bounds)
+        for scaling in scalings:
+            print(f"{scaling.stage} by {knob} {sizes[knob]}: "
+                  f"{', '.join(f'{seconds * 1000:.1f}' for seconds in scaling.seconds)} ms, "
+                  f"exponent {scaling.exponent:.2f} (bound {scaling.bound})")
+        check_scaling(scalings)
+
+
+def main() -> None:
+    benchmark_runtime_modes()
+    benchmark_common_subexpressions()
+    benchmark_fusion()
+    benchmark_type_checking()
+    benchmark_inline_caches()
+    benchmark_inlining()
+    benchmark_tree_shaking()
+    benchmark_startup()
+    benchmark_closures()
+    benchmark_fixed_width_numbers()
+    benchmark_ropes()
+    benchmark_hash_tries()
+    benchmark_tail_recursion()
+    benchmark_partial_application()
+    benchmark_ubiquefix()
+    benchmark_modules()
+    benchmark_match()
+    benchmark_arrays()
+    benchmark_streams()
+    benchmark_unboxing()
+    benchmark_scaling()
+
+
+if __name__ == "__main__":
+    main()
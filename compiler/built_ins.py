@@ -1,16 +1,41 @@
-from typing import Dict
-
-from .expressions import PrimitiveExpression, PrimitiveFunction, Definition
+from __future__ import annotations
+
+import math
+import operator
+from array import array
+from contextlib import closing
+from enum import auto, StrEnum
+from functools import partial
+from itertools import islice
+from types import MappingProxyType
+from typing import Dict, Callable, Any, Mapping, List, cast, Generator
+
+from .expressions import PrimitiveExpression, PrimitiveFunction, Definition, Constant, Expression, ArrayValue, \
+    StreamValue
+from .hash_tries import HashTrie
+from .ropes import Rope, Text, concat_texts
 from .type_signatures import TypeSignatureFunction, TypeSignaturePrimitive, BuiltInPrimitiveType
 
 
+# Unboxed is a release mode, which evaluates with native values where static types allow it, see unboxing.py.
+class RuntimeMode(StrEnum):
+    DEBUG = auto()
+    RELEASE = auto()
+    UNBOXED = auto()
+
+
 def get_const_int(exp: PrimitiveExpression) -> int:
     assert isinstance(exp.value, int)
     return exp.value
 
 
 def get_const_str(exp: PrimitiveExpression) -> str:
-    assert isinstance(exp.value, str)
+    return str(get_const_text(exp))
+
+
+# Strings are either Python strings or ropes, see concat.
+def get_const_text(exp: PrimitiveExpression) -> Text:
+    assert isinstance(exp.value, (str, Rope))
     return exp.value
 
 
@@ -19,23 +44,42 @@ def get_const_bool(exp: PrimitiveExpression) -> bool:
     return exp.value
 
 
+def get_const_float(exp: PrimitiveExpression) -> float:
+    assert isinstance(exp.value, float)
+    return exp.value
+
+
+def get_const_int64_array(exp: PrimitiveExpression) -> array[int]:
+    assert isinstance(exp.value, array) and exp.value.typecode == "q"
+    return cast("array[int]", exp.value)
+
+
+def get_const_float64_array(exp: PrimitiveExpression) -> array[float]:
+    assert isinstance(exp.value, array) and exp.value.typecode == "d"
+    return cast("array[float]", exp.value)
+
+
 def printline(text: PrimitiveExpression) -> PrimitiveExpression:
     print(text.value)
     return PrimitiveExpression(None)
 
 
+# Builds a rope instead of copying the characters, so accumulating a string by repeated concatenation is linear.
 def concat(*args: PrimitiveExpression) -> PrimitiveExpression:
-    def get_value(exp: PrimitiveExpression) -> str:
-        return get_const_str(exp)
-
-    arg_values = list(map(get_value, args))
-    return PrimitiveExpression("".join(arg_values))
+    result: Text = ""
+    for arg in args:
+        result = concat_texts(result, get_const_text(arg))
+    return PrimitiveExpression(result)
 
 
 def inttostr(number: PrimitiveExpression) -> PrimitiveExpression:
     return PrimitiveExpression(str(get_const_int(number)))
 
 
+def strtoint(text: PrimitiveExpression) -> PrimitiveExpression:
+    return PrimitiveExpression(int(get_const_str(text)))
+
+
 def plus(a: PrimitiveExpression, b: PrimitiveExpression) -> PrimitiveExpression:
     return PrimitiveExpression(get_const_int(a) + get_const_int(b))
 
@@ -68,7 +112,521 @@ def equal(a: PrimitiveExpression, b: PrimitiveExpression) -> PrimitiveExpression
     return PrimitiveExpression(a.value == b.value)
 
 
-def default_environment() -> Dict[str, Definition]:
+INT64_MIN = -2 ** 63
+INT64_MAX = 2 ** 63 - 1
+
+
+# Int64 arithmetic wraps around on overflow (two's complement), like machine integers do.
+def wrap_int64(value: int) -> int:
+    if INT64_MIN <= value <= INT64_MAX:
+        return value
+    return (value - INT64_MIN) % 2 ** 64 + INT64_MIN
+
+
+def wrapping(op: Callable[[int, int], int]) -> Callable[[int, int], int]:
+    def wrapped(a: int, b: int) -> int:
+        return wrap_int64(op(a, b))
+
+    return wrapped
+
+
+# Int64 division truncates toward zero and the remainder has the sign of the numerator.
+def truncated_divide(a: int, b: int) -> int:
+    quotient = a // b
+    if quotient < 0 and quotient * b != a:
+        quotient += 1
+    return quotient
+
+
+def truncated_remainder(a: int, b: int) -> int:
+    return a - b * truncated_divide(a, b)
+
+
+# Float64 division by zero results in an infinity or NaN, as specified by IEEE 754.
+def ieee_divide(a: float, b: float) -> float:
+    if b != 0.0:
+        return a / b
+    if a == 0.0 or math.isnan(a):
+        return math.nan
+    return math.copysign(math.inf, a) * math.copysign(1.0, b)
+
+
+# Out-of-range values saturate and NaN becomes 0.
+def saturate_int64(value: float) -> int:
+    if math.isnan(value):
+        return 0
+    if value >= 2.0 ** 63:
+        return INT64_MAX
+    if value < -2.0 ** 63:
+        return INT64_MIN
+    return int(value)
+
+
+def checked_binary_operation(get_value: Callable[[PrimitiveExpression], Any],
+                             op: Callable[[Any, Any], Any]) -> Callable[..., PrimitiveExpression]:
+    def impl(a: PrimitiveExpression, b: PrimitiveExpression) -> PrimitiveExpression:
+        return PrimitiveExpression(op(get_value(a), get_value(b)))
+
+    return impl
+
+
+plus_int64 = checked_binary_operation(get_const_int, wrapping(operator.add))
+minus_int64 = checked_binary_operation(get_const_int, wrapping(operator.sub))
+multiply_int64 = checked_binary_operation(get_const_int, wrapping(operator.mul))
+divide_int64 = checked_binary_operation(get_const_int, wrapping(truncated_divide))
+modulo_int64 = checked_binary_operation(get_const_int, truncated_remainder)
+less_int64 = checked_binary_operation(get_const_int, operator.lt)
+greater_int64 = checked_binary_operation(get_const_int, operator.gt)
+equal_int64 = checked_binary_operation(get_const_int, operator.eq)
+plus_float64 = checked_binary_operation(get_const_float, operator.add)
+minus_float64 = checked_binary_operation(get_const_float, operator.sub)
+multiply_float64 = checked_binary_operation(get_const_float, operator.mul)
+divide_float64 = checked_binary_operation(get_const_float, ieee_divide)
+less_float64 = checked_binary_operation(get_const_float, operator.lt)
+greater_float64 = checked_binary_operation(get_const_float, operator.gt)
+equal_float64 = checked_binary_operation(get_const_float, operator.eq)
+
+
+def to_int64(number: PrimitiveExpression) -> PrimitiveExpression:
+    return PrimitiveExpression(wrap_int64(get_const_int(number)))
+
+
+def int64_to_integer(number: PrimitiveExpression) -> PrimitiveExpression:
+    return PrimitiveExpression(get_const_int(number))
+
+
+def int64_to_float64(number: PrimitiveExpression) -> PrimitiveExpression:
+    return PrimitiveExpression(float(get_const_int(number)))
+
+
+def float64_to_int64(number: PrimitiveExpression) -> PrimitiveExpression:
+    return PrimitiveExpression(saturate_int64(get_const_float(number)))
+
+
+def float64_to_str(number: PrimitiveExpression) -> PrimitiveExpression:
+    return PrimitiveExpression(str(get_const_float(number)))
+
+
+# Arrays are immutable values, so setting an element copies the array.
+def checked_index(values: array[Any], index: PrimitiveExpression) -> int:
+    i = get_const_int(index)
+    if not 0 <= i < len(values):
+        raise IndexError(f"Array index {i} out of range for length {len(values)}")
+    return i
+
+
+# Elements are stored wrapped to 64 bits, so no Int64 value can overflow the array.
+def filled_int64_elements(size: PrimitiveExpression, value: PrimitiveExpression) -> array[int]:
+    assert get_const_int(size) >= 0
+    return array("q", [wrap_int64(get_const_int(value))]) * get_const_int(size)
+
+
+def get_int64_element(elements: array[int], index: PrimitiveExpression) -> PrimitiveExpression:
+    return PrimitiveExpression(elements[checked_index(elements, index)])
+
+
+def set_int64_element(elements: array[int], index: PrimitiveExpression, value: PrimitiveExpression) -> None:
+    elements[checked_index(elements, index)] = wrap_int64(get_const_int(value))
+
+
+def sum_int64_elements(elements: array[int]) -> PrimitiveExpression:
+    return PrimitiveExpression(wrap_int64(sum(elements)))
+
+
+def int64_array_fill(size: PrimitiveExpression, value: PrimitiveExpression) -> PrimitiveExpression:
+    return PrimitiveExpression(filled_int64_elements(size, value))
+
+
+def int64_array_range(start: PrimitiveExpression, stop: PrimitiveExpression) -> PrimitiveExpression:
+    return PrimitiveExpression(array("q", range(get_const_int(start), get_const_int(stop))))
+
+
+def int64_array_length(values: PrimitiveExpression) -> PrimitiveExpression:
+    return PrimitiveExpression(len(get_const_int64_array(values)))
+
+
+def int64_array_get(values: PrimitiveExpression, index: PrimitiveExpression) -> PrimitiveExpression:
+    return get_int64_element(get_const_int64_array(values), index)
+
+
+def int64_array_set(values: PrimitiveExpression, index: PrimitiveExpression,
+                    value: PrimitiveExpression) -> PrimitiveExpression:
+    elements = array("q", get_const_int64_array(values))
+    set_int64_element(elements, index, value)
+    return PrimitiveExpression(elements)
+
+
+def int64_array_sum(values: PrimitiveExpression) -> PrimitiveExpression:
+    return sum_int64_elements(get_const_int64_array(values))
+
+
+def int64_array_to_float64_array(values: PrimitiveExpression) -> PrimitiveExpression:
+    return PrimitiveExpression(array("d", get_const_int64_array(values)))
+
+
+def float64_array_fill(size: PrimitiveExpression, value: PrimitiveExpression) -> PrimitiveExpression:
+    assert get_const_int(size) >= 0
+    return PrimitiveExpression(array("d", [get_const_float(value)]) * get_const_int(size))
+
+
+def float64_array_length(values: PrimitiveExpression) -> PrimitiveExpression:
+    return PrimitiveExpression(len(get_const_float64_array(values)))
+
+
+def float64_array_get(values: PrimitiveExpression, index: PrimitiveExpression) -> PrimitiveExpression:
+    elements = get_const_float64_array(values)
+    return PrimitiveExpression(elements[checked_index(elements, index)])
+
+
+def float64_array_set(values: PrimitiveExpression, index: PrimitiveExpression,
+                      value: PrimitiveExpression) -> PrimitiveExpression:
+    elements = array("d", get_const_float64_array(values))
+    elements[checked_index(elements, index)] = get_const_float(value)
+    return PrimitiveExpression(elements)
+
+
+def float64_array_sum(values: PrimitiveExpression) -> PrimitiveExpression:
+    return PrimitiveExpression(sum(get_const_float64_array(values), 0.0))
+
+
+def float64_array_dot(a: PrimitiveExpression, b: PrimitiveExpression) -> PrimitiveExpression:
+    left = get_const_float64_array(a)
+    right = get_const_float64_array(b)
+    assert len(left) == len(right)
+    return PrimitiveExpression(sum(map(operator.mul, left, right), 0.0))
+
+
+def get_const_array(exp: PrimitiveExpression) -> ArrayValue:
+    assert isinstance(exp.value, ArrayValue)
+    return exp.value
+
+
+# Array holds Int64 elements like Int64Array does, but updates it in place.
+def array_fill(size: PrimitiveExpression, value: PrimitiveExpression) -> PrimitiveExpression:
+    return PrimitiveExpression(ArrayValue(filled_int64_elements(size, value)))
+
+
+def array_length(values: PrimitiveExpression) -> PrimitiveExpression:
+    return PrimitiveExpression(len(get_const_array(values).elements))
+
+
+def array_get(values: PrimitiveExpression, index: PrimitiveExpression) -> PrimitiveExpression:
+    return get_int64_element(get_const_array(values).elements, index)
+
+
+def array_sum(values: PrimitiveExpression) -> PrimitiveExpression:
+    return sum_int64_elements(get_const_array(values).elements)
+
+
+# Updates consume the array, so its elements are reused for the result, unless they are shared.
+def owned_array(values: PrimitiveExpression) -> PrimitiveExpression:
+    if get_const_array(values).shared:
+        return PrimitiveExpression(ArrayValue(array("q", get_const_array(values).elements)))
+    return values
+
+
+def array_set(values: PrimitiveExpression, index: PrimitiveExpression,
+              value: PrimitiveExpression) -> PrimitiveExpression:
+    owned = owned_array(values)
+    set_int64_element(get_const_array(owned).elements, index, value)
+    return owned
+
+
+def array_push(values: PrimitiveExpression, value: PrimitiveExpression) -> PrimitiveExpression:
+    owned = owned_array(values)
+    get_const_array(owned).elements.append(wrap_int64(get_const_int(value)))
+    return owned
+
+
+def get_const_map(exp: PrimitiveExpression) -> HashTrie:
+    assert isinstance(exp.value, HashTrie)
+    return exp.value
+
+
+# Maps are from String to Integer, since the type system has no generics yet.
+def map_insert(entries: PrimitiveExpression, key: PrimitiveExpression, value: PrimitiveExpression) \
+        -> PrimitiveExpression:
+    return PrimitiveExpression(get_const_map(entries).insert(get_const_str(key), get_const_int(value)))
+
+
+def map_lookup(entries: PrimitiveExpression, key: PrimitiveExpression,
+               default: PrimitiveExpression) -> PrimitiveExpression:
+    leaf = get_const_map(entries).lookup(get_const_str(key))
+    return PrimitiveExpression(get_const_int(default) if leaf is None else leaf.value)
+
+
+def map_contains(entries: PrimitiveExpression, key: PrimitiveExpression) -> PrimitiveExpression:
+    return PrimitiveExpression(get_const_map(entries).lookup(get_const_str(key)) is not None)
+
+
+def map_remove(entries: PrimitiveExpression, key: PrimitiveExpression) -> PrimitiveExpression:
+    return PrimitiveExpression(get_const_map(entries).remove(get_const_str(key)))
+
+
+def map_size(entries: PrimitiveExpression) -> PrimitiveExpression:
+    return PrimitiveExpression(len(get_const_map(entries)))
+
+
+# Calls `function accumulator key value` for every entry, in an order that only depends on the keys.
+def map_fold(function: Expression, initial: PrimitiveExpression, entries: PrimitiveExpression) -> PrimitiveExpression:
+    from .interpreting import apply  # The interpreter depends on the built-ins, not the other way around.
+    result: Expression = initial
+    for key, value in get_const_map(entries).items():
+        result = apply(function, [result, PrimitiveExpression(key), PrimitiveExpression(value)])
+    assert isinstance(result, PrimitiveExpression)
+    return result
+
+
+# Splitting a chunk creates all of its lines at once, so larger chunks take more memory but barely save time.
+READ_CHUNK_SIZE = 1 << 16
+
+
+def get_const_stream(exp: PrimitiveExpression) -> StreamValue:
+    assert isinstance(exp.value, StreamValue)
+    return exp.value
+
+
+# Splits large chunks into lines, so files of any size are read in constant memory. The file is only opened once
+# the stream is traversed.
+def file_lines(path: str) -> Generator[PrimitiveExpression, None, None]:
+    with open(path, "rb") as file:
+        rest = b""
+        while len(chunk := file.read(READ_CHUNK_SIZE)) > 0:
+            data = rest + chunk
+            end = data.rfind(b"\n")
+            if end >= 0:
+                for line in data[:end].decode().split("\n"):
+                    yield PrimitiveExpression(line)
+            rest = data[end + 1:]
+        if len(rest) > 0:
+            yield PrimitiveExpression(rest.decode())
+
+
+def read_lines(path: PrimitiveExpression) -> PrimitiveExpression:
+    return PrimitiveExpression(StreamValue(partial(file_lines, get_const_str(path))))
+
+
+# The functions passed to streams are called while the stream is traversed, one element after the other through all
+# stages, so their effects (e.g. of printLine) are interleaved in this order. Each stage closes the stage it reads
+# from when it stops early, so a file is closed as soon as nothing reads from it any more.
+def mapped_elements(function: Expression, stream: StreamValue) -> Generator[PrimitiveExpression, None, None]:
+    from .interpreting import apply
+    with closing(stream.traverse()) as elements:
+        for element in elements:
+            result = apply(function, [element])
+            assert isinstance(result, PrimitiveExpression)
+            yield result
+
+
+def filtered_elements(predicate: Expression, stream: StreamValue) -> Generator[PrimitiveExpression, None, None]:
+    from .interpreting import apply
+    with closing(stream.traverse()) as elements:
+        for element in elements:
+            keep = apply(predicate, [element])
+            assert isinstance(keep, PrimitiveExpression)
+            if get_const_bool(keep):
+                yield element
+
+
+# The source is closed before the last element is handed out, instead of when the next element is asked for.
+def taken_elements(count: int, stream: StreamValue) -> Generator[PrimitiveExpression, None, None]:
+    if count == 0:
+        return
+    with closing(stream.traverse()) as elements:
+        yield from islice(elements, count - 1)
+        last = next(elements, None)
+    if last is not None:
+        yield last
+
+
+def stream_map(function: Expression, stream: PrimitiveExpression) -> PrimitiveExpression:
+    return PrimitiveExpression(StreamValue(partial(mapped_elements, function, get_const_stream(stream))))
+
+
+def stream_filter(predicate: Expression, stream: PrimitiveExpression) -> PrimitiveExpression:
+    return PrimitiveExpression(StreamValue(partial(filtered_elements, predicate, get_const_stream(stream))))
+
+
+def stream_take(count: PrimitiveExpression, stream: PrimitiveExpression) -> PrimitiveExpression:
+    n = get_const_int(count)
+    assert n >= 0
+    return PrimitiveExpression(StreamValue(partial(taken_elements, n, get_const_stream(stream))))
+
+
+def stream_fold(function: Expression, initial: PrimitiveExpression, stream: PrimitiveExpression) \
+        -> PrimitiveExpression:
+    from .interpreting import apply
+    result: Expression = initial
+    with closing(get_const_stream(stream).traverse()) as elements:
+        for element in elements:
+            result = apply(function, [result, element])
+    assert isinstance(result, PrimitiveExpression)
+    return result
+
+
+# Only for programs that passed type checking, which makes the assertions above redundant.
+def unchecked_binary_operation(op: Callable[[Any, Any], Any]) -> Callable[..., PrimitiveExpression]:
+    def impl(a: PrimitiveExpression, b: PrimitiveExpression) -> PrimitiveExpression:
+        return PrimitiveExpression(op(a.value, b.value))
+
+    return impl
+
+
+def concat_unchecked(a: PrimitiveExpression, b: PrimitiveExpression) -> PrimitiveExpression:
+    return PrimitiveExpression(concat_texts(cast(Text, a.value), cast(Text, b.value)))
+
+
+def inttostr_unchecked(number: PrimitiveExpression) -> PrimitiveExpression:
+    return PrimitiveExpression(str(number.value))
+
+
+UNCHECKED_IMPLEMENTATIONS: Dict[Callable[..., PrimitiveExpression], Callable[..., PrimitiveExpression]] = {
+    concat: concat_unchecked,
+    inttostr: inttostr_unchecked,
+    plus: unchecked_binary_operation(operator.add),
+    minus: unchecked_binary_operation(operator.sub),
+    multiply: unchecked_binary_operation(operator.mul),
+    divide: unchecked_binary_operation(operator.floordiv),
+    modulo: unchecked_binary_operation(operator.mod),
+    less: unchecked_binary_operation(operator.lt),
+    greater: unchecked_binary_operation(operator.gt),
+    plus_int64: unchecked_binary_operation(wrapping(operator.add)),
+    minus_int64: unchecked_binary_operation(wrapping(operator.sub)),
+    multiply_int64: unchecked_binary_operation(wrapping(operator.mul)),
+    divide_int64: unchecked_binary_operation(wrapping(truncated_divide)),
+    modulo_int64: unchecked_binary_operation(truncated_remainder),
+    less_int64: unchecked_binary_operation(operator.lt),
+    greater_int64: unchecked_binary_operation(operator.gt),
+    equal_int64: unchecked_binary_operation(operator.eq),
+    plus_float64: unchecked_binary_operation(operator.add),
+    minus_float64: unchecked_binary_operation(operator.sub),
+    multiply_float64: unchecked_binary_operation(operator.mul),
+    divide_float64: unchecked_binary_operation(ieee_divide),
+    less_float64: unchecked_binary_operation(operator.lt),
+    greater_float64: unchecked_binary_operation(operator.gt),
+    equal_float64: unchecked_binary_operation(operator.eq),
+}
+
+
+def primitive_function(parameter_types: List[BuiltInPrimitiveType], return_type: BuiltInPrimitiveType,
+                       parameters: List[str], impl: Callable[..., PrimitiveExpression]) -> PrimitiveFunction:
+    return PrimitiveFunction({}, TypeSignatureFunction(list(map(TypeSignaturePrimitive, parameter_types)),
+                                                       TypeSignaturePrimitive(return_type)), parameters, impl)
+
+
+def map_prelude() -> Dict[str, Definition]:
+    string = BuiltInPrimitiveType.STRING
+    integer = BuiltInPrimitiveType.INTEGER
+    map_type = BuiltInPrimitiveType.MAP
+    return {
+        "mapEmpty": Constant({}, PrimitiveExpression(HashTrie()), TypeSignaturePrimitive(map_type)),
+        "mapInsert": primitive_function([map_type, string, integer], map_type, ["map", "key", "value"], map_insert),
+        "mapLookup": primitive_function([map_type, string, integer], integer, ["map", "key", "default"], map_lookup),
+        "mapContains": primitive_function([map_type, string], BuiltInPrimitiveType.BOOLEAN, ["map", "key"],
+                                          map_contains),
+        "mapRemove": primitive_function([map_type, string], map_type, ["map", "key"], map_remove),
+        "mapSize": primitive_function([map_type], integer, ["map"], map_size),
+        "mapFold": PrimitiveFunction(
+            {},
+            TypeSignatureFunction([TypeSignatureFunction([TypeSignaturePrimitive(integer),
+                                                          TypeSignaturePrimitive(string),
+                                                          TypeSignaturePrimitive(integer)],
+                                                         TypeSignaturePrimitive(integer)),
+                                   TypeSignaturePrimitive(integer), TypeSignaturePrimitive(map_type)],
+                                  TypeSignaturePrimitive(integer)),
+            ["function", "initial", "map"], map_fold),
+    }
+
+
+# Streams are of Strings, since the type system has no generics yet.
+def stream_prelude() -> Dict[str, Definition]:
+    string = TypeSignaturePrimitive(BuiltInPrimitiveType.STRING)
+    integer = TypeSignaturePrimitive(BuiltInPrimitiveType.INTEGER)
+    stream = TypeSignaturePrimitive(BuiltInPrimitiveType.STREAM)
+    return {
+        "readLines": primitive_function([BuiltInPrimitiveType.STRING], BuiltInPrimitiveType.STREAM, ["path"],
+                                        read_lines),
+        "streamMap": PrimitiveFunction({}, TypeSignatureFunction([TypeSignatureFunction([string], string), stream],
+                                                                 stream), ["function", "stream"], stream_map),
+        "streamFilter": PrimitiveFunction(
+            {}, TypeSignatureFunction([TypeSignatureFunction([string], TypeSignaturePrimitive(
+                BuiltInPrimitiveType.BOOLEAN)), stream], stream), ["predicate", "stream"], stream_filter),
+        "streamTake": primitive_function([BuiltInPrimitiveType.INTEGER, BuiltInPrimitiveType.STREAM],
+                                         BuiltInPrimitiveType.STREAM, ["count", "stream"], stream_take),
+        "streamFold": PrimitiveFunction(
+            {}, TypeSignatureFunction([TypeSignatureFunction([integer, string], integer), integer, stream], integer),
+            ["function", "initial", "stream"], stream_fold),
+    }
+
+
+# Elements are Integers that fit into 64 bits.
+def array_prelude() -> Dict[str, Definition]:
+    integer = BuiltInPrimitiveType.INTEGER
+    array_type = BuiltInPrimitiveType.ARRAY
+    int64 = BuiltInPrimitiveType.INT64
+    return {
+        "arrayFill": primitive_function([integer, int64], array_type, ["size", "value"], array_fill),
+        "arrayLength": primitive_function([array_type], integer, ["array"], array_length),
+        "arrayGet": primitive_function([array_type, integer], int64, ["array", "index"], array_get),
+        "arraySum": primitive_function([array_type], int64, ["array"], array_sum),
+        "arraySet": primitive_function([array_type, integer, int64], array_type, ["array", "index", "value"],
+                                       array_set),
+        "arrayPush": primitive_function([array_type, int64], array_type, ["array", "value"], array_push),
+    }
+
+
+def fixed_width_prelude() -> Dict[str, Definition]:
+    integer = BuiltInPrimitiveType.INTEGER
+    int64 = BuiltInPrimitiveType.INT64
+    float64 = BuiltInPrimitiveType.FLOAT64
+    boolean = BuiltInPrimitiveType.BOOLEAN
+    int64_array = BuiltInPrimitiveType.INT64_ARRAY
+    float64_array = BuiltInPrimitiveType.FLOAT64_ARRAY
+    return {
+        "int64": primitive_function([integer], int64, ["number"], to_int64),
+        "int64ToInteger": primitive_function([int64], integer, ["number"], int64_to_integer),
+        "int64ToFloat64": primitive_function([int64], float64, ["number"], int64_to_float64),
+        "float64ToInt64": primitive_function([float64], int64, ["number"], float64_to_int64),
+        "int64ToStr": primitive_function([int64], BuiltInPrimitiveType.STRING, ["number"], inttostr),
+        "float64ToStr": primitive_function([float64], BuiltInPrimitiveType.STRING, ["number"], float64_to_str),
+        "plusInt64": primitive_function([int64, int64], int64, ["a", "b"], plus_int64),
+        "minusInt64": primitive_function([int64, int64], int64, ["a", "b"], minus_int64),
+        "multiplyInt64": primitive_function([int64, int64], int64, ["a", "b"], multiply_int64),
+        "divideInt64": primitive_function([int64, int64], int64, ["numerator", "denominator"], divide_int64),
+        "moduloInt64": primitive_function([int64, int64], int64, ["numerator", "denominator"], modulo_int64),
+        "lessInt64": primitive_function([int64, int64], boolean, ["a", "b"], less_int64),
+        "greaterInt64": primitive_function([int64, int64], boolean, ["a", "b"], greater_int64),
+        "equalInt64": primitive_function([int64, int64], boolean, ["a", "b"], equal_int64),
+        "plusFloat64": primitive_function([float64, float64], float64, ["a", "b"], plus_float64),
+        "minusFloat64": primitive_function([float64, float64], float64, ["a", "b"], minus_float64),
+        "multiplyFloat64": primitive_function([float64, float64], float64, ["a", "b"], multiply_float64),
+        "divideFloat64": primitive_function([float64, float64], float64, ["numerator", "denominator"],
+                                            divide_float64),
+        "lessFloat64": primitive_function([float64, float64], boolean, ["a", "b"], less_float64),
+        "greaterFloat64": primitive_function([float64, float64], boolean, ["a", "b"], greater_float64),
+        "equalFloat64": primitive_function([float64, float64], boolean, ["a", "b"], equal_float64),
+        "int64ArrayFill": primitive_function([integer, int64], int64_array, ["size", "value"], int64_array_fill),
+        "int64ArrayRange": primitive_function([int64, int64], int64_array, ["start", "stop"], int64_array_range),
+        "int64ArrayLength": primitive_function([int64_array], integer, ["array"], int64_array_length),
+        "int64ArrayGet": primitive_function([int64_array, integer], int64, ["array", "index"], int64_array_get),
+        "int64ArraySet": primitive_function([int64_array, integer, int64], int64_array, ["array", "index", "value"],
+                                            int64_array_set),
+        "int64ArraySum": primitive_function([int64_array], int64, ["array"], int64_array_sum),
+        "int64ArrayToFloat64Array": primitive_function([int64_array], float64_array, ["array"],
+                                                       int64_array_to_float64_array),
+        "float64ArrayFill": primitive_function([integer, float64], float64_array, ["size", "value"],
+                                               float64_array_fill),
+        "float64ArrayLength": primitive_function([float64_array], integer, ["array"], float64_array_length),
+        "float64ArrayGet": primitive_function([float64_array, integer], float64, ["array", "index"],
+                                              float64_array_get),
+        "float64ArraySet": primitive_function([float64_array, integer, float64], float64_array,
+                                              ["array", "index", "value"], float64_array_set),
+        "float64ArraySum": primitive_function([float64_array], float64, ["array"], float64_array_sum),
+        "float64ArrayDot": primitive_function([float64_array, float64_array], float64, ["a", "b"], float64_array_dot),
+    }
+
+
+def build_prelude() -> Dict[str, Definition]:
     return {
         "printLine": PrimitiveFunction(
             {},
@@ -87,6 +645,8 @@ def default_environment() -> Dict[str, Definition]:
             TypeSignatureFunction([TypeSignaturePrimitive(BuiltInPrimitiveType.INTEGER)],
                                   TypeSignaturePrimitive(BuiltInPrimitiveType.STRING)),
             ["number"], inttostr),
+        "strToInt": primitive_function([BuiltInPrimitiveType.STRING], BuiltInPrimitiveType.INTEGER, ["text"],
+                                       strtoint),
         "plus": PrimitiveFunction(
             {},
             TypeSignatureFunction([TypeSignaturePrimitive(BuiltInPrimitiveType.INTEGER),
@@ -121,18 +681,26 @@ def default_environment() -> Dict[str, Definition]:
             {},
             TypeSignatureFunction([TypeSignaturePrimitive(BuiltInPrimitiveType.INTEGER),
                                    TypeSignaturePrimitive(BuiltInPrimitiveType.INTEGER)],
-                                  TypeSignaturePrimitive(BuiltInPrimitiveType.INTEGER)),
+                                  TypeSignaturePrimitive(BuiltInPrimitiveType.BOOLEAN)),
             ["a", "b"], less),
         "greater": PrimitiveFunction(
             {},
             TypeSignatureFunction([TypeSignaturePrimitive(BuiltInPrimitiveType.INTEGER),
                                    TypeSignaturePrimitive(BuiltInPrimitiveType.INTEGER)],
-                                  TypeSignaturePrimitive(BuiltInPrimitiveType.INTEGER)),
+                                  TypeSignaturePrimitive(BuiltInPrimitiveType.BOOLEAN)),
             ["a", "b"], greater),
         "equal": PrimitiveFunction(
             {},
             TypeSignatureFunction([TypeSignaturePrimitive(BuiltInPrimitiveType.INTEGER),
                                    TypeSignaturePrimitive(BuiltInPrimitiveType.INTEGER)],
-                                  TypeSignaturePrimitive(BuiltInPrimitiveType.INTEGER)),
+                                  TypeSignaturePrimitive(BuiltInPrimitiveType.BOOLEAN)),
             ["a", "b"], equal),
-    }
+    } | fixed_width_prelude() | map_prelude() | array_prelude() | stream_prelude()
+
+
+# Built once per process and shared, since the definitions are immutable.
+PRELUDE: Mapping[str, Definition] = MappingProxyType(build_prelude())
+
+
+def default_environment() -> Dict[str, Definition]:
+    return dict(PRELUDE)
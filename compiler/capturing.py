@@ -0,0 +1,60 @@
+from typing import Dict, Set, Tuple, FrozenSet, Iterable
+
+from .expressions import Definition, Constant, CompoundFunction, PrimitiveFunction
+from .traversing import flatten_definitions
+from .tree_shaking import referenced_names
+
+
+def free_variables(d: Definition) -> Set[str]:
+    names: Set[str] = set()
+    if isinstance(d, Constant):
+        names.update(referenced_names(d.expression))
+    if isinstance(d, CompoundFunction):
+        names.update(referenced_names(d.body))
+    for sub_definition in d.sub_definitions.values():
+        names |= free_variables(sub_definition)
+    names.difference_update(d.sub_definitions)
+    if isinstance(d, (CompoundFunction, PrimitiveFunction)):
+        names.difference_update(d.parameters)
+    return names
+
+
+def names_reachable_from(name: str, references: Dict[str, Set[str]], memo: Dict[str, FrozenSet[str]]) \
+        -> FrozenSet[str]:
+    if name not in memo:
+        reached: Set[str] = set()
+        pending = [name]
+        while len(pending) > 0:
+            current = pending.pop()
+            if current in reached:
+                continue
+            if current in memo:
+                reached |= memo[current]
+                continue
+            reached.add(current)
+            pending.extend(references.get(current, set()))
+        memo[name] = frozenset(reached)
+    return memo[name]
+
+
+def reachable_names(names: Iterable[str], references: Dict[str, Set[str]],
+                    memo: Dict[str, FrozenSet[str]]) -> Set[str]:
+    reached: Set[str] = set()
+    for name in names:
+        reached |= names_reachable_from(name, references, memo)
+    return reached
+
+
+# Names referenced from a closure body are resolved in the environment the body runs in, and so are the names
+# referenced by the definitions they resolve to. So a closure has to capture its free variables and everything
+# reachable from them. Like tree shaking, this is conservative: a name stands for every definition of that name.
+# Returns the captured names by the id of each compound function, including the nested ones.
+def closure_captures(definitions: Dict[str, Definition]) -> Dict[int, Tuple[str, ...]]:
+    flat = [(name, d) for name, d, _ in flatten_definitions(definitions, frozenset())]
+    free = {id(d): free_variables(d) for _, d in flat}
+    references: Dict[str, Set[str]] = {}
+    for name, d in flat:
+        references.setdefault(name, set()).update(free[id(d)])
+    memo: Dict[str, FrozenSet[str]] = {}
+    return {id(d): tuple(sorted(reachable_names(free[id(d)], references, memo)))
+            for _, d in flat if isinstance(d, CompoundFunction)}
@@ -0,0 +1,169 @@
+from collections import Counter
+from dataclasses import dataclass
+from enum import IntEnum
+from typing import Dict, List, Set, Tuple, Iterator, FrozenSet
+
+from .expressions import Expression, Call, Variable, Definition, Constant, CompoundFunction, Let, PrimitiveExpression
+from .parsing import hash_cons, make_call, make_variable
+from .traversing import sub_expressions, definition_expressions, flatten_definitions, callable_parameters
+
+# Array values are mutable, so calls creating or updating them must neither be shared nor duplicated.
+IMPURE_BUILT_INS = frozenset({"printLine", "arrayFill", "arraySet", "arrayPush"})
+BINDING_PREFIX = "$cse"
+
+
+class Purity(IntEnum):
+    PURE = 0
+    # Only impure through calling the function parameters of the enclosing function.
+    PARAMETRIC = 1
+    IMPURE = 2
+
+
+@dataclass(frozen=True)
+class Effects:
+    impure: Set[str]
+    parametric: Set[str]
+    constants: Set[str]
+    # Names the environment of a call can bind to anything, see local_names in interpreting.py.
+    shadowed: FrozenSet[str] = frozenset()
+
+
+def purity(exp: Expression, effects: Effects, parameters: FrozenSet[str]) -> Purity:
+    if isinstance(exp, PrimitiveExpression):
+        return Purity.PURE
+    if isinstance(exp, Variable):
+        if exp.name in parameters:
+            return Purity.PURE
+        if exp.name in effects.impure:
+            return Purity.IMPURE
+        if exp.name in effects.parametric:
+            # Evaluating such a constant calls parameters; a function value could be called with anything.
+            return Purity.PARAMETRIC if exp.name in effects.constants else Purity.IMPURE
+        return Purity.PURE
+    if not isinstance(exp, Call) or not isinstance(exp.operator, Variable):
+        return Purity.IMPURE
+    name = exp.operator.name
+    operands = max((purity(operand, effects, parameters) for operand in exp.operands), default=Purity.PURE)
+    if name in parameters:
+        return max(operands, Purity.PARAMETRIC)
+    if name in effects.impure or name in effects.shadowed:
+        return Purity.IMPURE
+    # A parametric function is as pure as the functions passed to it, which can only be impure
+    # if they are (or are built from) impure names or parameters.
+    if name in effects.parametric and any(isinstance(node, Variable) and node.name in parameters
+                                          for operand in exp.operands for node in sub_expressions(operand)):
+        return max(operands, Purity.PARAMETRIC)
+    return operands
+
+
+def is_pure(exp: Expression, effects: Effects, parameters: FrozenSet[str]) -> bool:
+    return purity(exp, effects, parameters) == Purity.PURE
+
+
+# Calling a parameter could run anything, so such definitions are only pure if called with pure functions.
+# Nested functions calling parameters of their enclosing function count as impure, and so do calls of shadowed names.
+def analyze_effects(definitions: Dict[str, Definition], shadowed: FrozenSet[str] = frozenset()) -> Effects:
+    flat = list(flatten_definitions(definitions, frozenset()))
+    effects = Effects(set(IMPURE_BUILT_INS), set(), {name for name, d, _ in flat if isinstance(d, Constant)}, shadowed)
+    changed = True
+    while changed:
+        changed = False
+        for name, d, parameters in flat:
+            if name in effects.impure:
+                continue
+            level = max((purity(exp, effects, parameters) for exp in definition_expressions(d)),
+                        default=Purity.PURE)
+            own_parameters = callable_parameters(d) if isinstance(d, CompoundFunction) else frozenset()
+            if level == Purity.PARAMETRIC and isinstance(d, CompoundFunction) and parameters != own_parameters:
+                level = Purity.IMPURE
+            if level == Purity.IMPURE:
+                effects.impure.add(name)
+                effects.parametric.discard(name)
+                changed = True
+            elif level == Purity.PARAMETRIC and name not in effects.parametric:
+                effects.parametric.add(name)
+                changed = True
+    return effects
+
+
+# Matches are left alone, since their case bodies can reference the names the cases bind.
+def count_calls(exp: Expression, counts: Counter[int], nodes: Dict[int, Expression]) -> None:
+    if isinstance(exp, Call):
+        counts[id(exp)] += 1
+        nodes[id(exp)] = exp
+        count_calls(exp.operator, counts, nodes)
+        for operand in exp.operands:
+            count_calls(operand, counts, nodes)
+
+
+def outermost(exp: Expression, candidates: Set[int], found: Dict[int, Expression]) -> None:
+    if id(exp) in candidates:
+        found[id(exp)] = exp
+        return
+    if isinstance(exp, Call):
+        outermost(exp.operator, candidates, found)
+        for operand in exp.operands:
+            outermost(operand, candidates, found)
+
+
+def substitute(exp: Expression, replacements: Dict[int, Expression]) -> Expression:
+    if id(exp) in replacements:
+        return replacements[id(exp)]
+    return substitute_children(exp, replacements)
+
+
+def substitute_children(exp: Expression, replacements: Dict[int, Expression]) -> Expression:
+    if isinstance(exp, Call):
+        return make_call(substitute(exp.operator, replacements),
+                         [substitute(operand, replacements) for operand in exp.operands])
+    return exp
+
+
+def eliminate_in_expression(exp: Expression, effects: Effects, parameters: FrozenSet[str]) -> Expression:
+    body = hash_cons(exp)
+    bindings: List[Tuple[str, Expression]] = []
+    while True:
+        counts: Counter[int] = Counter()
+        nodes: Dict[int, Expression] = {}
+        count_calls(body, counts, nodes)
+        for _, bound in bindings:
+            count_calls(bound, counts, nodes)
+            counts[id(bound)] -= 1
+        candidates = {node_id for node_id, count in counts.items()
+                      if count >= 2 and is_pure(nodes[node_id], effects, parameters)}
+        if len(candidates) == 0:
+            break
+        found: Dict[int, Expression] = {}
+        outermost(body, candidates, found)
+        for _, bound in bindings:
+            if isinstance(bound, Call):
+                for child in [bound.operator, *bound.operands]:
+                    outermost(child, candidates, found)
+        replacements = {node_id: make_variable(f"{BINDING_PREFIX}{len(bindings) + i}")
+                        for i, node_id in enumerate(found)}
+        body = substitute(body, replacements)
+        bindings = [(name, substitute_children(bound, replacements)) for name, bound in bindings] + \
+                   [(f"{BINDING_PREFIX}{len(bindings) + i}", substitute_children(node, replacements))
+                    for i, node in enumerate(found.values())]
+    return Let(tuple(bindings), body) if len(bindings) > 0 else exp
+
+
+def eliminate_in_definition(d: Definition, effects: Effects, parameters: FrozenSet[str]) -> Definition:
+    if isinstance(d, CompoundFunction):
+        parameters = parameters | callable_parameters(d)
+    sub_definitions = {name: eliminate_in_definition(sub_definition, effects, parameters)
+                       for name, sub_definition in d.sub_definitions.items()}
+    if isinstance(d, Constant):
+        return Constant(sub_definitions, eliminate_in_expression(d.expression, effects, parameters), d.type_sig)
+    if isinstance(d, CompoundFunction):
+        return CompoundFunction(sub_definitions, d.type_sig, d.parameters,
+                                eliminate_in_expression(d.body, effects, parameters), d.tail_recursive)
+    return d
+
+
+# Runs on type-checked definitions. A repeated pure call becomes a Let binding, which is evaluated at most once
+# per function activation and only if some occurrence is actually reached (ifElse branches stay lazy).
+def eliminate_common_subexpressions(definitions: Dict[str, Definition],
+                                    shadowed: FrozenSet[str] = frozenset()) -> Dict[str, Definition]:
+    effects = analyze_effects(definitions, shadowed)
+    return {name: eliminate_in_definition(d, effects, frozenset()) for name, d in definitions.items()}
@@ -1,12 +1,17 @@
 from __future__ import annotations
 from __future__ import annotations
 
+import threading
 from abc import ABC
-from dataclasses import dataclass
-from typing import List, Callable
+from array import array
+from dataclasses import dataclass, field
+from enum import auto, StrEnum
+from typing import List, Callable, Optional, Tuple, Iterable, Generator
 from typing import Sequence, Dict, Union
 
-from .type_signatures import TypeSignature, TypeSignatureFunction
+from .hash_tries import HashTrie
+from .ropes import Rope
+from .type_signatures import TypeSignature, TypeSignatureFunction, TypeSignaturePrimitive, BuiltInPrimitiveType
 
 
 @dataclass(frozen=True)
@@ -20,11 +25,13 @@ class Constant(Definition):
     type_sig: TypeSignature
 
 
+# Tail-recursive functions (annotated with `tailrec`) are checked to only call themselves in tail position.
 @dataclass(frozen=True)
 class CompoundFunction(Definition):
     type_sig: TypeSignatureFunction
     parameters: List[str]
     body: Expression
+    tail_recursive: bool = False
 
 
 @dataclass(frozen=True)
@@ -41,13 +48,140 @@ class Expression(ABC):
 
 @dataclass(frozen=True)
 class PrimitiveExpression(Expression):
-    value: Union[None, str, bool, float, dict[str, PrimitiveExpression]]
+    value: Union[None, str, bool, float, dict[str, PrimitiveExpression], array[int], array[float], Rope, HashTrie,
+                 ArrayValue, StreamValue]
+
+
+# The elements of an Array value, which updates mutate in place. The type checker ensures that arrays bound to names
+# have a single owner. Arrays that stay reachable from elsewhere, e.g. from a struct, are marked as shared instead,
+# and the first update of such an array copies it.
+@dataclass
+class ArrayValue:
+    elements: array[int]
+    shared: bool = field(default=False, compare=False)
+
+
+# A lazy sequence of Strings. Each traversal starts a new iteration from the source of the stream, so a stream value
+# can be used any number of times. Elements are only produced while a traversal asks for them.
+@dataclass(frozen=True)
+class StreamValue:
+    traverse: Callable[[], Generator[PrimitiveExpression, None, None]]
+
+
+def share_arrays(values: Iterable[Expression]) -> None:
+    for value in values:
+        if isinstance(value, PrimitiveExpression) and type(value.value) is ArrayValue:
+            value.value.shared = True
+
+
+# Every type a value can have at runtime gets an integer tag, which is unique in this process. Tags are pickled by
+# their type, so code compiled in another process uses the tags of the one it is loaded into.
+@dataclass(frozen=True)
+class TypeTag:
+    type_sig: TypeSignaturePrimitive
+    index: int
+
+    def __reduce__(self) -> Tuple[Callable[[TypeSignaturePrimitive], TypeTag], Tuple[TypeSignaturePrimitive]]:
+        return type_tag, (self.type_sig,)
+
+
+_type_tags: Dict[TypeSignaturePrimitive, TypeTag] = {}
+_tag_types: List[TypeSignaturePrimitive] = []
+_type_tags_lock = threading.Lock()
+
+
+# Int64 values are Python ints just like Integer values, so both types share a tag.
+def type_tag(type_sig: TypeSignaturePrimitive) -> TypeTag:
+    if type_sig.name == BuiltInPrimitiveType.INT64:
+        type_sig = TypeSignaturePrimitive(BuiltInPrimitiveType.INTEGER)
+    with _type_tags_lock:
+        if type_sig not in _type_tags:
+            _type_tags[type_sig] = TypeTag(type_sig, len(_type_tags))
+            _tag_types.append(type_sig)
+        return _type_tags[type_sig]
+
+
+def tag_type(tag: int) -> TypeSignaturePrimitive:
+    return _tag_types[tag]
+
+
+def built_in_tag(built_in: BuiltInPrimitiveType) -> int:
+    return type_tag(TypeSignaturePrimitive(built_in)).index
+
+
+# The fields of a struct value, tagged with the struct type it was constructed as.
+class StructValue(Dict[str, "PrimitiveExpression"]):
+    __slots__ = ("tag",)
+
+    def __init__(self, tag: TypeTag, fields: Iterable[Tuple[str, PrimitiveExpression]]) -> None:
+        super().__init__(fields)
+        self.tag = tag
+
+
+BUILT_IN_TAGS: Dict[type, int] = {
+    type(None): built_in_tag(BuiltInPrimitiveType.NONE),
+    bool: built_in_tag(BuiltInPrimitiveType.BOOLEAN),
+    int: built_in_tag(BuiltInPrimitiveType.INTEGER),
+    float: built_in_tag(BuiltInPrimitiveType.FLOAT64),
+    str: built_in_tag(BuiltInPrimitiveType.STRING),
+    Rope: built_in_tag(BuiltInPrimitiveType.STRING),
+    HashTrie: built_in_tag(BuiltInPrimitiveType.MAP),
+    ArrayValue: built_in_tag(BuiltInPrimitiveType.ARRAY),
+    StreamValue: built_in_tag(BuiltInPrimitiveType.STREAM),
+}
+
+ARRAY_TAGS = {
+    "q": built_in_tag(BuiltInPrimitiveType.INT64_ARRAY),
+    "d": built_in_tag(BuiltInPrimitiveType.FLOAT64_ARRAY),
+}
+
+
+def value_tag(value: PrimitiveExpression) -> int:
+    if type(value.value) is StructValue:
+        return value.value.tag.index
+    if isinstance(value.value, array):
+        return ARRAY_TAGS[value.value.typecode]
+    return BUILT_IN_TAGS[type(value.value)]
+
+
+# Remembers the code (body or impl) of the functions a call site has called. Updates are not synchronized, so
+# concurrent evaluations may lose counts, which only affects the statistics.
+@dataclass
+class InlineCache:
+    targets: List[object] = field(default_factory=list)
+    # The callee of a site whose operator can only name a global definition, once resolved.
+    callee: Optional[Expression] = None
+    hits: int = 0
+    misses: int = 0
 
 
 @dataclass(frozen=True)
 class Call(Expression):
     operator: Expression
     operands: Sequence[Expression]
+    _hash: Optional[int] = field(default=None, init=False, repr=False, compare=False)
+
+    def __post_init__(self) -> None:
+        object.__setattr__(self, "operands", tuple(self.operands))
+
+    def __hash__(self) -> int:
+        if self._hash is None:
+            object.__setattr__(self, "_hash", hash((self.operator, self.operands)))
+        assert self._hash is not None
+        return self._hash
+
+    # String hashes differ between processes, and cached targets are only meaningful in this one.
+    def __reduce__(self) -> Tuple[type, Tuple[Expression, Sequence[Expression]]]:
+        return Call, (self.operator, self.operands)
+
+
+# A call at one place in a program prepared for evaluation. Calls are hash-consed across programs, so the inline
+# cache belongs to these copies instead. Unless global, the operator may name a parameter or another local binding,
+# which depends on the environment, so it is looked up on every call.
+@dataclass(frozen=True, eq=False)
+class CallSite(Call):
+    global_operator: bool = False
+    inline_cache: InlineCache = field(default_factory=InlineCache, init=False, repr=False, compare=False)
 
 
 @dataclass(frozen=True)
@@ -61,11 +195,14 @@ class ConstantClosure(Expression):
     body: Expression
 
 
+# With captures, only these names are taken over from the environment the closure is created in,
+# otherwise the whole environment is.
 @dataclass(frozen=True)
 class CompoundClosure(Expression):
     parameters: List[str]
     environment: Dict[str, Expression]
     body: Expression
+    captures: Optional[Tuple[str, ...]] = None
 
 
 @dataclass(frozen=True)
@@ -73,3 +210,80 @@ class PrimitiveClosure(Expression):
     parameters: List[str]
     environment: Dict[str, Expression]
     impl: Callable[..., PrimitiveExpression]
+
+
+# A closure applied to fewer arguments than it has parameters. The arguments are already evaluated, and the callee
+# is never a partial application itself, so applying further arguments only concatenates the argument tuples.
+@dataclass(frozen=True)
+class PartialApplication(Expression):
+    callee: Union[CompoundClosure, PrimitiveClosure]
+    arguments: Tuple[Expression, ...]
+
+
+# Bindings are evaluated lazily and at most once per evaluation of the Let.
+@dataclass(frozen=True)
+class Let(Expression):
+    bindings: Tuple[Tuple[str, Expression], ...]
+    body: Expression
+
+
+@dataclass(frozen=True)
+class MatchCase:
+    type_sig: TypeSignaturePrimitive
+    # Bound to the matched value in the body, if given.
+    name: Optional[str]
+    body: Expression
+
+
+# Dispatches on the tag of the value through a jump table, so selecting a case takes constant time.
+# The case types are the non-union types the matched value can have.
+@dataclass(frozen=True)
+class Match(Expression):
+    scrutinee: Expression
+    cases: Tuple[MatchCase, ...]
+    jump_table: Dict[int, MatchCase] = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self) -> None:
+        object.__setattr__(self, "jump_table", {type_tag(case.type_sig).index: case for case in self.cases})
+
+    # The jump table is rebuilt with the tags of the process the match is loaded into.
+    def __reduce__(self) -> Tuple[type, Tuple[Expression, Tuple[MatchCase, ...]]]:
+        return Match, (self.scrutinee, self.cases)
+
+
+# The body of a tail-recursive function, whose calls of itself in tail position rebind the parameters.
+@dataclass(frozen=True)
+class TailLoop(Expression):
+    name: str
+    parameters: List[str]
+    body: Expression
+
+
+@dataclass(frozen=True, eq=False)
+class Thunk(Expression):
+    expression: Expression
+    environment: Dict[str, Expression]
+    value: List[Expression]
+
+
+class PipelineStageKind(StrEnum):
+    MAP = auto()
+    FILTER = auto()
+
+
+@dataclass(frozen=True)
+class PipelineStage:
+    kind: PipelineStageKind
+    function: Expression
+
+
+# A fused chain of list functions over a cons list built from the struct `cons` with the accessors `head` and `tail`.
+# Without a fold, the result is rebuilt as a cons list.
+@dataclass(frozen=True)
+class FusedPipeline(Expression):
+    source: Expression
+    cons: str
+    head: str
+    tail: str
+    stages: Tuple[PipelineStage, ...]
+    fold: Optional[Tuple[Expression, Expression]]
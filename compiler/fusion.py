@@ -0,0 +1,267 @@
+from dataclasses import dataclass
+from enum import auto, StrEnum
+from typing import Dict, List, Optional, Tuple, FrozenSet
+
+from .common_subexpressions import analyze_effects, is_pure
+from .expressions import Expression, Call, Variable, PrimitiveExpression, Definition, CompoundFunction, Constant, \
+    PrimitiveFunction, FusedPipeline, PipelineStage, PipelineStageKind
+from .parsing import make_call
+
+
+class ListFunctionKind(StrEnum):
+    MAP = auto()
+    FILTER = auto()
+    FOLD = auto()
+
+
+@dataclass(frozen=True)
+class ListFunction:
+    kind: ListFunctionKind
+    arity: int
+    list_parameter: int
+    function_parameter: int
+    accumulator_parameter: Optional[int]
+    cons: str
+    head: str
+    tail: str
+
+
+@dataclass(frozen=True)
+class ListFunctionWrapper:
+    wrapped: str
+    arguments: Tuple[Expression, ...]
+    list_argument: int
+
+
+@dataclass(frozen=True)
+class Fusion:
+    definition: str
+    functions: Tuple[str, ...]
+
+
+def operator_name(exp: Expression) -> Optional[str]:
+    if isinstance(exp, Call) and isinstance(exp.operator, Variable):
+        return exp.operator.name
+    return None
+
+
+def is_none_check(exp: Expression, list_name: str) -> bool:
+    if operator_name(exp) != "equal":
+        return False
+    assert isinstance(exp, Call)
+    return exp.operands in [(Variable(list_name), PrimitiveExpression(None)),
+                            (PrimitiveExpression(None), Variable(list_name))]
+
+
+def accessor_of(exp: Expression, list_name: str) -> Optional[str]:
+    name = operator_name(exp)
+    if name is None or "." not in name:
+        return None
+    assert isinstance(exp, Call)
+    return name if exp.operands == (Variable(list_name),) else None
+
+
+def is_recursive_call(exp: Expression, name: str, parameters: List[str], list_parameter: int, tail: str) -> bool:
+    if operator_name(exp) != name:
+        return False
+    assert isinstance(exp, Call)
+    expected: List[Expression] = [Variable(p) for p in parameters]
+    expected[list_parameter] = Call(Variable(tail), [Variable(parameters[list_parameter])])
+    return list(exp.operands) == expected
+
+
+def recognize_list_function(definitions: Dict[str, Definition], name: str, d: CompoundFunction) \
+        -> Optional[ListFunction]:
+    body = d.body
+    if len(d.sub_definitions) > 0 or operator_name(body) != "ifElse":
+        return None
+    assert isinstance(body, Call)
+    condition, empty_case, other_case = body.operands
+    for list_parameter, list_name in enumerate(d.parameters):
+        if not is_none_check(condition, list_name) or not isinstance(other_case, Call):
+            continue
+        candidate = recognize_cases(d, name, list_parameter, empty_case, other_case)
+        if candidate is not None and is_cons(definitions, candidate.cons, candidate.head, candidate.tail):
+            return candidate
+    return None
+
+
+def recognize_cases(d: CompoundFunction, name: str, list_parameter: int, empty_case: Expression,
+                    other_case: Call) -> Optional[ListFunction]:
+    parameters = d.parameters
+    list_name = parameters[list_parameter]
+    operands = other_case.operands
+    if operator_name(other_case) != "ifElse" and len(operands) != 2:
+        return None
+    if isinstance(other_case.operator, Variable) and other_case.operator.name in parameters:
+        # foldr: ifElse (equal xs none) acc (f (C.head xs) (self ... (C.tail xs) ...))
+        head = accessor_of(operands[0], list_name)
+        tail = accessor_of(operands[1].operands[list_parameter], list_name) \
+            if isinstance(operands[1], Call) and len(operands[1].operands) == len(parameters) else None
+        if head is None or tail is None or not isinstance(empty_case, Variable) or empty_case.name not in parameters:
+            return None
+        if not is_recursive_call(operands[1], name, parameters, list_parameter, tail):
+            return None
+        return ListFunction(ListFunctionKind.FOLD, len(parameters), list_parameter,
+                            parameters.index(other_case.operator.name), parameters.index(empty_case.name),
+                            head.split(".")[0], head, tail)
+    if empty_case != PrimitiveExpression(None):
+        return None
+    if operator_name(other_case) == "ifElse":
+        # filter: ifElse (equal xs none) none (ifElse (p (C.head xs)) (C (C.head xs) rec) rec)
+        predicate_call, kept, dropped = other_case.operands
+        predicate = operator_name(predicate_call)
+        if predicate not in parameters or not isinstance(predicate_call, Call) or len(predicate_call.operands) != 1:
+            return None
+        head = accessor_of(predicate_call.operands[0], list_name)
+        cons = operator_name(kept)
+        if head is None or cons is None or not isinstance(kept, Call) or len(kept.operands) != 2:
+            return None
+        tail = accessor_of(dropped.operands[list_parameter], list_name) \
+            if isinstance(dropped, Call) and len(dropped.operands) == len(parameters) else None
+        if tail is None or kept.operands != (predicate_call.operands[0], dropped) or \
+                not is_recursive_call(dropped, name, parameters, list_parameter, tail):
+            return None
+        return ListFunction(ListFunctionKind.FILTER, len(parameters), list_parameter, parameters.index(predicate),
+                            None, cons, head, tail)
+    # map: ifElse (equal xs none) none (C (f (C.head xs)) (self ... (C.tail xs) ...))
+    cons = operator_name(other_case)
+    function = operator_name(operands[0])
+    if cons is None or function not in parameters:
+        return None
+    assert isinstance(operands[0], Call)
+    if len(operands[0].operands) != 1:
+        return None
+    head = accessor_of(operands[0].operands[0], list_name)
+    tail = accessor_of(operands[1].operands[list_parameter], list_name) \
+        if isinstance(operands[1], Call) and len(operands[1].operands) == len(parameters) else None
+    if head is None or tail is None or not is_recursive_call(operands[1], name, parameters, list_parameter, tail):
+        return None
+    return ListFunction(ListFunctionKind.MAP, len(parameters), list_parameter, parameters.index(function), None,
+                        cons, head, tail)
+
+
+def is_cons(definitions: Dict[str, Definition], cons: str, head: str, tail: str) -> bool:
+    constructor = definitions.get(cons)
+    return isinstance(constructor, PrimitiveFunction) and head.startswith(cons + ".") and \
+        tail.startswith(cons + ".") and constructor.parameters == [head[len(cons) + 1:], tail[len(cons) + 1:]]
+
+
+# e.g. sum:Integer xs:IntList = foldr plus 0 xs
+def recognize_wrapper(list_functions: Dict[str, ListFunction], d: CompoundFunction) -> Optional[ListFunctionWrapper]:
+    name = operator_name(d.body)
+    if len(d.sub_definitions) > 0 or len(d.parameters) != 1 or name not in list_functions:
+        return None
+    assert isinstance(d.body, Call) and name is not None
+    list_function = list_functions[name]
+    if len(d.body.operands) != list_function.arity or \
+            d.body.operands[list_function.list_parameter] != Variable(d.parameters[0]):
+        return None
+    others = [arg for i, arg in enumerate(d.body.operands) if i != list_function.list_parameter]
+    if not all(isinstance(arg, PrimitiveExpression) or
+               (isinstance(arg, Variable) and arg.name != d.parameters[0]) for arg in others):
+        return None
+    return ListFunctionWrapper(name, tuple(d.body.operands), list_function.list_parameter)
+
+
+class PipelineFuser:
+    def __init__(self, definitions: Dict[str, Definition], shadowed: FrozenSet[str]) -> None:
+        self.definitions = definitions
+        self.list_functions: Dict[str, ListFunction] = {}
+        for name, d in definitions.items():
+            if isinstance(d, CompoundFunction):
+                list_function = recognize_list_function(definitions, name, d)
+                if list_function is not None:
+                    self.list_functions[name] = list_function
+        self.wrappers: Dict[str, ListFunctionWrapper] = {}
+        for name, d in definitions.items():
+            if isinstance(d, CompoundFunction) and name not in self.list_functions:
+                wrapper = recognize_wrapper(self.list_functions, d)
+                if wrapper is not None:
+                    self.wrappers[name] = wrapper
+        self.effects = analyze_effects(definitions, shadowed)
+        self.fusions: List[Fusion] = []
+
+    # Fusion interleaves the stages per element, which is only unobservable for pure stage functions.
+    def is_pure_argument(self, exp: Expression, local_names: FrozenSet[str]) -> bool:
+        return is_pure(exp, self.effects, local_names) and \
+            not (isinstance(exp, Variable) and exp.name in local_names)
+
+    # Resolves a call to a list function (directly or through a wrapper) into the function and its arguments.
+    def resolve(self, exp: Expression, local_names: FrozenSet[str]) \
+            -> Optional[Tuple[str, ListFunction, Tuple[Expression, ...]]]:
+        name = operator_name(exp)
+        if name is None or name in local_names:
+            return None
+        assert isinstance(exp, Call)
+        if name in self.list_functions and len(exp.operands) == self.list_functions[name].arity:
+            return name, self.list_functions[name], tuple(exp.operands)
+        if name in self.wrappers and len(exp.operands) == 1:
+            wrapper = self.wrappers[name]
+            if any(isinstance(arg, Variable) and arg.name in local_names
+                   for i, arg in enumerate(wrapper.arguments) if i != wrapper.list_argument):
+                return None
+            arguments = list(wrapper.arguments)
+            arguments[wrapper.list_argument] = exp.operands[0]
+            return name, self.list_functions[wrapper.wrapped], tuple(arguments)
+        return None
+
+    def fuse(self, exp: Expression, definition_name: str, local_names: FrozenSet[str]) -> Expression:
+        chain: List[Tuple[str, ListFunction, Tuple[Expression, ...]]] = []
+        current = exp
+        while True:
+            resolved = self.resolve(current, local_names)
+            if resolved is None or (len(chain) > 0 and (resolved[1].kind == ListFunctionKind.FOLD or
+                                                        resolved[1].cons != chain[0][1].cons)):
+                break
+            _, list_function, arguments = resolved
+            if not all(self.is_pure_argument(arguments[i], local_names) for i in range(list_function.arity)
+                       if i != list_function.list_parameter):
+                break
+            chain.append(resolved)
+            current = arguments[list_function.list_parameter]
+        if len(chain) < 2:
+            return self.fuse_children(exp, definition_name, local_names)
+        chain.reverse()
+        _, outer, outer_arguments = chain[-1]
+        fold = None
+        if outer.kind == ListFunctionKind.FOLD:
+            assert outer.accumulator_parameter is not None
+            fold = (self.fuse(outer_arguments[outer.function_parameter], definition_name, local_names),
+                    self.fuse(outer_arguments[outer.accumulator_parameter], definition_name, local_names))
+        stages = tuple(PipelineStage(PipelineStageKind(list_function.kind),
+                                     self.fuse(arguments[list_function.function_parameter], definition_name,
+                                               local_names))
+                       for _, list_function, arguments in chain if list_function.kind != ListFunctionKind.FOLD)
+        self.fusions.append(Fusion(definition_name, tuple(name for name, _, _ in chain)))
+        return FusedPipeline(self.fuse(current, definition_name, local_names), outer.cons, outer.head, outer.tail,
+                             stages, fold)
+
+    def fuse_children(self, exp: Expression, definition_name: str, local_names: FrozenSet[str]) -> Expression:
+        if isinstance(exp, Call):
+            return make_call(self.fuse(exp.operator, definition_name, local_names),
+                             [self.fuse(operand, definition_name, local_names) for operand in exp.operands])
+        return exp
+
+    def fuse_definition(self, name: str, d: Definition, local_names: FrozenSet[str]) -> Definition:
+        local_names = local_names | frozenset(d.sub_definitions)
+        if isinstance(d, CompoundFunction):
+            local_names = local_names | frozenset(d.parameters)
+        sub_definitions = {sub_name: self.fuse_definition(f"{name}.{sub_name}", sub_definition, local_names)
+                           for sub_name, sub_definition in d.sub_definitions.items()}
+        if isinstance(d, Constant):
+            return Constant(sub_definitions, self.fuse(d.expression, name, local_names), d.type_sig)
+        if isinstance(d, CompoundFunction):
+            return CompoundFunction(sub_definitions, d.type_sig, d.parameters, self.fuse(d.body, name, local_names),
+                                    d.tail_recursive)
+        return d
+
+
+# Runs on type-checked definitions. Recognizes map-, filter- and foldr-shaped functions (and one-parameter wrappers
+# such as `sum xs = foldr plus 0 xs`) by the shape of their bodies and fuses nested calls of them into one traversal.
+# Shadowed names are treated like local ones everywhere, so calls of them are never fused.
+def fuse_pipelines(definitions: Dict[str, Definition], shadowed: FrozenSet[str] = frozenset()) \
+        -> Tuple[Dict[str, Definition], List[Fusion]]:
+    fuser = PipelineFuser(definitions, shadowed)
+    fused = {name: fuser.fuse_definition(name, d, shadowed) for name, d in definitions.items()}
+    return fused, fuser.fusions
@@ -0,0 +1,105 @@
+import random
+from dataclasses import dataclass
+from typing import List
+
+
+@dataclass(frozen=True)
+class GeneratorSettings:
+    definitions: int = 20
+    # Levels of sub-definitions nested in each function.
+    sub_definition_depth: int = 1
+    expression_depth: int = 3
+    # Operands in ubiquefix chains like `x plus 1 plus y`.
+    chain_length: int = 3
+    structs: int = 2
+    # How deep main recurses into a recursive function.
+    recursion_depth: int = 10
+
+
+# Only every LEAF_INTERVAL-th function is a leaf, which calls no generated functions. The others only call leaves,
+# so evaluating a function takes time independent of the size of the program.
+LEAF_INTERVAL = 4
+OPERATORS = ["plus", "minus", "multiply"]
+
+
+class ProgramGenerator:
+    def __init__(self, settings: GeneratorSettings, seed: int) -> None:
+        self.settings = settings
+        self.random = random.Random(seed)
+
+    def atom(self, names: List[str]) -> str:
+        if len(names) > 0 and self.random.random() < 0.6:
+            return self.random.choice(names)
+        return str(self.random.randrange(10))
+
+    def operand(self, depth: int, names: List[str], callees: List[str]) -> str:
+        exp = self.expression(depth, names, callees)
+        return exp if " " not in exp else f"({exp})"
+
+    def expression(self, depth: int, names: List[str], callees: List[str]) -> str:
+        if depth == 0:
+            return self.atom(names)
+        kinds = ["arithmetic", "condition", "chain"]
+        if len(callees) > 0:
+            kinds.append("call")
+        if self.settings.structs > 0:
+            kinds.append("struct")
+        kind = self.random.choice(kinds)
+        if kind == "arithmetic":
+            return f"{self.random.choice(OPERATORS)} {self.operand(depth - 1, names, callees)} " \
+                   f"{self.operand(depth - 1, names, callees)}"
+        if kind == "condition":
+            return f"ifElse (less {self.operand(depth - 1, names, callees)} {self.atom(names)}) " \
+                   f"{self.operand(depth - 1, names, callees)} {self.operand(depth - 1, names, callees)}"
+        if kind == "call":
+            return f"{self.random.choice(callees)} {self.operand(depth - 1, names, callees)}"
+        if kind == "struct":
+            struct = f"S{self.random.randrange(self.settings.structs)}"
+            return f"field ({struct} {self.operand(depth - 1, names, callees)} {self.atom(names)})"
+        return " plus ".join(self.atom(names) for _ in range(max(self.settings.chain_length, 1)))
+
+    # Each level of sub-definitions is called from the body of its parent.
+    def function(self, name: str, parameter: str, names: List[str], callees: List[str], level: int) -> List[str]:
+        names = names + [parameter]
+        body = self.expression(self.settings.expression_depth, names, callees)
+        indentation = "    " * level
+        if level == self.settings.sub_definition_depth:
+            return [f"{indentation}{name}:Integer {parameter}:Integer = {body}"]
+        sub_name = f"g{level}"
+        return [f"{indentation}{name}:Integer {parameter}:Integer = plus ({sub_name} {self.atom(names)}) ({body})",
+                *self.function(sub_name, f"y{level}", names, callees, level + 1)]
+
+    def program(self) -> List[str]:
+        lines: List[str] = []
+        structs = [f"S{i}" for i in range(self.settings.structs)]
+        for struct in structs:
+            lines.append(f"{struct} := struct a:Integer b:Integer")
+        if len(structs) > 0:
+            lines.append(f"AnyStruct := union {' | '.join(structs)}")
+            cases = " ".join(f"| {struct} s -> {struct}.{'ab'[i % 2]} s" for i, struct in enumerate(structs))
+            lines.append(f"field:Integer v:AnyStruct = match v {cases}")
+        lines.append("recurse:Integer n:Integer = ifElse (less n 1) 0 (plus 1 (recurse (minus n 1)))")
+        leaves: List[str] = []
+        calls: List[str] = []
+        for i in range(self.settings.definitions):
+            name = f"f{i}"
+            lines.extend(self.function(name, "x", [], [] if i % LEAF_INTERVAL == 0 else leaves, 0))
+            if i % LEAF_INTERVAL == 0:
+                leaves.append(name)
+            calls.append(f"{name} {self.random.randrange(10)}")
+        calls.append(f"recurse {self.settings.recursion_depth}")
+        lines.append(f"main:Integer = {balanced_sum(calls)}")
+        return lines
+
+
+# Keeps the nesting of main logarithmic in the number of summands.
+def balanced_sum(summands: List[str]) -> str:
+    if len(summands) == 1:
+        return summands[0]
+    middle = len(summands) // 2
+    return f"plus ({balanced_sum(summands[:middle])}) ({balanced_sum(summands[middle:])})"
+
+
+# Generates a valid program, which defines main. The same seed and settings always give the same program.
+def generate_program(settings: GeneratorSettings, seed: int = 0) -> str:
+    return "\n".join(ProgramGenerator(settings, seed).program()) + "\n"
@@ -0,0 +1,163 @@
+from __future__ import annotations
+
+import zlib
+from dataclasses import dataclass
+from typing import Tuple, Union, Optional, Iterator, Any
+
+BITS_PER_LEVEL = 5
+HASH_BITS = 32
+
+
+@dataclass(frozen=True)
+class TrieLeaf:
+    hash: int
+    key: str
+    value: Any
+
+
+# Children are stored densely. Bit i of the bitmap tells if there is a child for the hash chunk i,
+# and the number of lower set bits is its position in the children.
+@dataclass(frozen=True)
+class BitmapNode:
+    bitmap: int
+    children: Tuple[TrieNode, ...]
+
+
+# Keys whose hashes are equal in all bits.
+@dataclass(frozen=True)
+class CollisionNode:
+    hash: int
+    leaves: Tuple[TrieLeaf, ...]
+
+
+TrieNode = Union[TrieLeaf, BitmapNode, CollisionNode]
+
+EMPTY_NODE = BitmapNode(0, ())
+
+
+# Python's string hashes are randomized per process, which would make the iteration order differ between runs.
+def key_hash(key: str) -> int:
+    return zlib.crc32(key.encode())
+
+
+def chunk(key_hash_value: int, shift: int) -> int:
+    return (key_hash_value >> shift) & ((1 << BITS_PER_LEVEL) - 1)
+
+
+def position(bitmap: int, bit: int) -> int:
+    return (bitmap & (bit - 1)).bit_count()
+
+
+def merge_leaves(a: TrieLeaf, b: TrieLeaf, shift: int) -> TrieNode:
+    if a.hash == b.hash or shift >= HASH_BITS:
+        return CollisionNode(a.hash, (a, b))
+    a_chunk = chunk(a.hash, shift)
+    b_chunk = chunk(b.hash, shift)
+    if a_chunk == b_chunk:
+        return BitmapNode(1 << a_chunk, (merge_leaves(a, b, shift + BITS_PER_LEVEL),))
+    return BitmapNode((1 << a_chunk) | (1 << b_chunk), (a, b) if a_chunk < b_chunk else (b, a))
+
+
+def node_hash(node: TrieNode) -> int:
+    assert isinstance(node, (TrieLeaf, CollisionNode))
+    return node.hash
+
+
+# Returns the new node and whether the key was not present before. Untouched children are shared.
+def insert(node: TrieNode, leaf: TrieLeaf, shift: int) -> Tuple[TrieNode, bool]:
+    if isinstance(node, TrieLeaf):
+        if node.key == leaf.key:
+            return leaf, False
+        return merge_leaves(node, leaf, shift), True
+    if isinstance(node, CollisionNode):
+        if node.hash != leaf.hash:
+            wrapper = BitmapNode(1 << chunk(node.hash, shift), (node,))
+            return insert(wrapper, leaf, shift)
+        others = tuple(existing for existing in node.leaves if existing.key != leaf.key)
+        return CollisionNode(node.hash, others + (leaf,)), len(others) == len(node.leaves)
+    bit = 1 << chunk(leaf.hash, shift)
+    i = position(node.bitmap, bit)
+    if node.bitmap & bit == 0:
+        return BitmapNode(node.bitmap | bit, node.children[:i] + (leaf,) + node.children[i:]), True
+    child, added = insert(node.children[i], leaf, shift + BITS_PER_LEVEL)
+    return BitmapNode(node.bitmap, node.children[:i] + (child,) + node.children[i + 1:]), added
+
+
+# Returns None if the key is not present. Nodes left with a single leaf collapse into it,
+# so the shape of a trie only depends on its keys.
+def remove(node: TrieNode, key: str, hash_value: int, shift: int) -> Optional[TrieNode]:
+    if isinstance(node, TrieLeaf):
+        return EMPTY_NODE if node.key == key else None
+    if isinstance(node, CollisionNode):
+        others = tuple(leaf for leaf in node.leaves if leaf.key != key)
+        if len(others) == len(node.leaves):
+            return None
+        return others[0] if len(others) == 1 else CollisionNode(node.hash, others)
+    bit = 1 << chunk(hash_value, shift)
+    if node.bitmap & bit == 0:
+        return None
+    i = position(node.bitmap, bit)
+    child = remove(node.children[i], key, hash_value, shift + BITS_PER_LEVEL)
+    if child is None:
+        return None
+    if child is EMPTY_NODE:
+        children = node.children[:i] + node.children[i + 1:]
+        if len(children) == 1 and isinstance(children[0], (TrieLeaf, CollisionNode)) and shift > 0:
+            return children[0]
+        return BitmapNode(node.bitmap & ~bit, children)
+    if len(node.children) == 1 and isinstance(child, (TrieLeaf, CollisionNode)) and shift > 0:
+        return child
+    return BitmapNode(node.bitmap, node.children[:i] + (child,) + node.children[i + 1:])
+
+
+def lookup(node: TrieNode, key: str, hash_value: int) -> Optional[TrieLeaf]:
+    shift = 0
+    while True:
+        if isinstance(node, TrieLeaf):
+            return node if node.key == key else None
+        if isinstance(node, CollisionNode):
+            return next((leaf for leaf in node.leaves if leaf.key == key), None)
+        bit = 1 << chunk(hash_value, shift)
+        if node.bitmap & bit == 0:
+            return None
+        node = node.children[position(node.bitmap, bit)]
+        shift += BITS_PER_LEVEL
+
+
+def leaves(node: TrieNode) -> Iterator[TrieLeaf]:
+    if isinstance(node, TrieLeaf):
+        yield node
+    elif isinstance(node, CollisionNode):
+        yield from node.leaves
+    else:
+        for child in node.children:
+            yield from leaves(child)
+
+
+# An immutable map from strings, implemented as a hash array mapped trie. Updates copy only the path to the
+# changed entry, i.e. O(log n) nodes of at most 32 children, and share everything else with the previous version.
+@dataclass(frozen=True)
+class HashTrie:
+    root: TrieNode = EMPTY_NODE
+    size: int = 0
+
+    def insert(self, key: str, value: Any) -> HashTrie:
+        root, added = insert(self.root, TrieLeaf(key_hash(key), key, value), 0)
+        return HashTrie(root, self.size + 1 if added else self.size)
+
+    def remove(self, key: str) -> HashTrie:
+        root = remove(self.root, key, key_hash(key), 0)
+        if root is None:
+            return self
+        return HashTrie(EMPTY_NODE if root is EMPTY_NODE else root, self.size - 1)
+
+    def lookup(self, key: str) -> Optional[TrieLeaf]:
+        return lookup(self.root, key, key_hash(key))
+
+    # In the order of the key hashes, which is the same in every run.
+    def items(self) -> Iterator[Tuple[str, Any]]:
+        for leaf in leaves(self.root):
+            yield leaf.key, leaf.value
+
+    def __len__(self) -> int:
+        return self.size
@@ -0,0 +1,183 @@
+from dataclasses import dataclass
+from enum import auto, StrEnum
+from typing import Dict, List, Set, Tuple, Union, Optional, FrozenSet
+
+from .common_subexpressions import analyze_effects, is_pure
+from .expressions import Expression, Call, Variable, PrimitiveExpression, Definition, CompoundFunction, Constant, \
+    PrimitiveFunction
+from .parsing import make_call
+from .traversing import sub_expressions, callable_parameters
+from .tree_shaking import definition_references
+
+DEFAULT_INLINING_THRESHOLD = 12
+
+
+class InliningOutcome(StrEnum):
+    INLINED = auto()
+    RECURSIVE = auto()
+    TOO_LARGE = auto()
+    HAS_SUB_DEFINITIONS = auto()
+    UNSUPPORTED_BODY = auto()
+    UNSAFE_ARGUMENT = auto()
+
+
+@dataclass(frozen=True)
+class InliningDecision:
+    caller: str
+    callee: str
+    outcome: InliningOutcome
+
+
+def expression_size(exp: Expression) -> int:
+    return sum(1 for _ in sub_expressions(exp))
+
+
+# Conservative, since a referenced name might actually resolve to a local definition.
+def is_recursive(references: Dict[str, Set[str]], name: str, d: Definition) -> bool:
+    reachable: Set[str] = set()
+    pending = list(definition_references(d))
+    while len(pending) > 0:
+        current = pending.pop()
+        if current not in reachable:
+            reachable.add(current)
+            pending.extend(references.get(current, set()))
+    return name in reachable
+
+
+# Returns, for each occurrence of the variable, whether it is evaluated whenever the expression is,
+# i.e. whether it is not inside an ifElse branch.
+def occurrences(exp: Expression, name: str, strict: bool = True) -> List[bool]:
+    if exp == Variable(name):
+        return [strict]
+    if not isinstance(exp, Call):
+        return []
+    if isinstance(exp.operator, Variable) and exp.operator.name == "ifElse":
+        return occurrences(exp.operands[0], name, strict) + \
+            [flag for operand in exp.operands[1:] for flag in occurrences(operand, name, False)]
+    return occurrences(exp.operator, name, strict) + \
+        [flag for operand in exp.operands for flag in occurrences(operand, name, strict)]
+
+
+def substitute_parameters(exp: Expression, arguments: Dict[str, Expression]) -> Expression:
+    if isinstance(exp, Variable):
+        return arguments.get(exp.name, exp)
+    if isinstance(exp, Call):
+        return make_call(substitute_parameters(exp.operator, arguments),
+                         [substitute_parameters(operand, arguments) for operand in exp.operands])
+    return exp
+
+
+# Local scopes map sub-definitions to their definitions and parameters to None.
+Scope = Dict[str, Optional[Definition]]
+
+
+class Inliner:
+    def __init__(self, definitions: Dict[str, Definition], size_threshold: int, shadowed: FrozenSet[str]) -> None:
+        self.definitions = definitions
+        self.size_threshold = size_threshold
+        self.shadowed = shadowed
+        self.references = {name: definition_references(d) & definitions.keys() for name, d in definitions.items()}
+        self.effects = analyze_effects(definitions, shadowed)
+        self.decisions: List[InliningDecision] = []
+        self.optimized: Dict[int, Definition] = {}
+
+    def optimize_global(self, name: str) -> Definition:
+        d = self.definitions[name]
+        if id(d) not in self.optimized:
+            self.optimize_definition(name, d, {}, frozenset())
+        return self.optimized[id(d)]
+
+    # `parameters` are the callable parameters in scope, see analyze_effects.
+    def optimize_definition(self, name: str, d: Definition, scope: Scope, parameters: FrozenSet[str]) -> Definition:
+        scope = {**scope, **d.sub_definitions}
+        if isinstance(d, CompoundFunction):
+            scope = scope | dict.fromkeys(d.parameters)
+            parameters = parameters | callable_parameters(d)
+        sub_definitions = {sub_name: self.optimize_definition(f"{name}.{sub_name}", sub_definition, scope, parameters)
+                           for sub_name, sub_definition in d.sub_definitions.items()}
+        optimized = d
+        if isinstance(d, Constant):
+            optimized = Constant(sub_definitions, self.optimize(d.expression, name, scope, parameters), d.type_sig)
+        if isinstance(d, CompoundFunction):
+            optimized = CompoundFunction(sub_definitions, d.type_sig, d.parameters,
+                                         self.optimize(d.body, name, scope, parameters), d.tail_recursive)
+        self.optimized[id(d)] = optimized
+        return optimized
+
+    def resolve(self, name: str, scope: Scope) -> Optional[Definition]:
+        if name in self.shadowed:
+            return None
+        return scope[name] if name in scope else self.definitions.get(name)
+
+    def optimize(self, exp: Expression, caller: str, scope: Scope, parameters: FrozenSet[str]) -> Expression:
+        if not isinstance(exp, Call):
+            return exp
+        operator = self.optimize(exp.operator, caller, scope, parameters)
+        operands = [self.optimize(operand, caller, scope, parameters) for operand in exp.operands]
+        # Beta-reduces an immediately applied partial application: (f a) b -> f a b
+        if isinstance(operator, Call) and isinstance(operator.operator, Variable):
+            applied = self.resolve(operator.operator.name, scope)
+            if isinstance(applied, (CompoundFunction, PrimitiveFunction)) and \
+                    len(operator.operands) + len(operands) == len(applied.parameters):
+                operands = list(operator.operands) + operands
+                operator = operator.operator
+        call = make_call(operator, operands)
+        assert isinstance(call, Call)
+        if not isinstance(operator, Variable):
+            return call
+        callee = self.resolve(operator.name, scope)
+        if not isinstance(callee, CompoundFunction) or len(operands) != len(callee.parameters):
+            return call
+        inlined = self.inline(call, operator.name, callee, scope, parameters)
+        if isinstance(inlined, InliningOutcome):
+            self.decisions.append(InliningDecision(caller, operator.name, inlined))
+            return call
+        self.decisions.append(InliningDecision(caller, operator.name, InliningOutcome.INLINED))
+        return inlined
+
+    def inline(self, call: Call, name: str, callee: CompoundFunction, scope: Scope,
+               parameters: FrozenSet[str]) -> Union[Expression, InliningOutcome]:
+        if is_recursive(self.references, name, callee):
+            return InliningOutcome.RECURSIVE
+        if len(callee.sub_definitions) > 0:
+            return InliningOutcome.HAS_SUB_DEFINITIONS
+        if expression_size(callee.body) > self.size_threshold:
+            return InliningOutcome.TOO_LARGE
+        # The parameters are the only binders, so substituting them cannot capture any names.
+        if not all(isinstance(node, (Call, Variable, PrimitiveExpression)) for node in sub_expressions(callee.body)):
+            return InliningOutcome.UNSUPPORTED_BODY
+        # Local callees that are not optimized yet (e.g. later siblings) are inlined as written.
+        if callee is self.definitions.get(name):
+            self.optimize_global(name)
+        optimized = self.optimized.get(id(callee), callee)
+        assert isinstance(optimized, CompoundFunction)
+        for parameter, argument in zip(callee.parameters, call.operands):
+            if not self.is_safe_argument(argument, occurrences(optimized.body, parameter), scope, parameters):
+                return InliningOutcome.UNSAFE_ARGUMENT
+        return substitute_parameters(optimized.body, dict(zip(callee.parameters, call.operands)))
+
+    # Call-by-value evaluates each argument exactly once before the body, so an argument may only be substituted
+    # if evaluating it any number of times is unobservable and cheap, or if the body evaluates it exactly once.
+    def is_safe_argument(self, argument: Expression, uses: List[bool], scope: Scope,
+                         parameters: FrozenSet[str]) -> bool:
+        if isinstance(argument, PrimitiveExpression) or self.is_function_or_parameter(argument, scope):
+            return True
+        return uses == [True] and is_pure(argument, self.effects, parameters)
+
+    # Constants are evaluated on every reference, so they do not count as cheap.
+    def is_function_or_parameter(self, argument: Expression, scope: Scope) -> bool:
+        if not isinstance(argument, Variable):
+            return False
+        if argument.name in scope and scope[argument.name] is None:
+            return True
+        return argument.name not in self.effects.impure and argument.name not in self.effects.parametric and \
+            isinstance(self.resolve(argument.name, scope), (CompoundFunction, PrimitiveFunction))
+
+
+# Runs on type-checked definitions. Inlines calls of small non-recursive compound functions and flattens
+# immediately applied partial applications. Returns the new definitions and one decision per considered call.
+# Shadowed names are never resolved, so calls of them are left as they are.
+def inline_functions(definitions: Dict[str, Definition], size_threshold: int = DEFAULT_INLINING_THRESHOLD,
+                     shadowed: FrozenSet[str] = frozenset()) -> Tuple[Dict[str, Definition], List[InliningDecision]]:
+    inliner = Inliner(definitions, size_threshold, shadowed)
+    return {name: inliner.optimize_global(name) for name in definitions}, inliner.decisions
@@ -1,9 +1,57 @@
+import threading
+from contextlib import contextmanager
+from dataclasses import replace, dataclass
 from functools import partial
-from typing import Dict, List
+from itertools import chain
+from types import MappingProxyType
+from typing import Dict, List, Optional, Callable, Iterator, cast, Tuple, Union, Set, Mapping, FrozenSet
 
-from .built_ins import default_environment
+from .built_ins import default_environment, RuntimeMode, UNCHECKED_IMPLEMENTATIONS as UNCHECKED_BUILT_INS, \
+    PRELUDE
+from .capturing import closure_captures
 from .expressions import PrimitiveClosure, Expression, Call, PrimitiveExpression, Variable, CompoundClosure, \
-    CompoundFunction, PrimitiveFunction, Constant, Definition, ConstantClosure
+    CompoundFunction, PrimitiveFunction, Constant, Definition, ConstantClosure, Let, Thunk, FusedPipeline, \
+    PipelineStageKind, TailLoop, PartialApplication, Match, value_tag, share_arrays, CallSite, MatchCase
+from .parsing import get_struct_field, get_struct_field_unchecked
+from .traversing import flatten_definitions, definition_expressions
+from .tree_shaking import shake_tree
+
+
+class EvaluationContext(threading.local):
+    def __init__(self) -> None:
+        self.step_hook: Optional[Callable[[], None]] = None
+        self.checked = True
+        self.inline_caching = True
+
+
+_context = EvaluationContext()
+
+
+def set_step_hook(step_hook: Optional[Callable[[], None]]) -> None:
+    _context.step_hook = step_hook
+
+
+@contextmanager
+def runtime_mode(mode: RuntimeMode) -> Iterator[None]:
+    previous = _context.checked
+    _context.checked = mode == RuntimeMode.DEBUG
+    try:
+        yield
+    finally:
+        _context.checked = previous
+
+
+@contextmanager
+def inline_caching(enabled: bool) -> Iterator[None]:
+    previous = _context.inline_caching
+    _context.inline_caching = enabled
+    try:
+        yield
+    finally:
+        _context.inline_caching = previous
+
+
+UNCHECKED_IMPLEMENTATIONS = UNCHECKED_BUILT_INS | {get_struct_field: get_struct_field_unchecked}
 
 
 def raise_type_error(expected: str, given: str) -> None:
@@ -16,7 +64,29 @@ def extend_env(environment: Dict[str, Expression],
     return environment | dict(zip(parameters, args))
 
 
+def capture(environment: Dict[str, Expression], closure: CompoundClosure) -> Dict[str, Expression]:
+    if closure.captures is None:
+        return environment | closure.environment
+    captured = {name: environment[name] for name in closure.captures if name in environment}
+    captured.update(closure.environment)
+    return captured
+
+
 def apply(closure: Expression, arguments: List[Expression]) -> Expression:
+    if isinstance(closure, PartialApplication):
+        callee = closure.callee
+        # Collected arguments are evaluated already, so saturated built-ins can be called right away.
+        if isinstance(callee, PrimitiveClosure) and len(closure.arguments) + len(arguments) == len(callee.parameters) \
+                and all(isinstance(argument, PrimitiveExpression) for argument in chain(closure.arguments, arguments)):
+            return callee.impl(*closure.arguments, *arguments)
+        return apply(callee, [*closure.arguments, *arguments])
+    if isinstance(closure, (PrimitiveClosure, CompoundClosure)) and len(arguments) != len(closure.parameters):
+        arity = len(closure.parameters)
+        if len(arguments) < arity:
+            # Every application of the partial application passes on the same arguments.
+            share_arrays(arguments)
+            return PartialApplication(closure, tuple(arguments))
+        return apply(apply(closure, arguments[:arity]), arguments[arity:])
     if isinstance(closure, PrimitiveClosure):
         return closure.impl(*list(map(partial(evaluate, closure.environment), arguments)))
     if isinstance(closure, CompoundClosure):
@@ -26,26 +96,92 @@ def apply(closure: Expression, arguments: List[Expression]) -> Expression:
         raise RuntimeError(f"Unknown closure type to apply: {closure}")
 
 
+# Polymorphic call sites like `f` in foldr stay cached for up to this many different callees.
+MAX_INLINE_CACHE_TARGETS = 4
+
+
+# Calls the callee the operator of the site names, if it takes exactly the given arguments. A global site resolves
+# its callee once and skips the lookup afterwards. Otherwise hits and misses only differ in the statistics, both
+# skip evaluating the operator into a new closure.
+def call_cached(environment: Dict[str, Expression], site: CallSite) -> Optional[Expression]:
+    cache = site.inline_cache
+    callee = cache.callee
+    if callee is None:
+        if not isinstance(site.operator, Variable):
+            return None
+        callee = environment[site.operator.name]
+        if not isinstance(callee, (PrimitiveClosure, CompoundClosure)) or \
+                len(site.operands) != len(callee.parameters):
+            return None
+        code = callee.impl if isinstance(callee, PrimitiveClosure) else callee.body
+        for target in cache.targets:
+            if target is code:
+                cache.hits += 1
+                break
+        else:
+            cache.misses += 1
+            if len(cache.targets) < MAX_INLINE_CACHE_TARGETS:
+                cache.targets.append(code)
+            if site.global_operator:
+                cache.callee = callee
+    else:
+        cache.hits += 1
+    # Same semantics as evaluating the operator to a closure and applying it, without allocating the closure.
+    arguments = [evaluate(environment, operand) for operand in site.operands]
+    if isinstance(callee, PrimitiveClosure):
+        if all(isinstance(argument, PrimitiveExpression) for argument in arguments):
+            return callee.impl(*arguments)
+        return callee.impl(*[evaluate(callee.environment, argument) for argument in arguments])
+    assert isinstance(callee, CompoundClosure)
+    extended_env = capture(environment, callee)
+    extended_env.update(zip(callee.parameters, arguments))
+    return evaluate(extended_env, callee.body)
+
+
 def evaluate(environment: Dict[str, Expression], exp: Expression) -> Expression:
+    step_hook = _context.step_hook
+    if step_hook is not None:
+        step_hook()
     if isinstance(exp, PrimitiveExpression):
         return exp
-    if isinstance(exp, PrimitiveClosure):
-        return PrimitiveClosure(exp.parameters, environment | exp.environment, exp.impl)
+    # Implementations do not reference any names, so there is nothing to capture.
+    if isinstance(exp, (PrimitiveClosure, PartialApplication)):
+        return exp
     if isinstance(exp, CompoundClosure):
-        return CompoundClosure(exp.parameters, environment | exp.environment, exp.body)
+        return CompoundClosure(exp.parameters, capture(environment, exp), exp.body, exp.captures)
     if isinstance(exp, Variable):
         return evaluate(environment, environment[exp.name])
     if isinstance(exp, ConstantClosure):
         return evaluate(environment | exp.environment, exp.body)
+    if isinstance(exp, Thunk):
+        if len(exp.value) == 0:
+            exp.value.append(evaluate(exp.environment, exp.expression))
+        return exp.value[0]
+    if isinstance(exp, Let):
+        return evaluate(let_environment(environment, exp), exp.body)
+    if isinstance(exp, FusedPipeline):
+        return evaluate_pipeline(environment, exp)
+    if isinstance(exp, TailLoop):
+        return evaluate_tail_loop(environment, exp)
+    if isinstance(exp, Match):
+        case_environment, body = match_case(environment, exp)
+        return evaluate(case_environment, body)
     if isinstance(exp, CompoundFunction):
         return CompoundClosure(exp.parameters, environment, exp.body)
     if isinstance(exp, PrimitiveFunction):
         return PrimitiveClosure(exp.parameters, environment, exp.impl)
     if isinstance(exp, Call):
         if isinstance(exp.operator, Variable) and exp.operator.name == "ifElse":
-            cond = evaluate(environment, exp.operands[0])
-            assert len(exp.operands) == 3 and isinstance(cond, PrimitiveExpression) and isinstance(cond.value, bool)
+            cond = cast(PrimitiveExpression, evaluate(environment, exp.operands[0]))
+            if _context.checked:
+                assert len(exp.operands) == 3 and isinstance(cond, PrimitiveExpression) and isinstance(cond.value, bool)
             return evaluate(environment, exp.operands[1]) if cond.value else evaluate(environment, exp.operands[2])
+        if isinstance(exp, CallSite) and _context.inline_caching:
+            result = call_cached(environment, exp)
+            if result is not None:
+                return result
+        if isinstance(exp.operator, Call):
+            return apply_nested(environment, exp)
         evaluated_operator = evaluate(environment, exp.operator)
         evaluated_operands = list(map(partial(evaluate, environment), exp.operands))
         return apply(evaluated_operator, evaluated_operands)
@@ -53,24 +189,248 @@ def evaluate(environment: Dict[str, Expression], exp: Expression) -> Expression:
         raise RuntimeError(f"Unknown expression type to evaluate: {exp}")
 
 
-def strip_definition_type(d: Definition) -> Expression:
+# Calls like `(f a) b` pass all arguments at once, so no partial application is built in between if that saturates f.
+def apply_nested(environment: Dict[str, Expression], call: Call) -> Expression:
+    calls = [call]
+    operator = call.operator
+    while isinstance(operator, Call) and not (isinstance(operator.operator, Variable) and
+                                              operator.operator.name == "ifElse"):
+        calls.append(operator)
+        operator = operator.operator
+    evaluated_operator = evaluate(environment, operator)
+    return apply(evaluated_operator, [evaluate(environment, operand)
+                                      for nested in reversed(calls) for operand in nested.operands])
+
+
+def let_environment(environment: Dict[str, Expression], let: Let) -> Dict[str, Expression]:
+    extended: Dict[str, Expression] = {}
+    extended.update(environment)
+    extended.update((name, Thunk(bound, extended, [])) for name, bound in let.bindings)
+    return extended
+
+
+# Returns the environment and body of the case matching the value.
+def match_case(environment: Dict[str, Expression], match: Match) -> Tuple[Dict[str, Expression], Expression]:
+    value = cast(PrimitiveExpression, evaluate(environment, match.scrutinee))
+    if _context.checked:
+        assert isinstance(value, PrimitiveExpression)
+        if value_tag(value) not in match.jump_table:
+            raise RuntimeError(f"No case matches {value}")
+    case = match.jump_table[value_tag(value)]
+    if case.name is None:
+        return environment, case.body
+    return environment | {case.name: value}, case.body
+
+
+# Follows the tail positions of the body. A call of the function itself there rebinds the parameters in the
+# environment of this activation and starts over, so the iterations need neither stack nor new environments.
+def evaluate_tail_loop(environment: Dict[str, Expression], loop: TailLoop) -> Expression:
+    # Closures created in the loop copy what they capture, so only this copy is ever updated.
+    loop_environment = dict(environment)
+    while True:
+        current_environment = loop_environment
+        exp = loop.body
+        while True:
+            if isinstance(exp, Let):
+                current_environment = let_environment(current_environment, exp)
+                exp = exp.body
+            elif isinstance(exp, Call) and isinstance(exp.operator, Variable) and exp.operator.name == "ifElse":
+                cond = cast(PrimitiveExpression, evaluate(current_environment, exp.operands[0]))
+                if _context.checked:
+                    assert isinstance(cond, PrimitiveExpression) and isinstance(cond.value, bool)
+                exp = exp.operands[1] if cond.value else exp.operands[2]
+            elif isinstance(exp, Match):
+                current_environment, exp = match_case(current_environment, exp)
+            elif isinstance(exp, Call) and isinstance(exp.operator, Variable) and exp.operator.name == loop.name:
+                arguments = [evaluate(current_environment, operand) for operand in exp.operands]
+                loop_environment.update(zip(loop.parameters, arguments))
+                break
+            else:
+                return evaluate(current_environment, exp)
+
+
+def pipeline_elements(environment: Dict[str, Expression], pipeline: FusedPipeline) -> Iterator[Expression]:
+    head = evaluate(environment, Variable(pipeline.head))
+    tail = evaluate(environment, Variable(pipeline.tail))
+    stages: List[Tuple[PipelineStageKind, Expression]] = [(stage.kind, evaluate(environment, stage.function))
+                                                          for stage in pipeline.stages]
+    node = evaluate(environment, pipeline.source)
+    while not (isinstance(node, PrimitiveExpression) and node.value is None):
+        value = apply(head, [node])
+        for kind, function in stages:
+            if kind == PipelineStageKind.MAP:
+                value = apply(function, [value])
+            elif not cast(PrimitiveExpression, apply(function, [value])).value:
+                break
+        else:
+            yield value
+        node = apply(tail, [node])
+
+
+# Right folds and rebuilt lists consume the elements from the end, so their values are buffered in a Python list,
+# but no intermediate cons lists are built.
+def evaluate_pipeline(environment: Dict[str, Expression], pipeline: FusedPipeline) -> Expression:
+    values = list(pipeline_elements(environment, pipeline))
+    if pipeline.fold is None:
+        function = evaluate(environment, Variable(pipeline.cons))
+        result: Expression = PrimitiveExpression(None)
+    else:
+        function = evaluate(environment, pipeline.fold[0])
+        result = evaluate(environment, pipeline.fold[1])
+    for value in reversed(values):
+        result = apply(function, [value, result])
+    return result
+
+
+def pipeline_expressions(pipeline: FusedPipeline) -> List[Expression]:
+    return [pipeline.source, *(stage.function for stage in pipeline.stages), *(pipeline.fold or ())]
+
+
+# Names bound by matches and lets in the expression, which can shadow global definitions like parameters do.
+def bound_names(exp: Expression) -> Set[str]:
+    if isinstance(exp, Call):
+        return bound_names(exp.operator).union(*map(bound_names, exp.operands))
+    if isinstance(exp, Match):
+        return bound_names(exp.scrutinee).union(*(bound_names(case.body) | ({case.name} if case.name else set())
+                                                  for case in exp.cases))
+    if isinstance(exp, Let):
+        return bound_names(exp.body).union(*(bound_names(bound) | {name} for name, bound in exp.bindings))
+    if isinstance(exp, FusedPipeline):
+        return set().union(*map(bound_names, pipeline_expressions(exp)))
+    return set()
+
+
+# Built-ins get their arguments passed directly, so their parameters are never bound in an environment.
+def local_names(definitions: Dict[str, Definition]) -> FrozenSet[str]:
+    names: Set[str] = set()
+    for _, d, _ in flatten_definitions(definitions, frozenset()):
+        names.update(d.sub_definitions)
+        if isinstance(d, CompoundFunction):
+            names.update(d.parameters)
+        for exp in definition_expressions(d):
+            names |= bound_names(exp)
+    return frozenset(names)
+
+
+# Copies the calls of a body into call sites of their own, see CallSite.
+def call_sites(exp: Expression, local: FrozenSet[str]) -> Expression:
+    if isinstance(exp, Call):
+        return CallSite(call_sites(exp.operator, local), [call_sites(operand, local) for operand in exp.operands],
+                        isinstance(exp.operator, Variable) and exp.operator.name not in local)
+    if isinstance(exp, Match):
+        return Match(call_sites(exp.scrutinee, local),
+                     tuple(MatchCase(case.type_sig, case.name, call_sites(case.body, local)) for case in exp.cases))
+    if isinstance(exp, Let):
+        return Let(tuple((name, call_sites(bound, local)) for name, bound in exp.bindings), call_sites(exp.body, local))
+    if isinstance(exp, FusedPipeline):
+        return replace(exp, source=call_sites(exp.source, local),
+                       stages=tuple(replace(stage, function=call_sites(stage.function, local)) for stage in exp.stages),
+                       fold=None if exp.fold is None else (call_sites(exp.fold[0], local),
+                                                           call_sites(exp.fold[1], local)))
+    return exp
+
+
+def strip_definition_type(name: str, d: Definition,
+                          captures: Optional[Mapping[int, Tuple[str, ...]]] = None,
+                          local: Optional[FrozenSet[str]] = None) -> Expression:
+    sub_definitions = {k: strip_definition_type(k, v, captures, local) for k, v in d.sub_definitions.items()}
     if isinstance(d, Constant):
-        return ConstantClosure({k: strip_definition_type(v) for k, v in d.sub_definitions.items()}, d.expression)
+        return ConstantClosure(sub_definitions, d.expression if local is None else call_sites(d.expression, local))
     if isinstance(d, CompoundFunction):
-        return CompoundClosure(d.parameters, {k: strip_definition_type(v) for k, v in d.sub_definitions.items()},
-                               d.body)
+        body = d.body if local is None else call_sites(d.body, local)
+        body = TailLoop(name, d.parameters, body) if d.tail_recursive else body
+        return CompoundClosure(d.parameters, sub_definitions, body, None if captures is None else captures[id(d)])
     if isinstance(d, PrimitiveFunction):
-        return PrimitiveClosure(d.parameters, {k: strip_definition_type(v) for k, v in d.sub_definitions.items()},
-                                d.impl)
+        return PrimitiveClosure(d.parameters, sub_definitions, d.impl)
     assert False
 
 
+def with_runtime_mode(definitions: Dict[str, Definition], mode: RuntimeMode) -> Dict[str, Definition]:
+    if mode == RuntimeMode.DEBUG:
+        return definitions
+
+    def select(d: Definition) -> Definition:
+        sub_definitions = {k: select(v) for k, v in d.sub_definitions.items()}
+        if isinstance(d, PrimitiveFunction):
+            return PrimitiveFunction(sub_definitions, d.type_sig, d.parameters, unchecked_implementation(d.impl))
+        return replace(d, sub_definitions=sub_definitions)
+
+    def unchecked_implementation(impl: Callable[..., PrimitiveExpression]) -> Callable[..., PrimitiveExpression]:
+        if isinstance(impl, partial):
+            return partial(unchecked_implementation(impl.func), *impl.args)
+        return UNCHECKED_IMPLEMENTATIONS.get(impl, impl)
+
+    return {name: select(d) for name, d in definitions.items()}
+
+
+PRELUDE_EXPRESSIONS: Mapping[str, Expression] = MappingProxyType(
+    dict(zip(PRELUDE, map(strip_definition_type, PRELUDE, PRELUDE.values()))))
+
+
+# Prepares the definitions of a program for evaluation. Every call in them becomes a call site with its own cache.
 def definitions_to_expressions(definitions: Dict[str, Definition]) -> Dict[str, Expression]:
-    return dict(zip(definitions, map(strip_definition_type, definitions.values())))
+    captures = closure_captures(definitions)
+    local = local_names(definitions)
+    return {name: PRELUDE_EXPRESSIONS[name] if PRELUDE.get(name) is d else
+            strip_definition_type(name, d, captures, local) for name, d in definitions.items()}
 
 
-def interpret(definitions: Dict[str, Definition]) -> None:
-    main = definitions["main"]
-    assert isinstance(main, Constant)
+@dataclass(frozen=True)
+class CallSiteStatistics:
+    definition: str
+    call: Call
+    hits: int
+    misses: int
+    targets: int
+    hit_rate: float
 
-    evaluate(definitions_to_expressions(default_environment()), main.expression)
+
+def closure_bodies(name: str, closure: Expression) -> Iterator[Tuple[str, Expression]]:
+    if isinstance(closure, (ConstantClosure, CompoundClosure)):
+        yield name, closure.body.body if isinstance(closure.body, TailLoop) else closure.body
+    if isinstance(closure, (ConstantClosure, CompoundClosure, PrimitiveClosure)):
+        for sub_name, sub_closure in closure.environment.items():
+            yield from closure_bodies(sub_name, sub_closure)
+
+
+def sites(exp: Expression) -> Iterator[CallSite]:
+    if isinstance(exp, CallSite):
+        yield exp
+    if isinstance(exp, Call):
+        yield from sites(exp.operator)
+        for operand in exp.operands:
+            yield from sites(operand)
+    if isinstance(exp, Match):
+        yield from sites(exp.scrutinee)
+        for case in exp.cases:
+            yield from sites(case.body)
+    if isinstance(exp, Let):
+        for _, bound in exp.bindings:
+            yield from sites(bound)
+        yield from sites(exp.body)
+    if isinstance(exp, FusedPipeline):
+        for child in pipeline_expressions(exp):
+            yield from sites(child)
+
+
+# Takes the environment of a prepared program, see definitions_to_expressions.
+def call_site_statistics(environment: Mapping[str, Expression]) -> List[CallSiteStatistics]:
+    statistics = []
+    for name, closure in environment.items():
+        for definition, body in closure_bodies(name, closure):
+            for site in sites(body):
+                cache = site.inline_cache
+                calls = cache.hits + cache.misses
+                statistics.append(CallSiteStatistics(definition, site, cache.hits, cache.misses, len(cache.targets),
+                                                     cache.hits / calls if calls > 0 else 0.0))
+    return statistics
+
+
+def evaluate_main(definitions: Dict[str, Definition]) -> Expression:
+    assert isinstance(definitions["main"], Constant)
+    reachable, _ = shake_tree(default_environment() | definitions)
+    return evaluate(definitions_to_expressions(reachable), Variable("main"))
+
+
+def interpret(definitions: Dict[str, Definition]) -> None:
+    evaluate_main(definitions)
@@ -47,6 +47,11 @@ class IntegerConstant(Token):
     value: int
 
 
+@dataclass(frozen=True)
+class FloatConstant(Token):
+    value: float
+
+
 @dataclass(frozen=True)
 class Assignment(Token):
     pass
@@ -88,17 +93,18 @@ class ColonEqual(Token):
 
 
 def lex(augmented_source_orig: str) -> List[Token]:
-    augmented_source: List[str] = [*augmented_source_orig]
+    # Reversed, so consuming a character pops from the end of the list, which takes constant time.
+    augmented_source: List[str] = [*reversed(augmented_source_orig)]
     tokens: List[Token] = []
 
     def done() -> bool:
         return len(augmented_source) == 0
 
     def current() -> str:
-        return augmented_source[0]
+        return augmented_source[-1]
 
     def progress() -> str:
-        return augmented_source.pop(0)
+        return augmented_source.pop()
 
     while not done():
         if current() == " ":
@@ -169,6 +175,13 @@ def lex(augmented_source_orig: str) -> List[Token]:
             while not done() and current().isnumeric():
                 acc = acc + current()
                 progress()
+            if len(augmented_source) > 1 and current() == "." and augmented_source[-2].isnumeric():
+                acc = acc + progress()
+                while not done() and current().isnumeric():
+                    acc = acc + current()
+                    progress()
+                tokens.append(FloatConstant(float(acc)))
+                continue
             tokens.append(IntegerConstant(int(acc)))
             continue
         if current() == "\"":
@@ -0,0 +1,274 @@
+import hashlib
+import json
+import pickle
+from collections import defaultdict
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass
+from enum import auto, StrEnum
+from functools import partial
+from pathlib import Path
+from typing import Dict, List, Tuple, Set, Optional, Sequence, Any, cast
+
+from .augmenting import augment
+from .built_ins import default_environment, RuntimeMode
+from .expressions import Definition, Constant, Expression, PrimitiveFunction
+from .lexing import lex, Semicolon
+from .parsing import parse, create_struct
+from .program import Program
+from .type_checking import check_types, TypeAliases, type_assert
+from .type_signatures import TypeSignature, TypeSignatureFunction, TypeSignaturePrimitive, BuiltInPrimitiveType, \
+    CustomPrimitiveType
+from .ubiquefix import transform_ubiquefix, definition_type
+
+MODULE_SUFFIX = ".behagolit"
+INTERFACE_SUFFIX = ".interface.json"
+IMPLEMENTATION_SUFFIX = ".implementation.pickle"
+
+
+class ModuleStatus(StrEnum):
+    COMPILED = auto()
+    UP_TO_DATE = auto()
+
+
+# Everything importers are checked against. The implementation is only needed to run a program.
+@dataclass(frozen=True)
+class Interface:
+    module: str
+    source_hash: str
+    # The types hashes of the imported interfaces this module was checked against.
+    dependencies: Dict[str, str]
+    exports: Dict[str, TypeSignature]
+    structs: Dict[str, List[Tuple[str, TypeSignature]]]
+    # Including the unions of imported modules, since exported signatures can use them.
+    unions: Dict[str, List[TypeSignature]]
+
+    # Changes to a module that keep this hash, e.g. in function bodies, do not require rebuilding its importers.
+    def types_hash(self) -> str:
+        return text_hash(json.dumps(encode_types(self), sort_keys=True))
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def encode_type(type_sig: TypeSignature) -> Any:
+    if isinstance(type_sig, TypeSignatureFunction):
+        return {"params": list(map(encode_type, type_sig.params)), "return_type": encode_type(type_sig.return_type)}
+    assert isinstance(type_sig, TypeSignaturePrimitive)
+    if isinstance(type_sig.name, BuiltInPrimitiveType):
+        return {"built_in": type_sig.name.value}
+    return {"custom": type_sig.name.name}
+
+
+def decode_type(data: Any) -> TypeSignature:
+    if "params" in data:
+        return TypeSignatureFunction(list(map(decode_type, data["params"])), decode_type(data["return_type"]))
+    if "built_in" in data:
+        return TypeSignaturePrimitive(BuiltInPrimitiveType(data["built_in"]))
+    return TypeSignaturePrimitive(CustomPrimitiveType(data["custom"]))
+
+
+def encode_types(interface: Interface) -> Any:
+    return {
+        "exports": {name: encode_type(type_sig) for name, type_sig in interface.exports.items()},
+        "structs": {name: [[field, encode_type(type_sig)] for field, type_sig in fields]
+                    for name, fields in interface.structs.items()},
+        # Sets of options have no order, so they are sorted to keep the hash stable.
+        "unions": {name: sorted(map(encode_type, options), key=json.dumps)
+                   for name, options in interface.unions.items()},
+    }
+
+
+def write_interface(path: Path, interface: Interface) -> None:
+    data = {"module": interface.module, "source_hash": interface.source_hash,
+            "dependencies": interface.dependencies} | encode_types(interface)
+    path.write_text(json.dumps(data, indent=2, sort_keys=True))
+
+
+def read_interface(path: Path) -> Interface:
+    data = json.loads(path.read_text())
+    return Interface(data["module"], data["source_hash"], data["dependencies"],
+                     {name: decode_type(type_sig) for name, type_sig in data["exports"].items()},
+                     {name: [(field, decode_type(type_sig)) for field, type_sig in fields]
+                      for name, fields in data["structs"].items()},
+                     {name: list(map(decode_type, options)) for name, options in data["unions"].items()})
+
+
+# Modules start with `import name` lines, naming other modules in the same directory. Returns the imported modules
+# and the source with these lines emptied. Finding the imports does not require lexing the whole module.
+def split_imports(source: str) -> Tuple[List[str], str]:
+    imports: List[str] = []
+    lines = source.split("\n")
+    for i, line in enumerate(lines):
+        words = line.split("#")[0].split()
+        if len(words) == 0:
+            continue
+        if words[0] != "import":
+            break
+        assert len(words) == 2, "Invalid import."
+        imports.append(words[1])
+        lines[i] = ""
+    return imports, "\n".join(lines)
+
+
+def struct_fields(definitions: Dict[str, Definition]) -> Dict[str, List[Tuple[str, TypeSignature]]]:
+    return {name: list(zip(d.parameters, d.type_sig.params)) for name, d in definitions.items()
+            if isinstance(d, PrimitiveFunction) and isinstance(d.impl, partial) and d.impl.func is create_struct}
+
+
+def union_options(type_aliases: TypeAliases) -> Dict[str, List[TypeSignature]]:
+    unions: Dict[str, List[TypeSignature]] = {}
+    for union, options in type_aliases.items():
+        assert isinstance(union.name, CustomPrimitiveType)
+        unions[union.name.name] = list(options)
+    return unions
+
+
+def interface_aliases(interface: Interface) -> TypeAliases:
+    return {TypeSignaturePrimitive(CustomPrimitiveType(name)): set(cast(List[TypeSignaturePrimitive], options))
+            for name, options in interface.unions.items()}
+
+
+# Imported names are only known by their types, like parameters during type checking.
+def interface_definitions(interface: Interface) -> Dict[str, Definition]:
+    return {name: Constant({}, Expression(), type_sig) for name, type_sig in interface.exports.items()}
+
+
+def interface_path(cache_dir: Path, module: str) -> Path:
+    return cache_dir / f"{module}{INTERFACE_SUFFIX}"
+
+
+def implementation_path(cache_dir: Path, module: str) -> Path:
+    return cache_dir / f"{module}{IMPLEMENTATION_SUFFIX}"
+
+
+# Checks the module against the interfaces of its imports alone, then writes its interface and implementation.
+def compile_module(module: str, source: str, dependencies: Dict[str, Interface], cache_dir: Path) -> Interface:
+    _, body = split_imports(source)
+    tokens = lex(augment(body))
+    own, own_aliases = parse(tokens) if any(not isinstance(token, Semicolon) for token in tokens) else ({}, {})
+    imported: Dict[str, Definition] = {}
+    type_aliases: TypeAliases = defaultdict(set)
+    for dependency in dependencies.values():
+        clashes = dependency.exports.keys() & (imported.keys() | own.keys())
+        type_assert(len(clashes) == 0, f"Defined more than once in {module}: {', '.join(sorted(clashes))}")
+        imported |= interface_definitions(dependency)
+        for union, options in interface_aliases(dependency).items():
+            type_aliases[union] |= options
+    type_aliases.update(own_aliases)
+    definitions, _ = transform_ubiquefix(default_environment() | imported | own, type_aliases)
+    check_types(definitions, type_aliases)
+    implementation = {name: definitions[name] for name in own}
+    interface = Interface(module, text_hash(source),
+                          {name: dependency.types_hash() for name, dependency in dependencies.items()},
+                          {name: cast(TypeSignature, definition_type(d)) for name, d in implementation.items()},
+                          struct_fields(implementation), union_options(type_aliases))
+    with implementation_path(cache_dir, module).open("wb") as implementation_file:
+        pickle.dump(implementation, implementation_file)
+    # Written last, so an interface is only present together with its implementation.
+    write_interface(interface_path(cache_dir, module), interface)
+    return interface
+
+
+def cached_interface(cache_dir: Path, module: str, source: str, dependencies: Dict[str, Interface]) \
+        -> Optional[Interface]:
+    path = interface_path(cache_dir, module)
+    if not path.exists() or not implementation_path(cache_dir, module).exists():
+        return None
+    interface = read_interface(path)
+    if interface.source_hash != text_hash(source) or \
+            interface.dependencies != {name: dependency.types_hash() for name, dependency in dependencies.items()}:
+        return None
+    return interface
+
+
+def module_imports(source_dir: Path, roots: Sequence[str]) -> Tuple[Dict[str, str], Dict[str, List[str]]]:
+    sources: Dict[str, str] = {}
+    imports: Dict[str, List[str]] = {}
+    pending = list(roots)
+    while len(pending) > 0:
+        module = pending.pop()
+        if module in sources:
+            continue
+        sources[module] = (source_dir / f"{module}{MODULE_SUFFIX}").read_text()
+        imports[module], _ = split_imports(sources[module])
+        pending.extend(imports[module])
+    return sources, imports
+
+
+def check_acyclic(imports: Dict[str, List[str]]) -> None:
+    done: Set[str] = set()
+
+    def visit(module: str, path: List[str]) -> None:
+        if module in path:
+            raise RuntimeError(f"Cyclic imports: {' -> '.join(path[path.index(module):] + [module])}")
+        if module not in done:
+            for imported in imports[module]:
+                visit(imported, path + [module])
+            done.add(module)
+
+    for module in imports:
+        visit(module, [])
+
+
+# Builds the given modules and everything they import. A module is compiled as soon as all its imports are, so
+# independent modules compile in parallel. Modules whose source and imported interfaces are unchanged are skipped.
+def build_modules(source_dir: Path, cache_dir: Path, roots: Sequence[str], workers: Optional[int] = None) \
+        -> Dict[str, ModuleStatus]:
+    sources, imports = module_imports(source_dir, roots)
+    check_acyclic(imports)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    interfaces: Dict[str, Interface] = {}
+    statuses: Dict[str, ModuleStatus] = {}
+    waiting = set(sources)
+    running: Dict[Future[Interface], str] = {}
+    # A single worker compiles in this process, which avoids starting another interpreter.
+    executor: Executor = ThreadPoolExecutor(1) if workers == 1 else ProcessPoolExecutor(workers)
+    with executor:
+        while len(waiting) > 0 or len(running) > 0:
+            ready = [module for module in waiting if all(imported in interfaces for imported in imports[module])]
+            for module in ready:
+                waiting.remove(module)
+                dependencies = {imported: interfaces[imported] for imported in imports[module]}
+                cached = cached_interface(cache_dir, module, sources[module], dependencies)
+                if cached is None:
+                    running[executor.submit(compile_module, module, sources[module], dependencies, cache_dir)] = module
+                else:
+                    interfaces[module] = cached
+                    statuses[module] = ModuleStatus.UP_TO_DATE
+            if len(ready) > 0 and len(running) == 0:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                module = running.pop(future)
+                interfaces[module] = future.result()
+                statuses[module] = ModuleStatus.COMPILED
+    return statuses
+
+
+# Links the compiled implementations of the module and everything it imports. The runtime environment is flat,
+# so top-level names have to be unique across all of these modules.
+def load_program(cache_dir: Path, module: str, mode: RuntimeMode = RuntimeMode.DEBUG,
+                 entry_points: Optional[Sequence[str]] = None) -> Program:
+    definitions: Dict[str, Definition] = {}
+    owners: Dict[str, str] = {}
+    type_aliases: TypeAliases = defaultdict(set)
+    loaded: Set[str] = set()
+    pending = [module]
+    while len(pending) > 0:
+        current = pending.pop()
+        if current in loaded:
+            continue
+        loaded.add(current)
+        interface = read_interface(interface_path(cache_dir, current))
+        with implementation_path(cache_dir, current).open("rb") as implementation_file:
+            implementation: Dict[str, Definition] = pickle.load(implementation_file)
+        for name in implementation:
+            if name in owners:
+                raise RuntimeError(f"{name} is defined in both {owners[name]} and {current}")
+            owners[name] = current
+        definitions |= implementation
+        for union, options in interface_aliases(interface).items():
+            type_aliases[union] |= options
+        pending.extend(interface.dependencies)
+    return Program(definitions, type_aliases, mode, entry_points, type_checked=True)
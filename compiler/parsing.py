@@ -1,14 +1,16 @@
 from __future__ import annotations
 
+import threading
 from collections import defaultdict
 from dataclasses import dataclass
 from functools import partial
-from typing import List, Dict, Tuple, Set
+from typing import List, Dict, Tuple, Set, cast, Sequence, Union, overload, FrozenSet
+from weakref import WeakValueDictionary
 
 from .expressions import Expression, PrimitiveExpression, Variable, Call, CompoundFunction, PrimitiveFunction, Constant, \
-    Definition
+    Definition, Match, MatchCase, StructValue, TypeTag, type_tag, share_arrays
 from .lexing import Token, Name, Assignment, StringConstant, IntegerConstant, Semicolon, BoolConstant, LeftParenthesis, \
-    RightParenthesis, Colon, Arrow, Comma, ColonEqual, NoneConstant, VerticalBar, ScopeOpen, ScopeClose
+    RightParenthesis, Colon, Arrow, Comma, ColonEqual, NoneConstant, VerticalBar, ScopeOpen, ScopeClose, FloatConstant
 from .type_signatures import TypeSignaturePrimitive, TypeSignature, TypeSignatureFunction, BuiltInPrimitiveType, \
     CustomPrimitiveType
 
@@ -29,16 +31,93 @@ class SumType(TypeSignature):
     options: List[TypeSignature]
 
 
+# Hash-consing: structurally equal subtrees built by the parser are the same object.
+# Children are interned before their parents, so a node's key only needs the identities of its children.
+_interned: WeakValueDictionary[Tuple[object, ...], Expression] = WeakValueDictionary()
+_interning_lock = threading.Lock()
+
+
+def intern_expression(key: Tuple[object, ...], exp: Expression) -> Expression:
+    with _interning_lock:
+        existing = _interned.get(key)
+        if existing is not None:
+            return existing
+        _interned[key] = exp
+        return exp
+
+
+def make_constant(value: Union[None, str, bool, int, float]) -> Expression:
+    return intern_expression((PrimitiveExpression, type(value), value), PrimitiveExpression(value))
+
+
+def make_variable(name: str) -> Expression:
+    return intern_expression((Variable, name), Variable(name))
+
+
+def make_call(operator: Expression, operands: Sequence[Expression]) -> Expression:
+    return intern_expression((Call, id(operator), *map(id, operands)), Call(operator, operands))
+
+
+def hash_cons(exp: Expression) -> Expression:
+    if isinstance(exp, Call):
+        return make_call(hash_cons(exp.operator), list(map(hash_cons, exp.operands)))
+    if isinstance(exp, Variable):
+        return make_variable(exp.name)
+    if isinstance(exp, PrimitiveExpression) and isinstance(exp.value, (type(None), str, bool, int, float)):
+        return make_constant(exp.value)
+    return exp
+
+
+# The tokens from a position on. The parser hands the rest of the tokens to the functions parsing the next part,
+# and slicing a list would copy all of them each time.
+class TokenSuffix(Sequence[Token]):
+    def __init__(self, tokens: List[Token], start: int = 0) -> None:
+        self.tokens = tokens
+        self.start = start
+
+    @overload
+    def __getitem__(self, index: int) -> Token:
+        ...
+
+    @overload
+    def __getitem__(self, index: slice) -> TokenSuffix:
+        ...
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[Token, TokenSuffix]:
+        if isinstance(index, slice):
+            assert index.stop is None and index.step is None
+            return TokenSuffix(self.tokens, self.start + (index.start or 0))
+        return self.tokens[self.start + index]
+
+    def __len__(self) -> int:
+        return len(self.tokens) - self.start
+
+
+PRIMITIVE_TYPE_NAMES = {
+    "Integer": BuiltInPrimitiveType.INTEGER,
+    "String": BuiltInPrimitiveType.STRING,
+    "Boolean": BuiltInPrimitiveType.BOOLEAN,
+    "None": BuiltInPrimitiveType.NONE,
+    "Int64": BuiltInPrimitiveType.INT64,
+    "Float64": BuiltInPrimitiveType.FLOAT64,
+    "Int64Array": BuiltInPrimitiveType.INT64_ARRAY,
+    "Float64Array": BuiltInPrimitiveType.FLOAT64_ARRAY,
+    "Array": BuiltInPrimitiveType.ARRAY,
+    "Stream": BuiltInPrimitiveType.STREAM,
+    "Map": BuiltInPrimitiveType.MAP,
+}
+
+
 def is_primitive_type_name(name: str) -> bool:
-    return name in ["Integer", "String", "Boolean", "None"]
+    return name in PRIMITIVE_TYPE_NAMES
 
 
 def primitive_type_signature_from_name(name: str) -> TypeSignaturePrimitive:
     return TypeSignaturePrimitive(
-        BuiltInPrimitiveType[name.upper()] if is_primitive_type_name(name) else CustomPrimitiveType(name))
+        PRIMITIVE_TYPE_NAMES[name] if is_primitive_type_name(name) else CustomPrimitiveType(name))
 
 
-def parse_type(tokens: List[Token]) -> Tuple[TypeSignature, int]:
+def parse_type(tokens: Sequence[Token]) -> Tuple[TypeSignature, int]:
     idx = 0
     curr = tokens[idx]
     idx += 1
@@ -64,26 +143,65 @@ def parse_type(tokens: List[Token]) -> Tuple[TypeSignature, int]:
     assert False
 
 
-def parse_expression(tokens: List[Token]) -> Tuple[Expression, int]:
+MATCH_KEYWORD = "match"
+
+
+# `match xs | None -> 0 | IntListElem x -> IntListElem.head x` extends to the end of the enclosing expression,
+# so a match in a case body has to be parenthesized.
+def parse_match(tokens: Sequence[Token]) -> Tuple[Match, int]:
+    assert tokens[0] == Name(MATCH_KEYWORD)
+    idx = 1
+    scrutinee, progress = parse_expression(tokens[idx:])
+    idx += progress
+    cases: List[MatchCase] = []
+    while isinstance(tokens[idx], VerticalBar):
+        idx += 1
+        case_type = tokens[idx]
+        assert isinstance(case_type, Name)
+        idx += 1
+        name = None
+        curr = tokens[idx]
+        if isinstance(curr, Name):
+            name = curr.value
+            idx += 1
+        assert isinstance(tokens[idx], Arrow)
+        idx += 1
+        body, progress = parse_expression(tokens[idx:])
+        idx += progress
+        cases.append(MatchCase(primitive_type_signature_from_name(case_type.value), name, body))
+    assert len(cases) > 0, "A match needs at least one case."
+    return Match(scrutinee, tuple(cases)), idx
+
+
+def parse_expression(tokens: Sequence[Token]) -> Tuple[Expression, int]:
     idx = 0
     parts: List[Expression] = []
-    while not isinstance(tokens[idx], RightParenthesis) and not isinstance(tokens[idx], Semicolon):
+    while not isinstance(tokens[idx], (RightParenthesis, Semicolon, VerticalBar)):
         curr = tokens[idx]
+        if curr == Name(MATCH_KEYWORD):
+            match, progress = parse_match(tokens[idx:])
+            idx += progress
+            parts.append(match)
+            continue
         if isinstance(curr, StringConstant):
             idx += 1
-            parts.append(PrimitiveExpression(curr.value))
+            parts.append(make_constant(curr.value))
             continue
         if isinstance(curr, IntegerConstant):
             idx += 1
-            parts.append(PrimitiveExpression(curr.value))
+            parts.append(make_constant(curr.value))
+            continue
+        if isinstance(curr, FloatConstant):
+            idx += 1
+            parts.append(make_constant(curr.value))
             continue
         if isinstance(curr, BoolConstant):
             idx += 1
-            parts.append(PrimitiveExpression(curr.value))
+            parts.append(make_constant(curr.value))
             continue
         if isinstance(curr, NoneConstant):
             idx += 1
-            parts.append(PrimitiveExpression(None))
+            parts.append(make_constant(None))
             continue
         if isinstance(curr, LeftParenthesis):
             idx += 1
@@ -95,16 +213,16 @@ def parse_expression(tokens: List[Token]) -> Tuple[Expression, int]:
             continue
         if isinstance(curr, Name):
             idx += 1
-            parts.append(Variable(curr.value))
+            parts.append(make_variable(curr.value))
             continue
         assert False
     if len(parts) == 1:
         return parts[0], idx
     else:
-        return Call(parts[0], parts[1:]), idx
+        return make_call(parts[0], parts[1:]), idx
 
 
-def parse_typed_name(tokens: List[Token]) -> Tuple[str, TypeSignature, int]:
+def parse_typed_name(tokens: Sequence[Token]) -> Tuple[str, TypeSignature, int]:
     idx = 0
     curr = tokens[idx]
     assert isinstance(curr, Name)
@@ -117,8 +235,14 @@ def parse_typed_name(tokens: List[Token]) -> Tuple[str, TypeSignature, int]:
     return def_name, def_type, idx
 
 
-def parse_definition(tokens: List[Token]) -> Tuple[str, Definition, int]:
+TAIL_RECURSION_ANNOTATION = "tailrec"
+
+
+def parse_definition(tokens: Sequence[Token]) -> Tuple[str, Definition, int]:
     idx = 0
+    tail_recursive = tokens[idx] == Name(TAIL_RECURSION_ANNOTATION) and isinstance(tokens[idx + 1], Name)
+    if tail_recursive:
+        idx += 1
     def_name, def_type, progress = parse_typed_name(tokens[idx:])
     idx += progress
     params = []
@@ -149,13 +273,14 @@ def parse_definition(tokens: List[Token]) -> Tuple[str, Definition, int]:
         idx += 1
 
     if len(params) == 0:
+        assert not tail_recursive, f"Only functions can be {TAIL_RECURSION_ANNOTATION}: {def_name}"
         return def_name, Constant(sub_definitions, expression, def_type), idx
     else:
         return def_name, CompoundFunction(sub_definitions, TypeSignatureFunction(param_types, def_type), params,
-                                          expression), idx
+                                          expression, tail_recursive), idx
 
 
-def parse_struct_definition(tokens: List[Token]) -> Tuple[str, Struct, int]:
+def parse_struct_definition(tokens: Sequence[Token]) -> Tuple[str, Struct, int]:
     idx = 0
     curr = tokens[idx]
     assert isinstance(curr, Name)
@@ -173,7 +298,7 @@ def parse_struct_definition(tokens: List[Token]) -> Tuple[str, Struct, int]:
     return struct_name, Struct(fields), idx
 
 
-def parse_union_definition(tokens: List[Token]) -> Tuple[str, SumType, int]:
+def parse_union_definition(tokens: Sequence[Token]) -> Tuple[str, SumType, int]:
     idx = 0
     curr = tokens[idx]
     assert isinstance(curr, Name)
@@ -199,15 +324,17 @@ def with_sub_definitions(definition: Definition, sub_definitions: Dict[str, Defi
     if isinstance(definition, Constant):
         return Constant(sub_definitions, definition.expression, definition.type_sig)
     if isinstance(definition, CompoundFunction):
-        return CompoundFunction(sub_definitions, definition.type_sig, definition.parameters, definition.body)
+        return CompoundFunction(sub_definitions, definition.type_sig, definition.parameters, definition.body,
+                                definition.tail_recursive)
     assert False
 
 
-def parse(tokens: List[Token]) -> Tuple[
+def parse(tokens: Sequence[Token]) -> Tuple[
     Dict[str, Definition], Dict[TypeSignaturePrimitive, Set[TypeSignaturePrimitive]]]:
     definitions: Dict[str, Definition] = {}
     structs: Dict[str, Struct] = {}
     unions: Dict[str, SumType] = {}
+    tokens = TokenSuffix(list(tokens))
 
     idx = 0
     while isinstance(tokens[idx], Semicolon):
@@ -238,7 +365,7 @@ def parse(tokens: List[Token]) -> Tuple[
             {},
             TypeSignatureFunction(field_types,
                                   primitive_type_signature_from_name(name)),
-            field_names, partial(create_struct, field_names))
+            field_names, partial(create_struct, field_names, type_tag(primitive_type_signature_from_name(name))))
         for field in struct.fields:
             definitions[name + "." + field.name] = PrimitiveFunction(
                 {},
@@ -246,11 +373,14 @@ def parse(tokens: List[Token]) -> Tuple[
                     [primitive_type_signature_from_name(name)],
                     field.type_sig),
                 ["the_struct"],
-                partial(get_struct_field, field.name))
+                partial(get_shared_struct_field if may_hold_array(field.type_sig, structs, unions, frozenset())
+                        else get_struct_field, field.name))
     type_aliases: Dict[TypeSignaturePrimitive, Set[TypeSignaturePrimitive]] = defaultdict(set)
     for name, union in unions.items():
         for option in union.options:
             assert isinstance(option, TypeSignaturePrimitive)
+            # Values carry the tag of their own type, so matches dispatch on the same tags in every union.
+            type_tag(option)
             type_aliases[TypeSignaturePrimitive(CustomPrimitiveType(name))].add(option)
     return definitions, type_aliases
 
@@ -258,9 +388,36 @@ def parse(tokens: List[Token]) -> Tuple[
 def get_struct_field(field_name: str, struct: PrimitiveExpression) -> PrimitiveExpression:
     assert isinstance(struct.value, dict)
     ret = struct.value[field_name]
-    assert isinstance(ret, PrimitiveExpression)
+    # Fields of function type hold closures.
+    assert isinstance(ret, Expression)
     return ret
 
 
-def create_struct(field_names: List[str], *args: PrimitiveExpression) -> PrimitiveExpression:
-    return PrimitiveExpression(dict(zip(field_names, list(args))))
+def get_struct_field_unchecked(field_name: str, struct: PrimitiveExpression) -> PrimitiveExpression:
+    return cast(Dict[str, PrimitiveExpression], struct.value)[field_name]
+
+
+# Struct values can be read any number of times, so arrays read from their fields are shared.
+def get_shared_struct_field(field_name: str, struct: PrimitiveExpression) -> PrimitiveExpression:
+    ret = get_struct_field(field_name, struct)
+    share_arrays([ret])
+    return ret
+
+
+# Other fields can only hold arrays through unions. The types of other modules are not known here, so these
+# might be unions holding arrays.
+def may_hold_array(type_sig: TypeSignature, structs: Dict[str, Struct], unions: Dict[str, SumType],
+                   visited: FrozenSet[str]) -> bool:
+    if not isinstance(type_sig, TypeSignaturePrimitive):
+        return False
+    if not isinstance(type_sig.name, CustomPrimitiveType):
+        return type_sig.name == BuiltInPrimitiveType.ARRAY
+    name = type_sig.name.name
+    if name in unions:
+        return name not in visited and any(may_hold_array(option, structs, unions, visited | {name})
+                                           for option in unions[name].options)
+    return name not in structs
+
+
+def create_struct(field_names: List[str], tag: TypeTag, *args: PrimitiveExpression) -> PrimitiveExpression:
+    return PrimitiveExpression(StructValue(tag, zip(field_names, args)))
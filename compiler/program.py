@@ -0,0 +1,127 @@
+from __future__ import annotations
+
+from enum import auto, StrEnum
+from types import MappingProxyType
+from typing import Dict, Set, Union, Mapping, List, Optional, Sequence, AbstractSet
+
+from .augmenting import augment
+from .built_ins import default_environment, RuntimeMode
+from .common_subexpressions import eliminate_common_subexpressions
+from .fusion import fuse_pipelines
+from .inlining import inline_functions
+from .expressions import Definition, Expression, PrimitiveExpression, Call, Variable
+from .interpreting import evaluate, definitions_to_expressions, with_runtime_mode, runtime_mode, \
+    call_site_statistics, CallSiteStatistics, inline_caching, local_names, bound_names
+from .lexing import lex
+from .parsing import parse, parse_expression, TokenSuffix
+from .tree_shaking import shake_tree
+from .type_checking import check_types, TypeRelations, definition_types, check_expression
+from .type_signatures import TypeSignaturePrimitive
+from .ubiquefix import transform_ubiquefix, Ambiguity, definition_scope, resolve_expression
+from .unboxing import UnboxedProgram
+
+Argument = Union[Expression, None, str, bool, int]
+
+
+def to_expression(value: Argument) -> Expression:
+    if isinstance(value, Expression):
+        return value
+    return PrimitiveExpression(value)
+
+
+def parse_source_expression(source: str) -> Expression:
+    exp, _ = parse_expression(TokenSuffix(lex(augment(source))))
+    return exp
+
+
+class Optimization(StrEnum):
+    INLINING = auto()
+    FUSION = auto()
+    COMMON_SUBEXPRESSIONS = auto()
+
+
+# Runs on type-checked definitions. Fusion only looks into calls, so it runs before the calls are bound by lets.
+# Names are scoped dynamically, so a name that some function binds locally may not refer to its global definition
+# where it is referenced. The passes must neither resolve such names nor assume their calls are pure.
+def optimize(definitions: Dict[str, Definition], optimizations: AbstractSet[Optimization]) -> Dict[str, Definition]:
+    shadowed = local_names(definitions)
+    if Optimization.INLINING in optimizations:
+        definitions, _ = inline_functions(definitions, shadowed=shadowed)
+    if Optimization.FUSION in optimizations:
+        definitions, _ = fuse_pipelines(definitions, shadowed)
+    if Optimization.COMMON_SUBEXPRESSIONS in optimizations:
+        definitions = eliminate_common_subexpressions(definitions, shadowed)
+    return definitions
+
+
+class Program:
+    # With entry points, only the definitions reachable from them are checked and kept.
+    # Definitions of compiled modules are resolved and checked already, see modules.py.
+    # Unless given, optimizations are off in debug mode, which evaluates the definitions as written.
+    def __init__(self, definitions: Dict[str, Definition],
+                 type_aliases: Dict[TypeSignaturePrimitive, Set[TypeSignaturePrimitive]],
+                 mode: RuntimeMode = RuntimeMode.DEBUG, entry_points: Optional[Sequence[str]] = None,
+                 type_checked: bool = False, optimizations: Optional[AbstractSet[Optimization]] = None) -> None:
+        all_definitions = default_environment() | definitions
+        self.dropped_definitions: List[str] = []
+        if entry_points is not None:
+            all_definitions, self.dropped_definitions = shake_tree(all_definitions, entry_points)
+        self.ambiguities: List[Ambiguity] = []
+        if type_checked:
+            self.type_relations = TypeRelations(type_aliases, definition_types(all_definitions))
+        else:
+            all_definitions, self.ambiguities = transform_ubiquefix(all_definitions, type_aliases)
+            self.type_relations = check_types(all_definitions, type_aliases)
+        # Release mode drops runtime assertions, which is only sound because the checks above passed.
+        all_definitions = with_runtime_mode(all_definitions, mode)
+        self.mode = mode
+        self.definitions: Mapping[str, Definition] = MappingProxyType(all_definitions)
+        self.type_aliases = type_aliases
+        self._scope = definition_scope(all_definitions)
+        self._checked_scope = dict(all_definitions)
+        self.optimizations = frozenset(optimizations if optimizations is not None else
+                                       [] if mode == RuntimeMode.DEBUG else Optimization)
+        # Unboxed mode compiles the definitions as written, so only the boxed evaluator gets the optimized ones.
+        self.optimized_definitions: Mapping[str, Definition] = MappingProxyType(
+            optimize(all_definitions, self.optimizations))
+        # Never mutated after construction, so concurrent evaluations can share it without locking.
+        self._environment = definitions_to_expressions(dict(self.optimized_definitions))
+        self._local_names = local_names(dict(self.optimized_definitions))
+        self._unboxed = UnboxedProgram(all_definitions, self.type_relations) if mode == RuntimeMode.UNBOXED else None
+
+    @staticmethod
+    def from_source(source: str, mode: RuntimeMode = RuntimeMode.DEBUG,
+                    entry_points: Optional[Sequence[str]] = None,
+                    optimizations: Optional[AbstractSet[Optimization]] = None) -> Program:
+        definitions, type_aliases = parse(lex(augment(source)))
+        return Program(definitions, type_aliases, mode, entry_points, optimizations=optimizations)
+
+    # Entry expressions go through the same front end as definitions. Only debug mode keeps the runtime assertions,
+    # so the others must not evaluate what does not pass the type checker.
+    def prepare(self, expression: Union[str, Expression]) -> Expression:
+        exp = parse_source_expression(expression) if isinstance(expression, str) else expression
+        exp = resolve_expression(self.type_relations, self._scope, exp)
+        if self.mode != RuntimeMode.DEBUG:
+            check_expression(self._checked_scope, self.type_relations, exp)
+        return exp
+
+    def evaluate(self, expression: Union[str, Expression]) -> Expression:
+        exp = self.prepare(expression)
+        with runtime_mode(self.mode):
+            if self._unboxed is not None:
+                return self._unboxed.evaluate(exp)
+            # Call sites resolve global names only once, which a name bound by the entry could shadow.
+            if not bound_names(exp) <= self._local_names:
+                with inline_caching(False):
+                    return evaluate(self._environment, exp)
+            return evaluate(self._environment, exp)
+
+    def call(self, name: str, *args: Argument) -> Expression:
+        if name not in self._environment:
+            raise KeyError(f"Unknown definition: {name}")
+        if len(args) == 0:
+            return self.evaluate(Variable(name))
+        return self.evaluate(Call(Variable(name), list(map(to_expression, args))))
+
+    def call_site_statistics(self) -> List[CallSiteStatistics]:
+        return call_site_statistics(self._environment)
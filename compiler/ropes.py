@@ -0,0 +1,69 @@
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from typing import Union, List
+
+# Shorter pieces are copied into one string, which is cheaper than a rope node for them.
+ROPE_CHUNK_SIZE = 256
+
+
+# A string built by concatenation. The characters are only joined once they are needed, e.g. by printing or
+# comparing. Flattening replaces the children with the result, so it happens at most once per node.
+@dataclass(eq=False)
+class Rope:
+    left: Text
+    right: Text
+    length: int = field(init=False)
+
+    def __post_init__(self) -> None:
+        self.length = len(self.left) + len(self.right)
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __str__(self) -> str:
+        if not isinstance(self.left, str) or self.right != "":
+            self.left, self.right = flatten(self), ""
+        assert isinstance(self.left, str)
+        return self.left
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, (str, Rope)):
+            return NotImplemented
+        return len(self) == len(other) and str(self) == str(other)
+
+    def __hash__(self) -> int:
+        return hash(str(self))
+
+
+Text = Union[str, Rope]
+
+
+# Iterative, since ropes built by accumulating loops are as deep as the loop is long.
+def flatten(text: Text) -> str:
+    chunks: List[str] = []
+    pending = [text]
+    while len(pending) > 0:
+        current = pending.pop()
+        if isinstance(current, str):
+            chunks.append(current)
+        elif current.right == "" and isinstance(current.left, str):
+            chunks.append(current.left)
+        else:
+            pending.append(current.right)
+            pending.append(current.left)
+    return "".join(chunks)
+
+
+def concat_texts(a: Text, b: Text) -> Text:
+    if len(a) == 0:
+        return b
+    if len(b) == 0:
+        return a
+    if isinstance(a, str) and isinstance(b, str) and len(a) + len(b) <= ROPE_CHUNK_SIZE:
+        return a + b
+    # Appending short pieces one by one, the typical way of accumulating, keeps filling the last chunk.
+    if isinstance(a, Rope) and isinstance(a.right, str) and isinstance(b, str) and \
+            len(a.right) + len(b) <= ROPE_CHUNK_SIZE:
+        return Rope(a.left, a.right + b)
+    return Rope(a, b)
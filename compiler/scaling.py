@@ -0,0 +1,136 @@
+import math
+import sys
+import time
+from dataclasses import dataclass
+from enum import auto, StrEnum
+from typing import Callable, Dict, List, Sequence, Tuple, Any
+
+from .augmenting import augment
+from .built_ins import default_environment
+from .expressions import Definition
+from .generating import GeneratorSettings, generate_program
+from .interpreting import evaluate_main
+from .lexing import lex
+from .parsing import parse
+from .type_checking import check_types, TypeAliases
+from .ubiquefix import transform_ubiquefix
+
+
+class Stage(StrEnum):
+    AUGMENT = auto()
+    LEX = auto()
+    PARSE = auto()
+    UBIQUEFIX = auto()
+    CHECK_TYPES = auto()
+    INTERPRET = auto()
+
+
+# The declared complexity of each stage, as the exponent of its growth in the size of the generated programs.
+LINEAR_BOUNDS: Dict[Stage, float] = dict.fromkeys(Stage, 1.0)
+# Indentation makes the source quadratic in the nesting depth of sub-definitions, and a nested function captures the
+# parameters of all functions it is nested in.
+NESTING_BOUNDS: Dict[Stage, float] = dict.fromkeys(Stage, 2.0)
+# Fitted exponents of linear stages scatter around 1 because of measurement noise and constant overheads,
+# while quadratic stages, e.g. ones copying the rest of their input per step, come out near 2.
+DEFAULT_TOLERANCE = 0.25
+
+
+@dataclass(frozen=True)
+class StageScaling:
+    stage: Stage
+    sizes: List[int]
+    seconds: List[float]
+    exponent: float
+    bound: float
+
+
+# Each stage takes the output of the previous one.
+def stage_functions(source: str) -> List[Tuple[Stage, Callable[[Any], Any]]]:
+    def resolve(parsed: Tuple[Dict[str, Definition], TypeAliases]) -> Tuple[Dict[str, Definition], TypeAliases]:
+        definitions, type_aliases = parsed
+        return transform_ubiquefix(default_environment() | definitions, type_aliases)[0], type_aliases
+
+    def check(resolved: Tuple[Dict[str, Definition], TypeAliases]) -> Dict[str, Definition]:
+        check_types(*resolved)
+        return resolved[0]
+
+    return [
+        (Stage.AUGMENT, lambda _: augment(source)),
+        (Stage.LEX, lex),
+        (Stage.PARSE, parse),
+        (Stage.UBIQUEFIX, resolve),
+        (Stage.CHECK_TYPES, check),
+        (Stage.INTERPRET, evaluate_main),
+    ]
+
+
+# Returns the best of `repeat` runs per stage.
+def measure_stages(source: str, repeat: int = 3) -> Dict[Stage, float]:
+    seconds: Dict[Stage, float] = {}
+    result: Any = None
+    for stage, function in stage_functions(source):
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            output = function(result)
+            times.append(time.perf_counter() - start)
+        seconds[stage] = min(times)
+        result = output
+    return seconds
+
+
+# The slope of the least-squares line through the points (log size, log seconds).
+def growth_exponent(sizes: Sequence[int], seconds: Sequence[float]) -> float:
+    xs = [math.log(size) for size in sizes]
+    ys = [math.log(max(duration, 1e-9)) for duration in seconds]
+    x_mean = sum(xs) / len(xs)
+    y_mean = sum(ys) / len(ys)
+    return sum((x - x_mean) * (y - y_mean) for x, y in zip(xs, ys)) / sum((x - x_mean) ** 2 for x in xs)
+
+
+# Generates a program of every size with the settings for that size and measures all stages on it.
+def measure_scaling(settings: Callable[[int], GeneratorSettings], sizes: Sequence[int], seed: int = 0,
+                    repeat: int = 3, bounds: Dict[Stage, float] = LINEAR_BOUNDS) -> List[StageScaling]:
+    measurements = []
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(100000)
+    try:
+        for size in sizes:
+            measurements.append(measure_stages(generate_program(settings(size), seed), repeat))
+    finally:
+        sys.setrecursionlimit(limit)
+    return [StageScaling(stage, list(sizes), [seconds[stage] for seconds in measurements],
+                         growth_exponent(sizes, [seconds[stage] for seconds in measurements]), bounds[stage])
+            for stage in Stage]
+
+
+def check_scaling(scalings: Sequence[StageScaling], tolerance: float = DEFAULT_TOLERANCE) -> None:
+    exceeding = [f"{scaling.stage} grows with exponent {scaling.exponent:.2f} (bound {scaling.bound})"
+                 for scaling in scalings if scaling.exponent > scaling.bound + tolerance]
+    if len(exceeding) > 0:
+        raise RuntimeError("Super-linear scaling: " + "; ".join(exceeding))
+
+
+def definitions_scaling(size: int) -> GeneratorSettings:
+    return GeneratorSettings(definitions=size)
+
+
+def sub_definition_scaling(size: int) -> GeneratorSettings:
+    return GeneratorSettings(definitions=4, sub_definition_depth=size)
+
+
+def structs_scaling(size: int) -> GeneratorSettings:
+    return GeneratorSettings(definitions=4, structs=size)
+
+
+def recursion_scaling(size: int) -> GeneratorSettings:
+    return GeneratorSettings(definitions=4, recursion_depth=size)
+
+
+# Each generator knob is swept on its own, with the others at small fixed values.
+KNOB_SCALINGS: List[Tuple[str, Callable[[int], GeneratorSettings], Dict[Stage, float]]] = [
+    ("definitions", definitions_scaling, LINEAR_BOUNDS),
+    ("sub-definition depth", sub_definition_scaling, NESTING_BOUNDS),
+    ("structs", structs_scaling, LINEAR_BOUNDS),
+    ("recursion depth", recursion_scaling, LINEAR_BOUNDS),
+]
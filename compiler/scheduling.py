@@ -0,0 +1,184 @@
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from enum import auto, StrEnum
+from typing import Dict, List, Optional, Deque
+
+from .expressions import Definition, Expression
+from .interpreting import evaluate_main, set_step_hook
+
+
+class SchedulingPolicy(StrEnum):
+    ROUND_ROBIN = auto()
+    PRIORITY = auto()
+
+
+class TaskStatus(StrEnum):
+    PENDING = auto()
+    RUNNING = auto()
+    SUSPENDED = auto()
+    FINISHED = auto()
+    FAILED = auto()
+    KILLED = auto()
+
+
+class LimitExceeded(RuntimeError):
+    pass
+
+
+class TaskCancelled(RuntimeError):
+    pass
+
+
+@dataclass(frozen=True)
+class TaskProgress:
+    name: str
+    status: TaskStatus
+    steps: int
+    slices: int
+    running_time: float
+
+
+# Stride scheduling: a task with priority p advances its pass by STRIDE_BASE / p per slice,
+# so higher priorities get proportionally more slices without starving the lower ones.
+STRIDE_BASE = 1 << 20
+
+
+class Task:
+    def __init__(self, name: str, definitions: Dict[str, Definition], priority: int,
+                 max_steps: Optional[int], time_limit: Optional[float]) -> None:
+        if priority < 1:
+            raise ValueError("Priority must be at least 1.")
+        self.name = name
+        self.definitions = definitions
+        self.priority = priority
+        self.max_steps = max_steps
+        self.time_limit = time_limit
+        self.status = TaskStatus.PENDING
+        self.result: Optional[Expression] = None
+        self.error: Optional[BaseException] = None
+        self.steps = 0
+        self.slices = 0
+        self.running_time = 0.0
+        self.pass_value = 0
+        self._fuel = 0
+        self._slice_start = 0.0
+        self._cancelled = False
+        self._resume = threading.Semaphore(0)
+        self._yielded = threading.Semaphore(0)
+        self._thread = threading.Thread(target=self._run, name=f"behagolit-{name}", daemon=True)
+
+    def done(self) -> bool:
+        return self.status in (TaskStatus.FINISHED, TaskStatus.FAILED, TaskStatus.KILLED)
+
+    def progress(self) -> TaskProgress:
+        return TaskProgress(self.name, self.status, self.steps, self.slices, self.running_time)
+
+    def run_slice(self, fuel: int) -> None:
+        self._fuel = fuel
+        self.slices += 1
+        self.status = TaskStatus.RUNNING
+        if not self._thread.is_alive() and self.slices == 1:
+            self._thread.start()
+        self._resume.release()
+        self._yielded.acquire()
+        if self.done():
+            self._thread.join()
+        else:
+            self.status = TaskStatus.SUSPENDED
+
+    def cancel(self) -> None:
+        if self.done():
+            return
+        if not self._thread.is_alive():
+            self.error = TaskCancelled(f"Task {self.name} was cancelled.")
+            self.status = TaskStatus.KILLED
+            return
+        # The thread is parked between slices; wake it so that it unwinds its evaluation and exits.
+        self._cancelled = True
+        self._resume.release()
+        self._yielded.acquire()
+        self._thread.join()
+
+    def _consume_fuel(self) -> None:
+        self.steps += 1
+        if self.max_steps is not None and self.steps > self.max_steps:
+            raise LimitExceeded(f"Task {self.name} exceeded its step limit of {self.max_steps}.")
+        if self.time_limit is not None and \
+                self.running_time + time.perf_counter() - self._slice_start > self.time_limit:
+            raise LimitExceeded(f"Task {self.name} exceeded its time limit of {self.time_limit} s.")
+        self._fuel -= 1
+        if self._fuel <= 0:
+            self.running_time += time.perf_counter() - self._slice_start
+            self._yielded.release()
+            self._resume.acquire()
+            if self._cancelled:
+                raise TaskCancelled(f"Task {self.name} was cancelled.")
+            self._slice_start = time.perf_counter()
+
+    def _run(self) -> None:
+        self._resume.acquire()
+        self._slice_start = time.perf_counter()
+        set_step_hook(self._consume_fuel)
+        try:
+            self.result = evaluate_main(self.definitions)
+            self.running_time += time.perf_counter() - self._slice_start
+            self.status = TaskStatus.FINISHED
+        except (LimitExceeded, TaskCancelled) as e:
+            self.error = e
+            self.status = TaskStatus.KILLED
+        except Exception as e:
+            self.error = e
+            self.status = TaskStatus.FAILED
+        finally:
+            set_step_hook(None)
+            self._yielded.release()
+
+
+class Scheduler:
+    def __init__(self, slice_steps: int = 10000, policy: SchedulingPolicy = SchedulingPolicy.ROUND_ROBIN) -> None:
+        self.slice_steps = slice_steps
+        self.policy = policy
+        self.tasks: List[Task] = []
+        self._runnable: Deque[Task] = deque()
+
+    def submit(self, definitions: Dict[str, Definition], name: Optional[str] = None, priority: int = 1,
+               max_steps: Optional[int] = None, time_limit: Optional[float] = None) -> Task:
+        task = Task(name if name is not None else f"task{len(self.tasks)}", definitions, priority, max_steps,
+                    time_limit)
+        if len(self._runnable) > 0:
+            task.pass_value = min(t.pass_value for t in self._runnable)
+        self.tasks.append(task)
+        self._runnable.append(task)
+        return task
+
+    def _next_task(self) -> Task:
+        if self.policy == SchedulingPolicy.ROUND_ROBIN:
+            return self._runnable.popleft()
+        task = min(self._runnable, key=lambda t: t.pass_value)
+        self._runnable.remove(task)
+        return task
+
+    def step(self) -> bool:
+        if len(self._runnable) == 0:
+            return False
+        task = self._next_task()
+        task.run_slice(self.slice_steps)
+        task.pass_value += STRIDE_BASE // task.priority
+        if not task.done():
+            self._runnable.append(task)
+        return len(self._runnable) > 0
+
+    def cancel(self, task: Task) -> None:
+        if task in self._runnable:
+            self._runnable.remove(task)
+        task.cancel()
+
+    def run(self) -> List[Task]:
+        while self.step():
+            pass
+        return self.tasks
+
+    def progress(self) -> Dict[str, TaskProgress]:
+        return {task.name: task.progress() for task in self.tasks}
@@ -0,0 +1,97 @@
+from __future__ import annotations
+
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, Future
+from dataclasses import dataclass
+from types import TracebackType
+from typing import Dict, List, Optional, Union, Type, Callable
+
+from .expressions import Expression
+from .program import Program, Argument
+
+
+@dataclass(frozen=True)
+class Response:
+    value: Optional[Expression]
+    error: Optional[BaseException]
+    queue_time: float
+    latency: float
+
+
+@dataclass(frozen=True)
+class LatencyStatistics:
+    count: int
+    mean: float
+    p50: float
+    p95: float
+    p99: float
+    max: float
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+class ProgramServer:
+    def __init__(self, workers: int = 4) -> None:
+        self._programs: Dict[str, Program] = {}
+        self._latencies: List[float] = []
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="behagolit-worker")
+
+    def __enter__(self) -> ProgramServer:
+        return self
+
+    def __exit__(self, exc_type: Optional[Type[BaseException]], exc_value: Optional[BaseException],
+                 traceback: Optional[TracebackType]) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
+
+    def load(self, name: str, source_or_program: Union[str, Program]) -> Program:
+        program = Program.from_source(source_or_program) \
+            if isinstance(source_or_program, str) else source_or_program
+        with self._lock:
+            self._programs[name] = program
+        return program
+
+    def program(self, name: str) -> Program:
+        with self._lock:
+            return self._programs[name]
+
+    def evaluate(self, program_name: str, expression: Union[str, Expression]) -> Future[Response]:
+        program = self.program(program_name)
+        return self._submit(lambda: program.evaluate(expression))
+
+    def call(self, program_name: str, function_name: str, *args: Argument) -> Future[Response]:
+        program = self.program(program_name)
+        return self._submit(lambda: program.call(function_name, *args))
+
+    def _submit(self, job: Callable[[], Expression]) -> Future[Response]:
+        submitted = time.perf_counter()
+
+        def run() -> Response:
+            started = time.perf_counter()
+            value: Optional[Expression] = None
+            error: Optional[BaseException] = None
+            try:
+                value = job()
+            except Exception as e:
+                error = e
+            finished = time.perf_counter()
+            with self._lock:
+                self._latencies.append(finished - submitted)
+            return Response(value, error, started - submitted, finished - submitted)
+
+        return self._executor.submit(run)
+
+    def latency_statistics(self) -> LatencyStatistics:
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if len(latencies) == 0:
+            return LatencyStatistics(0, 0.0, 0.0, 0.0, 0.0, 0.0)
+        return LatencyStatistics(len(latencies), statistics.fmean(latencies), percentile(latencies, 0.5),
+                                 percentile(latencies, 0.95), percentile(latencies, 0.99), latencies[-1])
@@ -1,13 +1,286 @@
+import io
+import pickle
+import tempfile
 import unittest
+from array import array
+from contextlib import redirect_stdout
+from pathlib import Path
+from typing import cast, IO, Any, Callable, List
+from unittest.mock import patch
 
 from .augmenting import augment
-from .built_ins import default_environment
-from .expressions import Call, PrimitiveExpression, Variable, Constant
-from .interpreting import evaluate, definitions_to_expressions
-from .lexing import Name, Colon, Assignment, Semicolon, lex
+from .built_ins import default_environment, RuntimeMode, PRELUDE
+from .capturing import free_variables, closure_captures
+from .common_subexpressions import eliminate_common_subexpressions
+from .expressions import Call, PrimitiveExpression, Variable, Constant, CompoundFunction, Let, FusedPipeline, \
+    CompoundClosure, PartialApplication, Match, ArrayValue, StreamValue
+from .fusion import fuse_pipelines, Fusion
+from .generating import GeneratorSettings, generate_program
+from .hash_tries import HashTrie
+from .inlining import inline_functions, InliningDecision, InliningOutcome
+from .interpreting import evaluate, definitions_to_expressions, evaluate_main, inline_caching, \
+    MAX_INLINE_CACHE_TARGETS, PRELUDE_EXPRESSIONS, apply
+from .lexing import Name, Colon, Assignment, Semicolon, lex, FloatConstant, IntegerConstant
+from .modules import build_modules, load_program, read_interface, ModuleStatus, MODULE_SUFFIX, INTERFACE_SUFFIX
 from .parsing import parse_type, parse_expression, parse
+from .program import Program, parse_source_expression, Optimization
+from .ropes import Rope, Text, concat_texts, ROPE_CHUNK_SIZE
+from .scaling import Stage, StageScaling, check_scaling, growth_exponent, KNOB_SCALINGS
+from .scheduling import Scheduler, SchedulingPolicy, TaskStatus
+from .serving import ProgramServer
+from .tree_shaking import shake_tree
 from .type_checking import check_types, TypeCheckException
-from .type_signatures import TypeSignaturePrimitive, TypeSignatureFunction, BuiltInPrimitiveType
+from .type_signatures import TypeSignaturePrimitive, TypeSignatureFunction, BuiltInPrimitiveType, CustomPrimitiveType
+from .ubiquefix import transform_ubiquefix, Ambiguity
+from .unboxing import UnboxedProgram
+
+
+IDENTITY_SOURCE = "a:Integer = 1\nb:Integer=c\nc:Integer=2\nidentity:Integer x:Integer=x"
+
+VARIABLE_SOURCE = "fourteen:Integer = plus 10 4"
+
+HIGHER_ORDER_SOURCE = """
+apply:Integer f:(Integer->Integer) v:Integer = f v
+square:Integer x:Integer = multiply x x
+"""
+
+SCOPE_SOURCE = "y:Integer = plusTwo 40\n    plusTwo:Integer x:Integer = plus x two\n        two:Integer = 2"
+
+RETURNED_FUNCTION_SOURCE = """
+foo:(Integer -> Integer) x:Integer = helper
+    helper:Integer y:Integer = plus x y
+        """
+
+PARENTHESIZED_OPERATOR_SOURCE = "a:Integer = (plus 40) 2"
+
+STRUCT_SOURCE = "Foo := struct x:Integer y:Boolean"
+
+UNION_SOURCE = "Foo := union Boolean | Integer\nf:Foo = 42"
+
+MESSAGE_SOURCE = """
+main:None = printLine message
+message:String = concat "Hello, world!" (concat "\\n" answerSentence)
+    answerSentence:String = tellFact "answer" theAnswer
+        tellFact:String name:String value:String = concat "The " (concat name (concat " is: " value))
+    theAnswer:String = ifElse true fourtyTwoRepr "No."
+        fourtyTwoRepr:String = intToStr fourtyTwo
+            fourtyTwo:Integer = plus fourteen (plus 15 thirteen)
+                thirteen:Integer = divide (plus (modulo 29 19) (plus (fib 8) sixty)) 7
+                    sixty:Integer = plus (multiply 10 (TwoDigitNumber.tens weirdSixty)) (TwoDigitNumber.ones weirdSixty)
+                        weirdSixty:TwoDigitNumber = TwoDigitNumber 6 0
+                fourteen:Integer = sum (map oneTwoThree square)
+                    oneTwoThree:IntList = IntListElem 1 (IntListElem 2 (IntListElem 3 none))
+fib:Integer n:Integer = ifElse (less n 2) n (plus (fib (minus n 1)) (fib (minus n 2)))
+TwoDigitNumber := struct tens:Integer ones:Integer
+IntListElem := struct head:Integer tail:IntList
+IntList := union None | IntListElem
+sum:Integer xs:IntList = foldr plus 0 xs
+foldr:Integer f:(Integer, Integer -> Integer) acc:Integer xs:IntList = ifElse (equal xs none) acc (f (IntListElem.head xs) (foldr f acc (IntListElem.tail xs)))
+map:IntList xs:IntList f:(Integer -> Integer) = ifElse (equal xs none) none (IntListElem (f (IntListElem.head xs)) (map (IntListElem.tail xs) f))
+square:Integer x:Integer = multiply x x"""
+
+DESCRIBE_SOURCE = "TwoDigitNumber := struct tens:Integer ones:Integer\n" \
+                  "describe:String n:Integer = ifElse (less n 10) \"small\" (concat \"tens: \" (intToStr tens))\n" \
+                  "    tens:Integer = TwoDigitNumber.tens (TwoDigitNumber (divide n 10) (modulo n 10))"
+
+COMMON_SUBEXPRESSIONS_SOURCE = """
+f:Integer n:Integer = plus (multiply (minus n 1) (minus n 1)) (multiply (minus n 1) (minus n 1))
+g:String = concat (printLine "a") (printLine "a")
+"""
+
+PIPELINES_SOURCE = """
+IntListElem := struct head:Integer tail:IntList
+IntList := union None | IntListElem
+sum:Integer xs:IntList = foldr plus 0 xs
+foldr:Integer f:(Integer, Integer -> Integer) acc:Integer xs:IntList = ifElse (equal xs none) acc (f (IntListElem.head xs) (foldr f acc (IntListElem.tail xs)))
+map:IntList xs:IntList f:(Integer -> Integer) = ifElse (equal xs none) none (IntListElem (f (IntListElem.head xs)) (map (IntListElem.tail xs) f))
+filter:IntList xs:IntList p:(Integer -> Boolean) = ifElse (equal xs none) none (ifElse (p (IntListElem.head xs)) (IntListElem (IntListElem.head xs) (filter (IntListElem.tail xs) p)) (filter (IntListElem.tail xs) p))
+isOdd:Boolean x:Integer = equal (modulo x 2) 1
+square:Integer x:Integer = multiply x x
+total:Integer = sum (map (filter oneToFour isOdd) square)
+    oneToFour:IntList = IntListElem 1 (IntListElem 2 (IntListElem 3 (IntListElem 4 none)))
+squares:IntList xs:IntList = map (map xs square) square
+"""
+
+SHAPES_SOURCE = """
+Circle := struct radius:Integer
+Triangle := struct side:Integer
+Square := struct side:Integer
+Polygon := union Triangle | Square
+Shape := union Circle | Polygon
+describe:String s:Shape = concat "a shape" ""
+applyToPolygon:String f:(Polygon -> String) p:Polygon = f p
+"""
+
+FOLDR_SOURCE = """
+IntListElem := struct head:Integer tail:IntList
+IntList := union None | IntListElem
+foldr:Integer f:(Integer, Integer -> Integer) acc:Integer xs:IntList = ifElse (equal xs none) acc (f (IntListElem.head xs) (foldr f acc (IntListElem.tail xs)))
+numbers:IntList = IntListElem 1 (IntListElem 2 (IntListElem 3 (IntListElem 4 none)))
+first:Integer a:Integer b:Integer = a
+second:Integer a:Integer b:Integer = b
+larger:Integer a:Integer b:Integer = ifElse (greater a b) a b
+"""
+
+INLINING_SOURCE = """
+square:Integer x:Integer = multiply x x
+add:Integer a:Integer b:Integer = plus a b
+norm:Integer x:Integer y:Integer = add (square x) (square y)
+twice:String s:String = concat s s
+shout:String = twice (printLine "hey")
+squareOfSum:Integer = square (plus 1 2)
+curried:Integer = (add 1) 2
+fib:Integer n:Integer = ifElse (less n 2) n (plus (fib (minus n 1)) (fib (minus n 2)))
+"""
+
+ADDER_SOURCE = """
+adder:(Integer -> Integer) n:Integer = add
+    add:Integer x:Integer = plus (twice x) n
+twice:Integer x:Integer = multiply x 2
+unrelated:Integer = 42
+"""
+
+FIXED_WIDTH_SOURCE = """
+wrapped:Int64 = plusInt64 (int64 9223372036854775807) (int64 1)
+quotient:Int64 = divideInt64 (minusInt64 (int64 0) (int64 7)) (int64 2)
+infinite:Float64 = divideFloat64 1.5 0.0
+saturated:Int64 = float64ToInt64 infinite
+total:Int64 = int64ArraySum (int64ArraySet (int64ArrayRange (int64 0) (int64 100)) 0 (int64 50))
+dot:Float64 = float64ArrayDot (float64ArrayFill 3 0.5) ints
+    ints:Float64Array = int64ArrayToFloat64Array (int64ArrayRange (int64 1) (int64 4))
+"""
+
+ARRAYS_SOURCE = """
+tailrec pushAll:Array xs:Array n:Integer = ifElse (less n 1) xs (pushAll (arrayPush xs (int64 n)) (minus n 1))
+bump:Array xs:Array i:Integer = arraySet xs i (plusInt64 (int64 1) (arrayGet xs i))
+Holder := struct items:Array
+holder:Holder = Holder (pushAll (arrayFill 0 (int64 0)) 3)
+main:Int64 = plusInt64 (arraySum (arrayPush (Holder.items holder) (int64 4))) (arraySum (Holder.items holder))
+"""
+
+MAP_SOURCE = """
+counts:Map = mapInsert (mapInsert (mapInsert mapEmpty "a" 1) "b" 2) "a" 3
+total:Integer = mapFold add 0 counts
+    add:Integer acc:Integer key:String value:Integer = plus acc value
+"""
+
+TAIL_RECURSION_SOURCE = """
+tailrec sumTo:Integer acc:Integer n:Integer = ifElse (equal n 0) acc (sumTo (plus acc n) (minus n 1))
+tailrec collatz:Integer steps:Integer n:Integer = ifElse (equal n 1) steps (ifElse (equal (modulo n 2) 0) (collatz (plus steps 1) (divide n 2)) (collatz (plus steps 1) (plus (multiply 3 n) 1)))
+"""
+
+PARTIAL_APPLICATION_SOURCE = """
+add3:Integer a:Integer b:Integer c:Integer = plus a (plus b c)
+twice:Integer f:(Integer -> Integer) x:Integer = f (f x)
+increment:(Integer -> Integer) = plus 1
+adder:(Integer -> Integer) n:Integer = plus n
+curried:Integer = (add3 1) 2 3
+nested:Integer = ((add3 1) 2) 3
+applied:Integer = twice (add3 1 2) 4
+overSaturated:Integer = adder 40 2
+"""
+
+UBIQUEFIX_SOURCE = """
+IntListElem := struct head:Integer tail:IntList
+IntList := union None | IntListElem
+map:IntList xs:IntList f:(Integer -> Integer) = ifElse (equal xs none) none (IntListElem (f (IntListElem.head xs)) (map (IntListElem.tail xs) f))
+sum:Integer xs:IntList = ifElse (equal xs none) 0 (plus (IntListElem.head xs) (sum (IntListElem.tail xs)))
+square:Integer x:Integer = multiply x x
+input:IntList = IntListElem 1 (IntListElem 2 (IntListElem 3 none))
+result:Integer = input map square map (plus 1) sum
+difference:Integer = 10 minus 3
+"""
+
+MATCH_SOURCE = """
+IntListElem := struct head:Integer tail:IntList
+IntList := union None | IntListElem
+Circle := struct radius:Integer
+Rectangle := struct width:Integer height:Integer
+Shape := union Circle | Rectangle | Integer
+sum:Integer xs:IntList = match xs | None -> 0 | IntListElem x -> plus (IntListElem.head x) (sum (IntListElem.tail x))
+tailrec count:Integer acc:Integer xs:IntList = match xs | None -> acc | IntListElem x -> count (plus acc 1) (IntListElem.tail x)
+area:Integer s:Shape = match s | Rectangle r -> multiply (Rectangle.width r) (Rectangle.height r) | Circle c -> multiply 3 (square (Circle.radius c)) | Integer -> 0
+square:Integer x:Integer = multiply x x
+xs:IntList = IntListElem 1 (IntListElem 2 (IntListElem 3 none))
+main:Integer = plus (sum xs) (plus (count 0 xs) (plus (area (Rectangle 2 5)) (plus (area (Circle 2)) (area 7))))
+"""
+
+UNBOXED_SOURCE = """
+IntListElem := struct head:Integer tail:IntList
+IntList := union None | IntListElem
+Circle := struct radius:Integer
+Shape := union Circle | Integer
+Op := struct run:(Integer -> Integer)
+range:IntList n:Integer = ifElse (equal n 0) none (IntListElem n (range (minus n 1)))
+sum:Integer xs:IntList = match xs | None -> 0 | IntListElem x -> plus (IntListElem.head x) (sum (IntListElem.tail x))
+shape:Shape n:Integer = ifElse (less n 0) (Circle (minus 0 n)) n
+size:Integer s:Shape = match s | Circle c -> Circle.radius c | Integer n -> multiply 10 n
+total:Integer = mapFold add 0 (mapInsert (mapInsert mapEmpty "a" 1) "b" 2)
+    add:Integer acc:Integer key:String value:Integer = plus acc value
+twice:Integer = Op.run op (Op.run op 1)
+    op:Op = Op (plus 20)
+"""
+
+ROPES_SOURCE = """
+repeated:String piece:String n:Integer = ifElse (equal n 0) "" (concat (repeated piece (minus n 1)) piece)
+"""
+
+# Names are scoped dynamically, so the parameter k of f is the k that addK sees when f calls it.
+DYNAMIC_SCOPE_SOURCE = """
+k:Integer = 1
+addK:Integer x:Integer = plus x k
+f:Integer k:Integer = addK 10
+step:Integer = 2
+addStep:Integer x:Integer = plus x step
+"""
+
+# The parameter square of the apply functions is the square that norm, twice and total call.
+SHADOWED_FUNCTION_SOURCE = """
+IntListElem := struct head:Integer tail:IntList
+IntList := union None | IntListElem
+map:IntList xs:IntList f:(Integer -> Integer) = ifElse (equal xs none) none (IntListElem (f (IntListElem.head xs)) (map (IntListElem.tail xs) f))
+sum:Integer xs:IntList = ifElse (equal xs none) 0 (plus (IntListElem.head xs) (sum (IntListElem.tail xs)))
+square:Integer x:Integer = multiply x x
+norm:Integer x:Integer y:Integer = plus (square x) (square y)
+twice:Integer x:Integer = plus (square x) (square x)
+total:Integer xs:IntList = sum (map (map xs square) square)
+applyNorm:Integer square:(Integer -> Integer) = norm 3 4
+applyTwice:Integer square:(Integer -> Integer) = twice 3
+applyTotal:Integer square:(Integer -> Integer) = total (IntListElem 1 (IntListElem 2 none))
+"""
+
+# Each runtime mode has to give the same results for these entry expressions.
+MODE_INDEPENDENT_PROGRAMS = [
+    (IDENTITY_SOURCE, ["plus a (identity b)"]),
+    (VARIABLE_SOURCE, ["intToStr fourteen"]),
+    (HIGHER_ORDER_SOURCE, ["apply square 3"]),
+    (SCOPE_SOURCE, ["y"]),
+    (RETURNED_FUNCTION_SOURCE, ["(foo 40) 2"]),
+    (PARENTHESIZED_OPERATOR_SOURCE, ["a"]),
+    (STRUCT_SOURCE, ["Foo.y (Foo 42 true)"]),
+    (UNION_SOURCE, ["equal f 42"]),
+    (MESSAGE_SOURCE, ["message"]),
+    (DESCRIBE_SOURCE, ["describe 3", "describe 42", "3 describe"]),
+    (COMMON_SUBEXPRESSIONS_SOURCE, ["f 5"]),
+    (PIPELINES_SOURCE, ["total", "squares (IntListElem 2 (IntListElem 3 none))"]),
+    (SHAPES_SOURCE + "main:String = applyToPolygon describe (Square 3)", ["main"]),
+    (FOLDR_SOURCE, ["foldr plus 1 numbers", "foldr first 1 numbers", "foldr larger 1 numbers"]),
+    (INLINING_SOURCE, ["norm 3 4", "squareOfSum", "fib 10", "curried"]),
+    (ADDER_SOURCE, ["(adder 1) 2"]),
+    (FIXED_WIDTH_SOURCE, ["wrapped", "quotient", "infinite", "saturated", "total", "dot"]),
+    (ARRAYS_SOURCE, ["main", "pushAll (arrayFill 2 (int64 7)) 2"]),
+    (ROPES_SOURCE, ['repeated "ab" 3']),
+    (MAP_SOURCE, ["total", 'mapLookup counts "a" 0', "mapSize counts"]),
+    (TAIL_RECURSION_SOURCE, ["sumTo 0 2000", "collatz 0 27"]),
+    (PARTIAL_APPLICATION_SOURCE, ["curried", "nested", "applied", "overSaturated", "increment 5"]),
+    (UBIQUEFIX_SOURCE, ["result", "difference"]),
+    (MATCH_SOURCE, ["main"]),
+    (UNBOXED_SOURCE, ["sum (range 100)", "size (shape 4)", "size (shape (minus 0 3))", "shape (minus 0 3)",
+                      "range 2", "total", "twice"]),
+    (DYNAMIC_SCOPE_SOURCE, ["f 100", "addK 10", "match 5 | Integer step -> addStep 10", "addStep 10"]),
+    (SHADOWED_FUNCTION_SOURCE, ["norm 3 4", "applyNorm (plus 1)", "applyTwice (plus 1)", "applyTotal (plus 1)",
+                                "total (IntListElem 1 (IntListElem 2 none))"]),
+]
 
 
 class TestBehagolit(unittest.TestCase):
@@ -131,7 +404,6 @@ foo:(Integer -> Integer) x:Integer = helper
         env = definitions_to_expressions(definitions)
         self.assertEqual(PrimitiveExpression(42), evaluate(env, exp))
 
-    @unittest.skip("not yet implemented")
     def test_partial_application_transformation(self) -> None:
         source = "a:Integer = (plus 40) 2"
         exp, _ = parse_expression(lex(augment("a")))
@@ -234,3 +506,671 @@ square:Integer x:Integer = multiply x x"""
         user_definitions, type_aliases = parse(lex(augment(source)))
         definitions = default_environment() | user_definitions
         self.assertRaises(TypeCheckException, check_types, definitions, type_aliases)
+
+    def test_comparison_types(self) -> None:
+        for source in ["foo:Boolean = less 1 2", "foo:Boolean = greater 1 2", "foo:Boolean = equal 1 2",
+                       "foo:Integer = ifElse (less 1 2) 1 2"]:
+            user_definitions, type_aliases = parse(lex(augment(source)))
+            check_types(default_environment() | user_definitions, type_aliases)
+        for source in ["foo:Integer = plus 1 (less 1 2)", "foo:Integer = plus 1 (greater 1 2)",
+                       "foo:Integer = plus 1 (equal 1 2)", "foo:Integer = ifElse (plus 1 2) 1 2"]:
+            user_definitions, type_aliases = parse(lex(augment(source)))
+            self.assertRaises(TypeCheckException, check_types, default_environment() | user_definitions, type_aliases)
+
+    def test_scheduler_interleaves_programs(self) -> None:
+        fib_source = "main:Integer = fib 15\nfib:Integer n:Integer = ifElse (less n 2) n (plus (fib (minus n 1)) (fib (minus n 2)))"
+        quick_source = "main:Integer = plus 40 2"
+        scheduler = Scheduler(slice_steps=500)
+        slow = scheduler.submit(parse(lex(augment(fib_source)))[0], name="slow")
+        quick = scheduler.submit(parse(lex(augment(quick_source)))[0], name="quick")
+        scheduler.step()
+        self.assertEqual(TaskStatus.SUSPENDED, slow.status)
+        scheduler.step()
+        self.assertEqual(TaskStatus.FINISHED, quick.status)
+        scheduler.run()
+        self.assertEqual(PrimitiveExpression(610), slow.result)
+        self.assertEqual(PrimitiveExpression(42), quick.result)
+        progress = scheduler.progress()
+        self.assertGreater(progress["slow"].slices, 1)
+        self.assertEqual(1, progress["quick"].slices)
+
+    def test_scheduler_enforces_step_limit(self) -> None:
+        source = "main:Integer = loop 0\nloop:Integer n:Integer = loop (plus n 1)"
+        scheduler = Scheduler(slice_steps=100, policy=SchedulingPolicy.PRIORITY)
+        runaway = scheduler.submit(parse(lex(augment(source)))[0], max_steps=300)
+        scheduler.run()
+        self.assertEqual(TaskStatus.KILLED, runaway.status)
+        self.assertEqual(301, runaway.steps)
+
+    def test_scheduler_enforces_time_limit_within_slice(self) -> None:
+        source = "main:Integer = fib 30\nfib:Integer n:Integer = ifElse (less n 2) n (plus (fib (minus n 1)) (fib (minus n 2)))"
+        scheduler = Scheduler(slice_steps=10 ** 9)
+        runaway = scheduler.submit(parse(lex(augment(source)))[0], time_limit=0.05)
+        scheduler.run()
+        self.assertEqual(TaskStatus.KILLED, runaway.status)
+        self.assertEqual(1, runaway.slices)
+        self.assertFalse(runaway._thread.is_alive())
+
+    def test_scheduler_cancels_tasks(self) -> None:
+        source = "main:Integer = loop 0\nloop:Integer n:Integer = loop (plus n 1)"
+        scheduler = Scheduler(slice_steps=100)
+        started = scheduler.submit(parse(lex(augment(source)))[0], name="started")
+        pending = scheduler.submit(parse(lex(augment(source)))[0], name="pending")
+        scheduler.step()
+        self.assertEqual(TaskStatus.SUSPENDED, started.status)
+        scheduler.cancel(started)
+        scheduler.cancel(pending)
+        self.assertEqual(TaskStatus.KILLED, started.status)
+        self.assertEqual(TaskStatus.KILLED, pending.status)
+        self.assertFalse(started._thread.is_alive())
+        self.assertFalse(scheduler.step())
+        quick = Scheduler().submit(parse(lex(augment("main:Integer = plus 40 2")))[0])
+        quick.run_slice(100)
+        self.assertEqual(TaskStatus.FINISHED, quick.status)
+        self.assertFalse(quick._thread.is_alive())
+
+    def test_prepared_program(self) -> None:
+        program = Program.from_source("square:Integer x:Integer = multiply x x\nanswer:Integer = plus 40 2")
+        self.assertEqual(PrimitiveExpression(49), program.call("square", 7))
+        self.assertEqual(PrimitiveExpression(42), program.call("answer"))
+        self.assertEqual(PrimitiveExpression("1764"), program.evaluate("intToStr (square answer)"))
+
+    def test_program_server(self) -> None:
+        with ProgramServer(workers=4) as server:
+            server.load("squares", "square:Integer x:Integer = multiply x x")
+            futures = [server.call("squares", "square", i) for i in range(20)]
+            responses = [f.result() for f in futures]
+            failing = server.evaluate("squares", "square \"no\"").result()
+        self.assertEqual([PrimitiveExpression(i * i) for i in range(20)], [r.value for r in responses])
+        self.assertIsNotNone(failing.error)
+        statistics = server.latency_statistics()
+        self.assertEqual(21, statistics.count)
+        self.assertLessEqual(statistics.p50, statistics.max)
+
+    def test_release_mode(self) -> None:
+        source = "TwoDigitNumber := struct tens:Integer ones:Integer\n" \
+                 "describe:String n:Integer = ifElse (less n 10) \"small\" (concat \"tens: \" (intToStr tens))\n" \
+                 "    tens:Integer = TwoDigitNumber.tens (TwoDigitNumber (divide n 10) (modulo n 10))"
+        debug = Program.from_source(source, RuntimeMode.DEBUG)
+        release = Program.from_source(source, RuntimeMode.RELEASE)
+        for n in [3, 42]:
+            self.assertEqual(debug.call("describe", n), release.call("describe", n))
+        self.assertEqual(PrimitiveExpression("tens: 4"), release.call("describe", 42))
+        self.assertRaises(AssertionError, debug.evaluate, "plus 1 \"x\"")
+        for ill_typed in ['multiply "ab" 3', 'ifElse 1 "a" "b"', 'plus 1 (multiply "ab" 3)']:
+            self.assertRaises(TypeCheckException, release.evaluate, ill_typed)
+        self.assertRaises(TypeCheckException, release.call, "describe", "x")
+        nested = 'main:Integer = f 1\nf:Integer n:Integer = multiply (multiply "ab" 3) n'
+        for mode in [RuntimeMode.DEBUG, RuntimeMode.RELEASE]:
+            self.assertRaises(TypeCheckException, Program.from_source, nested, mode)
+        # Entry expressions are resolved like definition bodies.
+        self.assertEqual(PrimitiveExpression("small"), release.evaluate("3 describe"))
+        self.assertEqual(PrimitiveExpression("small"), debug.evaluate("3 describe"))
+
+    def test_hash_consing(self) -> None:
+        exp, _ = parse_expression(lex(augment("plus (minus n 1) (minus n 1)")))
+        assert isinstance(exp, Call)
+        self.assertIs(exp.operands[0], exp.operands[1])
+        self.assertIsInstance(exp.operands, tuple)
+        self.assertEqual(hash(exp), hash(Call(Variable("plus"), [exp.operands[0], exp.operands[1]])))
+
+    def test_common_subexpression_elimination(self) -> None:
+        source = """
+f:Integer n:Integer = plus (multiply (minus n 1) (minus n 1)) (multiply (minus n 1) (minus n 1))
+g:String = concat (printLine "a") (printLine "a")
+"""
+        user_definitions, type_aliases = parse(lex(augment(source)))
+        definitions = default_environment() | user_definitions
+        check_types(definitions, type_aliases)
+        optimized = eliminate_common_subexpressions(definitions)
+        f = optimized["f"]
+        assert isinstance(f, CompoundFunction) and isinstance(f.body, Let)
+        self.assertEqual(2, len(f.body.bindings))
+        self.assertEqual(definitions["g"], optimized["g"])
+        exp, _ = parse_expression(lex(augment("f 5")))
+        self.assertEqual(PrimitiveExpression(32), evaluate(definitions_to_expressions(optimized), exp))
+        release = Program.from_source(source, RuntimeMode.RELEASE)
+        f = release.optimized_definitions["f"]
+        assert isinstance(f, CompoundFunction) and isinstance(f.body, Let)
+        self.assertEqual(PrimitiveExpression(32), release.call("f", 5))
+        # Each binding is evaluated once, through a call site of its own.
+        sites = [site for site in release.call_site_statistics() if site.definition == "f"]
+        self.assertEqual([1, 1, 1], [site.hits + site.misses for site in sites])
+        debug = Program.from_source(source)
+        self.assertIs(debug.definitions["f"], debug.optimized_definitions["f"])
+        self.assertEqual(release.optimized_definitions["f"], Program.from_source(
+            source, optimizations={Optimization.COMMON_SUBEXPRESSIONS}).optimized_definitions["f"])
+
+    def test_pipeline_fusion(self) -> None:
+        source = """
+IntListElem := struct head:Integer tail:IntList
+IntList := union None | IntListElem
+sum:Integer xs:IntList = foldr plus 0 xs
+foldr:Integer f:(Integer, Integer -> Integer) acc:Integer xs:IntList = ifElse (equal xs none) acc (f (IntListElem.head xs) (foldr f acc (IntListElem.tail xs)))
+map:IntList xs:IntList f:(Integer -> Integer) = ifElse (equal xs none) none (IntListElem (f (IntListElem.head xs)) (map (IntListElem.tail xs) f))
+filter:IntList xs:IntList p:(Integer -> Boolean) = ifElse (equal xs none) none (ifElse (p (IntListElem.head xs)) (IntListElem (IntListElem.head xs) (filter (IntListElem.tail xs) p)) (filter (IntListElem.tail xs) p))
+isOdd:Boolean x:Integer = equal (modulo x 2) 1
+square:Integer x:Integer = multiply x x
+total:Integer = sum (map (filter oneToFour isOdd) square)
+    oneToFour:IntList = IntListElem 1 (IntListElem 2 (IntListElem 3 (IntListElem 4 none)))
+squares:IntList xs:IntList = map (map xs square) square
+"""
+        user_definitions, type_aliases = parse(lex(augment(source)))
+        definitions = default_environment() | user_definitions
+        check_types(definitions, type_aliases)
+        fused, fusions = fuse_pipelines(definitions)
+        self.assertEqual([Fusion("total", ("filter", "map", "sum")), Fusion("squares", ("map", "map"))], fusions)
+        total = fused["total"]
+        assert isinstance(total, Constant)
+        self.assertIsInstance(total.expression, FusedPipeline)
+        for expression in ["total", "squares (IntListElem 2 (IntListElem 3 none))"]:
+            exp, _ = parse_expression(lex(augment(expression)))
+            self.assertEqual(evaluate(definitions_to_expressions(definitions), exp),
+                             evaluate(definitions_to_expressions(fused), exp))
+        debug = Program.from_source(source)
+        release = Program.from_source(source, RuntimeMode.RELEASE)
+        total = release.optimized_definitions["total"]
+        assert isinstance(total, Constant)
+        self.assertIsInstance(total.expression, FusedPipeline)
+        for expression in ["total", "squares (IntListElem 2 (IntListElem 3 none))"]:
+            self.assertEqual(debug.evaluate(expression), release.evaluate(expression))
+        self.assertEqual(PrimitiveExpression(10), release.evaluate("total"))
+
+    def test_nested_union_subtyping(self) -> None:
+        shapes = """
+Circle := struct radius:Integer
+Triangle := struct side:Integer
+Square := struct side:Integer
+Polygon := union Triangle | Square
+Shape := union Circle | Polygon
+describe:String s:Shape = concat "a shape" ""
+applyToPolygon:String f:(Polygon -> String) p:Polygon = f p
+"""
+        user_definitions, type_aliases = parse(lex(augment(shapes + "main:String = applyToPolygon describe (Square 3)")))
+        definitions = default_environment() | user_definitions
+        relations = check_types(definitions, type_aliases)
+        square, polygon, shape, circle = (TypeSignaturePrimitive(CustomPrimitiveType(name))
+                                          for name in ["Square", "Polygon", "Shape", "Circle"])
+        self.assertTrue(relations.is_assignable(square, shape))
+        self.assertFalse(relations.is_assignable(shape, square))
+        self.assertFalse(relations.is_assignable(circle, polygon))
+        self.assertEqual(polygon, relations.join(square, TypeSignaturePrimitive(CustomPrimitiveType("Triangle"))))
+        self.assertEqual(shape, relations.join(square, circle))
+        self.assertTrue(relations.is_assignable(TypeSignatureFunction([shape], square),
+                                                TypeSignatureFunction([square], polygon)))
+        self.assertFalse(relations.is_assignable(TypeSignatureFunction([square], square),
+                                                 TypeSignatureFunction([shape], square)))
+        self.assertEqual(PrimitiveExpression("a shape"), evaluate_main(definitions))
+        user_definitions, type_aliases = parse(lex(augment(shapes + "main:String = applyToPolygon describe (Circle 3)")))
+        self.assertRaises(TypeCheckException, check_types, default_environment() | user_definitions, type_aliases)
+
+    def test_inline_caches(self) -> None:
+        source = """
+IntListElem := struct head:Integer tail:IntList
+IntList := union None | IntListElem
+foldr:Integer f:(Integer, Integer -> Integer) acc:Integer xs:IntList = ifElse (equal xs none) acc (f (IntListElem.head xs) (foldr f acc (IntListElem.tail xs)))
+numbers:IntList = IntListElem 1 (IntListElem 2 (IntListElem 3 (IntListElem 4 none)))
+first:Integer a:Integer b:Integer = a
+second:Integer a:Integer b:Integer = b
+larger:Integer a:Integer b:Integer = ifElse (greater a b) a b
+"""
+        program = Program.from_source(source)
+        functions = ["plus", "multiply", "minus", "first", "second", "larger"]
+        expected = [11, 24, -1, 1, 1, 4]
+        for _ in range(2):
+            for function, result in zip(functions, expected):
+                self.assertEqual(PrimitiveExpression(result), program.evaluate(f"foldr {function} 1 numbers"))
+                with inline_caching(False):
+                    self.assertEqual(PrimitiveExpression(result), program.evaluate(f"foldr {function} 1 numbers"))
+        site = next(s for s in program.call_site_statistics()
+                    if s.definition == "foldr" and s.call.operator == Variable("f"))
+        self.assertEqual(MAX_INLINE_CACHE_TARGETS, site.targets)
+        self.assertEqual(2 * len(functions) * 4, site.hits + site.misses)
+        self.assertEqual(2 * 4 * 4 - 4, site.hits)
+        fresh = Program.from_source(source)
+        self.assertEqual(PrimitiveExpression(11), fresh.evaluate("foldr plus 1 numbers"))
+        site = next(s for s in fresh.call_site_statistics()
+                    if s.definition == "foldr" and s.call.operator == Variable("f"))
+        self.assertEqual((1, 3, 1), (site.targets, site.hits, site.misses))
+        site = next(s for s in fresh.call_site_statistics()
+                    if s.definition == "foldr" and s.call.operator == Variable("foldr"))
+        self.assertEqual((1, 3, 1), (site.targets, site.hits, site.misses))
+
+    def test_inlining(self) -> None:
+        source = """
+square:Integer x:Integer = multiply x x
+add:Integer a:Integer b:Integer = plus a b
+norm:Integer x:Integer y:Integer = add (square x) (square y)
+twice:String s:String = concat s s
+shout:String = twice (printLine "hey")
+squareOfSum:Integer = square (plus 1 2)
+curried:Integer = (add 1) 2
+fib:Integer n:Integer = ifElse (less n 2) n (plus (fib (minus n 1)) (fib (minus n 2)))
+"""
+        user_definitions, type_aliases = parse(lex(augment(source)))
+        definitions = default_environment() | user_definitions
+        check_types(definitions, type_aliases)
+        inlined, decisions = inline_functions(definitions)
+        self.assertIn(InliningDecision("norm", "square", InliningOutcome.INLINED), decisions)
+        self.assertIn(InliningDecision("shout", "twice", InliningOutcome.UNSAFE_ARGUMENT), decisions)
+        self.assertIn(InliningDecision("squareOfSum", "square", InliningOutcome.UNSAFE_ARGUMENT), decisions)
+        self.assertIn(InliningDecision("fib", "fib", InliningOutcome.RECURSIVE), decisions)
+        norm = inlined["norm"]
+        assert isinstance(norm, CompoundFunction)
+        self.assertEqual(parse_expression(lex(augment("plus (multiply x x) (multiply y y)")))[0], norm.body)
+        curried = inlined["curried"]
+        assert isinstance(curried, Constant)
+        self.assertEqual(parse_expression(lex(augment("plus 1 2")))[0], curried.expression)
+        for expression in ["norm 3 4", "squareOfSum", "fib 10"]:
+            exp, _ = parse_expression(lex(augment(expression)))
+            self.assertEqual(evaluate(definitions_to_expressions(definitions), exp),
+                             evaluate(definitions_to_expressions(inlined), exp))
+        self.assertEqual(PrimitiveExpression(3), evaluate(definitions_to_expressions(inlined), Variable("curried")))
+        _, decisions = inline_functions(definitions, size_threshold=2)
+        self.assertIn(InliningDecision("norm", "square", InliningOutcome.TOO_LARGE), decisions)
+        release = Program.from_source(source, RuntimeMode.RELEASE)
+        norm = release.optimized_definitions["norm"]
+        assert isinstance(norm, CompoundFunction)
+        self.assertEqual(parse_source_expression("plus (multiply x x) (multiply y y)"), norm.body)
+        self.assertEqual(PrimitiveExpression(25), release.call("norm", 3, 4))
+        # Every call of an inlined body has a call site and cache of its own.
+        self.assertEqual([1, 1, 1], [site.hits + site.misses for site in release.call_site_statistics()
+                                     if site.definition == "norm"])
+        # A function parameter named square can stand for square wherever it is called, so no pass resolves it.
+        shadowed = Program.from_source(SHADOWED_FUNCTION_SOURCE, RuntimeMode.RELEASE)
+        self.assertEqual(shadowed.definitions["norm"], shadowed.optimized_definitions["norm"])
+        self.assertEqual(shadowed.definitions["twice"], shadowed.optimized_definitions["twice"])
+        self.assertEqual(shadowed.definitions["total"], shadowed.optimized_definitions["total"])
+        self.assertEqual(PrimitiveExpression(9), shadowed.evaluate("applyNorm (plus 1)"))
+
+    def test_tree_shaking(self) -> None:
+        source = """
+main:Integer = Point.x origin
+    origin:Point = shifted 0
+Point := struct x:Integer y:Integer
+shifted:Point offset:Integer = Point (plus offset 1) (plus offset 2)
+unused:Integer = alsoUnused 1
+alsoUnused:Integer x:Integer = plus x true
+"""
+        definitions, type_aliases = parse(lex(augment(source)))
+        reachable, dropped = shake_tree(default_environment() | definitions)
+        self.assertEqual({"main", "Point.x", "shifted", "Point", "plus"}, set(reachable))
+        self.assertIn("unused", dropped)
+        self.assertIn("Point.y", dropped)
+        self.assertEqual(PrimitiveExpression(1), evaluate_main(definitions))
+        self.assertRaises(TypeCheckException, Program.from_source, source)
+        program = Program.from_source(source, entry_points=["main"])
+        self.assertIn("alsoUnused", program.dropped_definitions)
+        self.assertEqual(PrimitiveExpression(1), program.call("main"))
+        self.assertRaises(KeyError, program.call, "unused")
+        self.assertRaises(KeyError, shake_tree, definitions, ["missing"])
+
+    def test_prelude_snapshot(self) -> None:
+        import compiler
+        self.assertEqual({"augment", "interpret", "lex", "parse", "Program"}, set(compiler.__all__))
+        self.assertIs(Program, compiler.Program)
+        environment = default_environment()
+        environment["plus"] = environment["minus"]
+        self.assertIsNot(PRELUDE["plus"], environment["plus"])
+        definitions, _ = parse(lex(augment("main:Integer = plus 1 2")))
+        expressions = definitions_to_expressions(default_environment() | definitions)
+        self.assertIs(PRELUDE_EXPRESSIONS["plus"], expressions["plus"])
+        self.assertEqual(PrimitiveExpression(3), evaluate(expressions, Variable("main")))
+
+    def test_closure_captures(self) -> None:
+        source = """
+adder:(Integer -> Integer) n:Integer = add
+    add:Integer x:Integer = plus (twice x) n
+twice:Integer x:Integer = multiply x 2
+unrelated:Integer = 42
+"""
+        user_definitions, type_aliases = parse(lex(augment(source)))
+        definitions = default_environment() | user_definitions
+        check_types(definitions, type_aliases)
+        add = definitions["adder"].sub_definitions["add"]
+        self.assertEqual({"plus", "twice", "n"}, free_variables(add))
+        self.assertEqual({"plus", "twice"}, free_variables(definitions["adder"]))
+        self.assertEqual(("multiply", "n", "plus", "twice"), closure_captures(definitions)[id(add)])
+        env = definitions_to_expressions(definitions)
+        closure = evaluate(env, Call(Variable("adder"), [PrimitiveExpression(1)]))
+        assert isinstance(closure, CompoundClosure)
+        self.assertEqual({"multiply", "n", "plus", "twice"}, set(closure.environment))
+        self.assertEqual(PrimitiveExpression(5),
+                         evaluate(env | {"f": closure}, Call(Variable("f"), [PrimitiveExpression(2)])))
+
+    def test_fixed_width_numbers(self) -> None:
+        self.assertEqual([FloatConstant(2.5), IntegerConstant(3), Name("Point.x")], lex("2.5 3 Point.x"))
+        source = """
+wrapped:Int64 = plusInt64 (int64 9223372036854775807) (int64 1)
+quotient:Int64 = divideInt64 (minusInt64 (int64 0) (int64 7)) (int64 2)
+infinite:Float64 = divideFloat64 1.5 0.0
+saturated:Int64 = float64ToInt64 infinite
+total:Int64 = int64ArraySum (int64ArraySet (int64ArrayRange (int64 0) (int64 100)) 0 (int64 50))
+dot:Float64 = float64ArrayDot (float64ArrayFill 3 0.5) ints
+    ints:Float64Array = int64ArrayToFloat64Array (int64ArrayRange (int64 1) (int64 4))
+"""
+        for mode in RuntimeMode:
+            program = Program.from_source(source, mode)
+            self.assertEqual(PrimitiveExpression(-2 ** 63), program.call("wrapped"))
+            self.assertEqual(PrimitiveExpression(-3), program.call("quotient"))
+            self.assertEqual(PrimitiveExpression(float("inf")), program.call("infinite"))
+            self.assertEqual(PrimitiveExpression(2 ** 63 - 1), program.call("saturated"))
+            self.assertEqual(PrimitiveExpression(5000), program.call("total"))
+            self.assertEqual(PrimitiveExpression(3.0), program.call("dot"))
+        self.assertRaises(IndexError, Program.from_source(source).evaluate,
+                          "int64ArrayGet (int64ArrayFill 2 (int64 0)) 2")
+        self.assertRaises(TypeCheckException, Program.from_source, "main:Int64 = plusInt64 1 (int64 2)")
+        self.assertRaises(TypeCheckException, Program.from_source, "main:Integer = plus 1.5 2")
+
+    def test_arrays(self) -> None:
+        source = """
+tailrec pushAll:Array xs:Array n:Integer = ifElse (less n 1) xs (pushAll (arrayPush xs (int64 n)) (minus n 1))
+bump:Array xs:Array i:Integer = arraySet xs i (plusInt64 (int64 1) (arrayGet xs i))
+Holder := struct items:Array
+holder:Holder = Holder (pushAll (arrayFill 0 (int64 0)) 3)
+main:Int64 = plusInt64 (arraySum (arrayPush (Holder.items holder) (int64 4))) (arraySum (Holder.items holder))
+"""
+        for mode in RuntimeMode:
+            program = Program.from_source(source, mode)
+            self.assertEqual(PrimitiveExpression(ArrayValue(array("q", [7, 7, 2, 1]))),
+                             program.evaluate("pushAll (arrayFill 2 (int64 7)) 2"))
+            self.assertEqual(PrimitiveExpression(16), program.call("main"))
+            owned = ArrayValue(array("q", [1, 2]))
+            self.assertIs(owned, cast(PrimitiveExpression, program.call("bump", PrimitiveExpression(owned), 0)).value)
+            self.assertEqual(array("q", [2, 2]), owned.elements)
+            shared = ArrayValue(array("q", [1, 2]), shared=True)
+            self.assertEqual(PrimitiveExpression(ArrayValue(array("q", [1, 3]))),
+                             program.call("bump", PrimitiveExpression(shared), 1))
+            self.assertEqual(array("q", [1, 2]), shared.elements)
+            self.assertEqual(PrimitiveExpression(ArrayValue(array("q", [1, -2 ** 63]))),
+                             program.evaluate("arrayPush (arrayFill 1 (int64 1)) (int64 9223372036854775808)"))
+        self.assertRaises(TypeCheckException, Program.from_source(source, RuntimeMode.RELEASE).evaluate,
+                          "arrayPush (arrayFill 2 1) 9223372036854775808")
+        self.assertRaises(IndexError, Program.from_source(source).evaluate, "arrayGet (arrayFill 2 (int64 0)) 2")
+        for consuming_twice in ["f:Array xs:Array = arraySet (arrayPush xs (int64 1)) 0 (arrayGet xs 0)",
+                                "f:Int64 xs:Array = plusInt64 (arraySum (arrayPush xs (int64 1))) "
+                                "(arraySum (arrayPush xs (int64 2)))",
+                                "f:Array xs:Array = ifElse (lessInt64 (arraySum (bump xs 0)) (int64 1)) xs "
+                                "(arrayFill 1 (int64 0))\n"
+                                "bump:Array xs:Array i:Integer = arraySet xs i (int64 1)",
+                                "f:Array xs:Array = g (int64 1)\n    g:Array n:Int64 = arrayPush xs n"]:
+            self.assertRaises(TypeCheckException, Program.from_source, consuming_twice)
+        Program.from_source("f:Array xs:Array = ifElse (less (arrayLength xs) 1) (arrayPush xs (int64 1)) "
+                            "(arraySet xs 0 (int64 2))")
+
+    def test_streams(self) -> None:
+        source = """
+isEven:Boolean line:String = equal (modulo (strToInt line) 2) 0
+addLine:Integer total:Integer line:String = plus total (strToInt line)
+double:String line:String = intToStr (multiply 2 (strToInt line))
+one:Integer text:String = 1
+loud:Boolean line:String = equal (one (printLine (concat "a" line))) 1
+count:Integer total:Integer line:String = plus total (one (printLine (concat "b" line)))
+evenTotal:Integer path:String = streamFold addLine 0 (streamMap double (streamFilter isEven (readLines path)))
+twice:Integer path:String = plus (streamFold addLine 0 lines) (streamFold addLine 0 lines)
+    lines:Stream = readLines path
+printed:Integer path:String = streamFold count 0 (streamTake 2 (streamFilter loud (readLines path)))
+unused:Integer = ignore (readLines "missing.txt")
+    ignore:Integer lines:Stream = 0
+taken:Stream path:String = streamTake 2 (readLines path)
+"""
+        with tempfile.TemporaryDirectory() as directory:
+            # Lines cross the boundaries of the chunks the file is read in, and the last one has no newline.
+            path = str(Path(directory) / "numbers.txt")
+            Path(path).write_text("\n".join(str(i) for i in range(1, 15001)))
+            for mode in RuntimeMode:
+                program = Program.from_source(source, mode)
+                self.assertEqual(PrimitiveExpression(112515000), program.call("evenTotal", path))
+                self.assertEqual(PrimitiveExpression(225015000), program.call("twice", path))
+                self.assertEqual(PrimitiveExpression(0), program.call("unused"))
+                # Elements are produced on demand and pass through all stages one after the other.
+                output = io.StringIO()
+                with redirect_stdout(output):
+                    self.assertEqual(PrimitiveExpression(2), program.call("printed", path))
+                self.assertEqual("a1\nb1\na2\nb2\n", output.getvalue())
+                # A partial take closes the file as soon as it stops, not when the traversal is collected.
+                opened: List[IO[Any]] = []
+
+                def recording_open(*args: Any, real_open: Callable[..., IO[Any]] = open) -> IO[Any]:
+                    opened.append(real_open(*args))
+                    return opened[-1]
+
+                with patch("builtins.open", side_effect=recording_open):
+                    taken = program.call("taken", path)
+                    assert isinstance(taken, PrimitiveExpression) and isinstance(taken.value, StreamValue)
+                    elements = taken.value.traverse()
+                    self.assertEqual(PrimitiveExpression("1"), next(elements))
+                    self.assertFalse(opened[0].closed)
+                    self.assertEqual(PrimitiveExpression("2"), next(elements))
+                    self.assertTrue(opened[0].closed)
+                    self.assertEqual([], list(elements))
+                self.assertEqual(1, len(opened))
+
+    def test_ropes(self) -> None:
+        text: Text = ""
+        for i in range(100000):
+            text = concat_texts(text, str(i % 10))
+        self.assertIsInstance(text, Rope)
+        self.assertEqual("0123456789" * 10000, text)
+        self.assertEqual("0123456789" * 10000, str(text))
+        self.assertEqual("ab", concat_texts("a", "b"))
+        source = """
+repeated:String piece:String n:Integer = ifElse (equal n 0) "" (concat (repeated piece (minus n 1)) piece)
+"""
+        program = Program.from_source(source)
+        piece = "x" * ROPE_CHUNK_SIZE
+        repeated = program.call("repeated", piece, 3)
+        assert isinstance(repeated, PrimitiveExpression)
+        self.assertIsInstance(repeated.value, Rope)
+        self.assertEqual(PrimitiveExpression(piece * 3), repeated)
+        self.assertEqual(PrimitiveExpression(True), program.evaluate(f'equal (repeated "{piece}" 3) '
+                                                                     f'(concat (repeated "{piece}" 2) "{piece}")'))
+
+    def test_hash_tries(self) -> None:
+        entries = HashTrie()
+        versions = []
+        for i in range(3000):
+            versions.append(entries)
+            entries = entries.insert(str(i % 2000), i)
+        self.assertEqual(2000, len(entries))
+        leaf = entries.lookup("999")
+        self.assertEqual(2999, None if leaf is None else leaf.value)
+        self.assertIsNone(versions[500].lookup("500"))
+        self.assertEqual({str(i): i for i in range(1000)}, dict(versions[1000].items()))
+        for i in range(0, 2000, 2):
+            entries = entries.remove(str(i))
+        self.assertEqual(1000, len(entries))
+        self.assertIs(entries, entries.remove("missing"))
+        self.assertEqual({str(i): i + 2000 if i < 1000 else i for i in range(1, 2000, 2)}, dict(entries.items()))
+        source = """
+counts:Map = mapInsert (mapInsert (mapInsert mapEmpty "a" 1) "b" 2) "a" 3
+total:Integer = mapFold add 0 counts
+    add:Integer acc:Integer key:String value:Integer = plus acc value
+"""
+        program = Program.from_source(source)
+        self.assertEqual(PrimitiveExpression(5), program.call("total"))
+        self.assertEqual(PrimitiveExpression(3), program.evaluate('mapLookup counts "a" 0'))
+        self.assertEqual(PrimitiveExpression(0), program.evaluate('mapLookup (mapRemove counts "a") "a" 0'))
+        self.assertEqual(PrimitiveExpression(2), program.evaluate("mapSize counts"))
+        self.assertRaises(TypeCheckException, Program.from_source, 'main:Map = mapInsert mapEmpty 1 "a"')
+
+    def test_tail_recursion(self) -> None:
+        source = """
+tailrec sumTo:Integer acc:Integer n:Integer = ifElse (equal n 0) acc (sumTo (plus acc n) (minus n 1))
+tailrec collatz:Integer steps:Integer n:Integer = ifElse (equal n 1) steps (ifElse (equal (modulo n 2) 0) (collatz (plus steps 1) (divide n 2)) (collatz (plus steps 1) (plus (multiply 3 n) 1)))
+"""
+        for mode in RuntimeMode:
+            program = Program.from_source(source, mode)
+            self.assertEqual(PrimitiveExpression(20000 * 20001 // 2), program.call("sumTo", 0, 20000))
+            self.assertEqual(PrimitiveExpression(111), program.call("collatz", 0, 27))
+        self.assertRaises(TypeCheckException, Program.from_source,
+                          "tailrec f:Integer n:Integer = ifElse (equal n 0) 0 (plus 1 (f (minus n 1)))")
+        self.assertRaises(TypeCheckException, Program.from_source,
+                          "tailrec f:Integer n:Integer = ifElse (equal n 0) 0 next\n    next:Integer = f (minus n 1)")
+
+    def test_partial_application(self) -> None:
+        source = """
+add3:Integer a:Integer b:Integer c:Integer = plus a (plus b c)
+twice:Integer f:(Integer -> Integer) x:Integer = f (f x)
+increment:(Integer -> Integer) = plus 1
+adder:(Integer -> Integer) n:Integer = plus n
+curried:Integer = (add3 1) 2 3
+nested:Integer = ((add3 1) 2) 3
+applied:Integer = twice (add3 1 2) 4
+overSaturated:Integer = adder 40 2
+"""
+        for mode in RuntimeMode:
+            program = Program.from_source(source, mode)
+            self.assertEqual(PrimitiveExpression(6), program.call("curried"))
+            self.assertEqual(PrimitiveExpression(6), program.call("nested"))
+            self.assertEqual(PrimitiveExpression(10), program.call("applied"))
+            self.assertEqual(PrimitiveExpression(42), program.call("overSaturated"))
+            self.assertEqual(PrimitiveExpression(6), program.call("increment", 5))
+        partial_application = Program.from_source(source).evaluate("add3 1 2")
+        assert isinstance(partial_application, PartialApplication)
+        self.assertEqual((PrimitiveExpression(1), PrimitiveExpression(2)), partial_application.arguments)
+        self.assertRaises(TypeCheckException, Program.from_source, "f:Integer x:Integer = plus x")
+        self.assertRaises(TypeCheckException, Program.from_source, "f:Integer = plus 1 2 3")
+
+    def test_ubiquefix(self) -> None:
+        source = """
+IntListElem := struct head:Integer tail:IntList
+IntList := union None | IntListElem
+map:IntList xs:IntList f:(Integer -> Integer) = ifElse (equal xs none) none (IntListElem (f (IntListElem.head xs)) (map (IntListElem.tail xs) f))
+sum:Integer xs:IntList = ifElse (equal xs none) 0 (plus (IntListElem.head xs) (sum (IntListElem.tail xs)))
+square:Integer x:Integer = multiply x x
+input:IntList = IntListElem 1 (IntListElem 2 (IntListElem 3 none))
+result:Integer = input map square map (plus 1) sum
+difference:Integer = 10 minus 3
+"""
+        user_definitions, type_aliases = parse(lex(augment(source)))
+        definitions, ambiguities = transform_ubiquefix(default_environment() | user_definitions, type_aliases)
+        self.assertEqual(parse_source_expression("sum (map (map input square) (plus 1))"),
+                         cast(Constant, definitions["result"]).expression)
+        self.assertIs(user_definitions["map"], definitions["map"])
+        self.assertEqual([Ambiguity("difference", 2, (parse_source_expression("minus 10 3"),
+                                                      parse_source_expression("minus 3 10")))], ambiguities)
+        program = Program(user_definitions, type_aliases)
+        self.assertEqual(PrimitiveExpression(17), program.call("result"))
+        self.assertEqual(PrimitiveExpression(7), program.call("difference"))
+
+    def test_modules(self) -> None:
+        with tempfile.TemporaryDirectory() as directory:
+            source_dir = Path(directory) / "source"
+            cache_dir = Path(directory) / "cache"
+            source_dir.mkdir()
+            (source_dir / f"lists{MODULE_SUFFIX}").write_text("""
+IntListElem := struct head:Integer tail:IntList
+IntList := union None | IntListElem
+sum:Integer xs:IntList = ifElse (equal xs none) 0 (plus (IntListElem.head xs) (sum (IntListElem.tail xs)))
+""")
+            (source_dir / f"squares{MODULE_SUFFIX}").write_text("square:Integer x:Integer = multiply x x")
+            (source_dir / f"main{MODULE_SUFFIX}").write_text("""
+import lists
+import squares
+main:Integer = sum (IntListElem (square 3) (IntListElem 4 none))
+""")
+            compiled = dict.fromkeys(["lists", "squares", "main"], ModuleStatus.COMPILED)
+            self.assertEqual(compiled, build_modules(source_dir, cache_dir, ["main"], workers=1))
+            self.assertEqual(dict.fromkeys(compiled, ModuleStatus.UP_TO_DATE),
+                             build_modules(source_dir, cache_dir, ["main"], workers=1))
+            self.assertEqual(PrimitiveExpression(13), load_program(cache_dir, "main").call("main"))
+            interface = read_interface(cache_dir / f"lists{INTERFACE_SUFFIX}")
+            self.assertEqual([("head", TypeSignaturePrimitive(BuiltInPrimitiveType.INTEGER)),
+                              ("tail", TypeSignaturePrimitive(CustomPrimitiveType("IntList")))],
+                             interface.structs["IntListElem"])
+            # Only the body changed, so the interface and thus the importer stay the same.
+            (source_dir / f"squares{MODULE_SUFFIX}").write_text("square:Integer x:Integer = multiply x (plus x 1)")
+            self.assertEqual({"lists": ModuleStatus.UP_TO_DATE, "squares": ModuleStatus.COMPILED,
+                              "main": ModuleStatus.UP_TO_DATE}, build_modules(source_dir, cache_dir, ["main"]))
+            self.assertEqual(PrimitiveExpression(16), load_program(cache_dir, "main").call("main"))
+            (source_dir / f"squares{MODULE_SUFFIX}").write_text("square:Integer x:Integer y:Integer = multiply x y")
+            (source_dir / f"main{MODULE_SUFFIX}").write_text("import squares\nmain:Integer = square 3")
+            self.assertRaises(TypeCheckException, build_modules, source_dir, cache_dir, ["main"], 1)
+
+    def test_match(self) -> None:
+        source = """
+IntListElem := struct head:Integer tail:IntList
+IntList := union None | IntListElem
+Circle := struct radius:Integer
+Rectangle := struct width:Integer height:Integer
+Shape := union Circle | Rectangle | Integer
+sum:Integer xs:IntList = match xs | None -> 0 | IntListElem x -> plus (IntListElem.head x) (sum (IntListElem.tail x))
+tailrec count:Integer acc:Integer xs:IntList = match xs | None -> acc | IntListElem x -> count (plus acc 1) (IntListElem.tail x)
+area:Integer s:Shape = match s | Rectangle r -> multiply (Rectangle.width r) (Rectangle.height r) | Circle c -> multiply 3 (square (Circle.radius c)) | Integer -> 0
+square:Integer x:Integer = multiply x x
+xs:IntList = IntListElem 1 (IntListElem 2 (IntListElem 3 none))
+main:Integer = plus (sum xs) (plus (count 0 xs) (plus (area (Rectangle 2 5)) (plus (area (Circle 2)) (area 7))))
+"""
+        for mode in RuntimeMode:
+            self.assertEqual(PrimitiveExpression(6 + 3 + 10 + 12), Program.from_source(source, mode).call("main"))
+        match = parse_source_expression("match xs | None -> 0 | IntListElem x -> 1")
+        self.assertIsInstance(match, Match)
+        self.assertEqual(match, pickle.loads(pickle.dumps(match)))
+        declarations = source.split("sum:")[0]
+        for body in ["match s | Circle -> 1 | Integer -> 2",
+                     "match s | Circle -> 1 | Rectangle -> 2 | Integer -> 3 | Circle -> 4",
+                     "match s | Circle -> 1 | Rectangle -> 2 | Integer -> 3 | None -> 4",
+                     "match s | Circle -> 1 | Rectangle -> true | Integer -> 3"]:
+            self.assertRaises(TypeCheckException, Program.from_source, declarations + f"f:Integer s:Shape = {body}")
+
+    def test_unboxed(self) -> None:
+        source = """
+IntListElem := struct head:Integer tail:IntList
+IntList := union None | IntListElem
+Circle := struct radius:Integer
+Shape := union Circle | Integer
+Op := struct run:(Integer -> Integer)
+range:IntList n:Integer = ifElse (equal n 0) none (IntListElem n (range (minus n 1)))
+sum:Integer xs:IntList = match xs | None -> 0 | IntListElem x -> plus (IntListElem.head x) (sum (IntListElem.tail x))
+shape:Shape n:Integer = ifElse (less n 0) (Circle (minus 0 n)) n
+size:Integer s:Shape = match s | Circle c -> Circle.radius c | Integer n -> multiply 10 n
+total:Integer = mapFold add 0 (mapInsert (mapInsert mapEmpty "a" 1) "b" 2)
+    add:Integer acc:Integer key:String value:Integer = plus acc value
+twice:Integer = Op.run op (Op.run op 1)
+    op:Op = Op (plus 20)
+"""
+        release = Program.from_source(source, RuntimeMode.RELEASE)
+        program = Program.from_source(source, RuntimeMode.UNBOXED)
+        for expression in ["sum (range 100)", "size (shape 4)", "size (shape (minus 0 3))", "shape (minus 0 3)",
+                           "range 2", "total", "twice"]:
+            self.assertEqual(release.evaluate(expression), program.evaluate(expression))
+        self.assertEqual(PrimitiveExpression(5050), program.call("sum", program.evaluate("range 100")))
+        # Only the public result is boxed, including function values, which the boxed evaluator can apply.
+        self.assertEqual(PrimitiveExpression(3), apply(program.evaluate("plus 1"), [PrimitiveExpression(2)]))
+        unboxed = UnboxedProgram(dict(program.definitions), program.type_relations)
+        code, type_sig = unboxed.compile(parse_source_expression("size (shape 4)"), unboxed.scope, None)
+        self.assertEqual(TypeSignaturePrimitive(BuiltInPrimitiveType.INTEGER), type_sig)
+        self.assertIs(int, type(code({})))
+        self.assertEqual(PrimitiveExpression(4), unboxed.compile(parse_source_expression("shape 4"), unboxed.scope,
+                                                                 None)[0]({}))
+
+    def test_runtime_modes_agree(self) -> None:
+        for source, expressions in MODE_INDEPENDENT_PROGRAMS:
+            programs = [Program.from_source(source, mode) for mode in RuntimeMode]
+            for expression in expressions:
+                results = [program.evaluate(expression) for program in programs]
+                self.assertEqual([results[0]] * len(programs), results, expression)
+        program = Program.from_source(DYNAMIC_SCOPE_SOURCE, RuntimeMode.UNBOXED)
+        self.assertEqual(PrimitiveExpression(110), program.evaluate("f 100"))
+        self.assertEqual(PrimitiveExpression(15), program.evaluate("match 5 | Integer step -> addStep 10"))
+        self.assertRaises(TypeCheckException, program.evaluate, 'multiply "ab" 3')
+        # Unboxed code calls operator.mul for multiply, so ill-typed nested calls must not get past construction.
+        nested = 'main:Integer = f 1\nf:Integer n:Integer = multiply (multiply "ab" 3) n'
+        for mode in RuntimeMode:
+            self.assertRaises(TypeCheckException, Program.from_source, nested, mode)
+
+    def test_generated_programs(self) -> None:
+        settings = GeneratorSettings(definitions=12, sub_definition_depth=2, structs=3, recursion_depth=20)
+        self.assertEqual(generate_program(settings, 1), generate_program(settings, 1))
+        self.assertNotEqual(generate_program(settings, 1), generate_program(settings, 2))
+        for seed in range(3):
+            source = generate_program(settings, seed)
+            self.assertEqual(1, len({Program.from_source(source, mode).call("main") for mode in RuntimeMode}))
+        for _, knob_settings, _ in KNOB_SCALINGS:
+            for size in [1, 8]:
+                source = generate_program(knob_settings(size))
+                self.assertEqual(1, len({Program.from_source(source, mode).call("main") for mode in RuntimeMode}))
+        self.assertAlmostEqual(2.0, growth_exponent([1, 2, 4], [1.0, 4.0, 16.0]))
+        self.assertRaises(RuntimeError, check_scaling, [StageScaling(Stage.LEX, [1, 2], [1.0, 4.0], 2.0, 1.0)])
+        check_scaling([StageScaling(Stage.LEX, [1, 2], [1.0, 2.2], 1.14, 1.0)])
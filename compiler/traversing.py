@@ -0,0 +1,37 @@
+from typing import Dict, Tuple, Iterator, FrozenSet
+
+from .expressions import Expression, Call, Definition, Constant, CompoundFunction, Match
+from .type_signatures import TypeSignatureFunction
+
+
+def sub_expressions(exp: Expression) -> Iterator[Expression]:
+    yield exp
+    if isinstance(exp, Call):
+        yield from sub_expressions(exp.operator)
+        for operand in exp.operands:
+            yield from sub_expressions(operand)
+    if isinstance(exp, Match):
+        yield from sub_expressions(exp.scrutinee)
+        for case in exp.cases:
+            yield from sub_expressions(case.body)
+
+
+def definition_expressions(d: Definition) -> Iterator[Expression]:
+    if isinstance(d, Constant):
+        yield d.expression
+    if isinstance(d, CompoundFunction):
+        yield d.body
+
+
+# Only parameters of function type can be called, so only those can make a definition impure.
+def callable_parameters(d: CompoundFunction) -> FrozenSet[str]:
+    return frozenset(name for name, type_sig in zip(d.parameters, d.type_sig.params)
+                     if isinstance(type_sig, TypeSignatureFunction))
+
+
+def flatten_definitions(definitions: Dict[str, Definition], parameters: FrozenSet[str]) -> Iterator[
+        Tuple[str, Definition, FrozenSet[str]]]:
+    for name, d in definitions.items():
+        scope_parameters = parameters | callable_parameters(d) if isinstance(d, CompoundFunction) else parameters
+        yield name, d, scope_parameters
+        yield from flatten_definitions(d.sub_definitions, scope_parameters)
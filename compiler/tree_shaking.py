@@ -0,0 +1,65 @@
+from typing import Dict, List, Set, Tuple, Iterable, Iterator
+
+from .expressions import Expression, Call, Variable, Definition, Constant, CompoundFunction, Let, FusedPipeline, \
+    Match
+
+
+def referenced_names(exp: Expression) -> Iterator[str]:
+    if isinstance(exp, Variable):
+        yield exp.name
+    if isinstance(exp, Call):
+        yield from referenced_names(exp.operator)
+        for operand in exp.operands:
+            yield from referenced_names(operand)
+    if isinstance(exp, Let):
+        for _, bound in exp.bindings:
+            yield from referenced_names(bound)
+        yield from referenced_names(exp.body)
+    if isinstance(exp, Match):
+        yield from referenced_names(exp.scrutinee)
+        for case in exp.cases:
+            yield from referenced_names(case.body)
+    if isinstance(exp, FusedPipeline):
+        yield from [exp.cons, exp.head, exp.tail]
+        yield from referenced_names(exp.source)
+        for stage in exp.stages:
+            yield from referenced_names(stage.function)
+        if exp.fold is not None:
+            yield from referenced_names(exp.fold[0])
+            yield from referenced_names(exp.fold[1])
+
+
+# Includes the names referenced by sub-definitions, since those are only reachable through their parent.
+def definition_references(d: Definition) -> Set[str]:
+    names: Set[str] = set()
+    if isinstance(d, Constant):
+        names.update(referenced_names(d.expression))
+    if isinstance(d, CompoundFunction):
+        names.update(referenced_names(d.body))
+    for sub_definition in d.sub_definitions.values():
+        names |= definition_references(sub_definition)
+    return names
+
+
+def reachable_definitions(definitions: Dict[str, Definition], entry_points: Iterable[str]) -> Set[str]:
+    reachable: Set[str] = set()
+    pending = list(entry_points)
+    for name in pending:
+        if name not in definitions:
+            raise KeyError(f"Unknown entry point: {name}")
+    while len(pending) > 0:
+        name = pending.pop()
+        if name in reachable or name not in definitions:
+            continue
+        reachable.add(name)
+        pending.extend(definition_references(definitions[name]))
+    return reachable
+
+
+# Names are resolved conservatively: a reference keeps the top-level definition of that name alive even if it
+# actually resolves to a local one. Returns the remaining definitions and the names of the dropped ones.
+def shake_tree(definitions: Dict[str, Definition], entry_points: Iterable[str] = ("main",)) \
+        -> Tuple[Dict[str, Definition], List[str]]:
+    reachable = reachable_definitions(definitions, entry_points)
+    return {name: d for name, d in definitions.items() if name in reachable}, \
+        [name for name in definitions if name not in reachable]
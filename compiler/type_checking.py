@@ -1,8 +1,13 @@
-from functools import partial
-from typing import Dict, Set, List
+import operator
+from collections import ChainMap
+from functools import partial, reduce
+from itertools import chain
+from typing import Dict, Set, List, Iterable, Optional, Iterator, Tuple, MutableMapping, FrozenSet
 
 from .expressions import Call, Variable, PrimitiveExpression, CompoundFunction, Constant, Definition, PrimitiveFunction, \
-    Expression
+    Expression, Let, Match, TypeTag, type_tag, tag_type, value_tag
+from .traversing import flatten_definitions
+from .tree_shaking import referenced_names, definition_references
 from .type_signatures import TypeSignatureFunction, TypeSignaturePrimitive, TypeSignature, BuiltInPrimitiveType
 
 
@@ -15,74 +20,212 @@ def type_assert(condition: bool, error_msg: str) -> None:
         raise TypeCheckException(error_msg)
 
 
-def assert_types_are_the_same(
-        type_aliases: Dict[TypeSignaturePrimitive, Set[TypeSignaturePrimitive]],
-        a: TypeSignature, b: TypeSignature,
-        error_msg: str) -> None:
-    if isinstance(a, TypeSignaturePrimitive) and isinstance(b, TypeSignaturePrimitive):
-        a_plain = type_aliases.get(a, {a})
-        b_plain = type_aliases.get(b, {b})
-        if len(a_plain) > 1 and len(b_plain) > 1:
-            type_assert(a_plain == b_plain, error_msg)
-        elif len(a_plain) == 1 and len(b_plain) == 1:
-            type_assert(a == b, error_msg)
-        elif len(a_plain) == 1:
-            single_a = next(iter(a_plain))
-            assert isinstance(single_a, TypeSignaturePrimitive)
-            type_assert(single_a in b_plain, error_msg)
-        elif len(b_plain) == 1:
-            single_b = next(iter(b_plain))
-            assert isinstance(single_b, TypeSignaturePrimitive)
-            type_assert(single_b in a_plain, error_msg)
-        else:
-            assert False
-    else:
-        type_assert(a == b, error_msg)
+TypeAliases = Dict[TypeSignaturePrimitive, Set[TypeSignaturePrimitive]]
+
+# The definitions visible in a scope, including the parameters in scope as stubs that only carry their types.
+Scope = MutableMapping[str, Definition]
+
+
+# Every primitive type gets an integer ID. supertypes[i] is a bitset with bit j set iff type i is assignable to
+# type j, so a subtype check is one shift and mask. Unions are resolved transitively into the non-union types they
+# contain, and A is assignable to B iff every such member of A is also one of B.
+class TypeRelations:
+    def __init__(self, type_aliases: TypeAliases, types: Iterable[TypeSignaturePrimitive]) -> None:
+        self.type_ids: Dict[TypeSignaturePrimitive, int] = {}
+        for t in chain(map(TypeSignaturePrimitive, BuiltInPrimitiveType), type_aliases,
+                       *type_aliases.values(), types):
+            self.type_ids.setdefault(t, len(self.type_ids))
+        self.types = list(self.type_ids)
+        self.members: Dict[TypeSignaturePrimitive, int] = {}
+        for t in self.types:
+            union_members(type_aliases, self.type_ids, t, self.members, set())
+        # A non-union type is assignable to exactly the types containing it; a union is assignable to the types
+        # all of its members are assignable to.
+        leaf_supertypes = [0] * len(self.types)
+        for j, b in enumerate(self.types):
+            for i in bits(self.members[b]):
+                leaf_supertypes[i] |= 1 << j
+        self.supertypes = [reduce(operator.and_, (leaf_supertypes[i] for i in bits(self.members[a])))
+                           for a in self.types]
+
+    def is_assignable(self, a: TypeSignature, b: TypeSignature) -> bool:
+        if isinstance(a, TypeSignaturePrimitive) and isinstance(b, TypeSignaturePrimitive):
+            a_id = self.type_ids.get(a)
+            b_id = self.type_ids.get(b)
+            if a_id is None or b_id is None:
+                return a == b
+            return (self.supertypes[a_id] >> b_id) & 1 == 1
+        if isinstance(a, TypeSignatureFunction) and isinstance(b, TypeSignatureFunction):
+            return len(a.params) == len(b.params) and \
+                all(self.is_assignable(b_param, a_param) for a_param, b_param in zip(a.params, b.params)) and \
+                self.is_assignable(a.return_type, b.return_type)
+        return False
+
+    # The non-union types a value of the type can have at runtime.
+    def leaf_types(self, t: TypeSignaturePrimitive) -> Set[TypeSignaturePrimitive]:
+        if t not in self.members:
+            return {t}
+        return {self.types[i] for i in bits(self.members[t])}
+
+    # There is no flow typing, so a union value may be passed where one of its members is expected.
+    def are_compatible(self, a: TypeSignature, b: TypeSignature) -> bool:
+        return self.is_assignable(a, b) or self.is_assignable(b, a)
+
+    def join(self, a: TypeSignature, b: TypeSignature) -> Optional[TypeSignature]:
+        if self.is_assignable(a, b):
+            return b
+        if self.is_assignable(b, a):
+            return a
+        if not isinstance(a, TypeSignaturePrimitive) or not isinstance(b, TypeSignaturePrimitive) or \
+                a not in self.type_ids or b not in self.type_ids:
+            return None
+        common = self.supertypes[self.type_ids[a]] & self.supertypes[self.type_ids[b]]
+        for i, t in enumerate(self.types):
+            if (common >> i) & 1 == 1 and common & ~self.supertypes[i] == 0:
+                return t
+        return None
+
+
+def bits(bitset: int) -> Iterator[int]:
+    while bitset != 0:
+        lowest = bitset & -bitset
+        yield lowest.bit_length() - 1
+        bitset ^= lowest
+
+
+def union_members(type_aliases: TypeAliases, type_ids: Dict[TypeSignaturePrimitive, int],
+                  t: TypeSignaturePrimitive, members: Dict[TypeSignaturePrimitive, int],
+                  visiting: Set[TypeSignaturePrimitive]) -> int:
+    if t in members:
+        return members[t]
+    type_assert(t not in visiting, f"Cyclic union: {t}")
+    if t not in type_aliases:
+        members[t] = 1 << type_ids[t]
+        return members[t]
+    visiting.add(t)
+    members[t] = reduce(operator.or_, (union_members(type_aliases, type_ids, option, members, visiting)
+                                       for option in type_aliases[t]), 0)
+    visiting.remove(t)
+    return members[t]
+
 
+def primitive_types(type_sig: TypeSignature) -> Iterator[TypeSignaturePrimitive]:
+    if isinstance(type_sig, TypeSignaturePrimitive):
+        yield type_sig
+    if isinstance(type_sig, TypeSignatureFunction):
+        for param in type_sig.params:
+            yield from primitive_types(param)
+        yield from primitive_types(type_sig.return_type)
 
+
+def definition_types(definitions: Dict[str, Definition]) -> Iterator[TypeSignaturePrimitive]:
+    for d in definitions.values():
+        if isinstance(d, (Constant, CompoundFunction, PrimitiveFunction)):
+            yield from primitive_types(d.type_sig)
+        yield from definition_types(d.sub_definitions)
+
+
+def assert_assignable(relations: TypeRelations, a: TypeSignature, b: TypeSignature, error_msg: str) -> None:
+    type_assert(relations.is_assignable(a, b), error_msg)
+
+
+def assert_compatible(relations: TypeRelations, a: TypeSignature, b: TypeSignature, error_msg: str) -> None:
+    type_assert(relations.are_compatible(a, b), error_msg)
+
+
+# Values passed to a program, e.g. structs or arrays, have the type they are tagged with, just like literals.
 def derive_type(exp: PrimitiveExpression) -> TypeSignaturePrimitive:
-    if isinstance(exp.value, bool):
-        return TypeSignaturePrimitive(BuiltInPrimitiveType.BOOLEAN)
-    if isinstance(exp.value, int):
-        return TypeSignaturePrimitive(BuiltInPrimitiveType.INTEGER)
-    if isinstance(exp.value, str):
-        return TypeSignaturePrimitive(BuiltInPrimitiveType.STRING)
-    assert False
+    return tag_type(value_tag(exp))
+
+
+def operator_type(definitions: Scope, relations: TypeRelations, operator: Expression) -> TypeSignature:
+    if isinstance(operator, Call):
+        return get_type(definitions, relations, operator)
+    assert isinstance(operator, Variable)
+    op = definitions[operator.name]
+    assert isinstance(op, (Constant, PrimitiveFunction, CompoundFunction))
+    return op.type_sig
+
+
+# Fewer arguments than parameters make a partial application, more are passed on to the returned function.
+# Returns the parameter type for each argument and the type of the result.
+def applied_type(op_sig: TypeSignature, argument_count: int) -> Tuple[List[TypeSignature], TypeSignature]:
+    param_types: List[TypeSignature] = []
+    while len(param_types) < argument_count:
+        type_assert(isinstance(op_sig, TypeSignatureFunction), "Wrong number of arguments")
+        assert isinstance(op_sig, TypeSignatureFunction)
+        missing = argument_count - len(param_types)
+        param_types.extend(op_sig.params[:missing])
+        if missing < len(op_sig.params):
+            return param_types, TypeSignatureFunction(op_sig.params[missing:], op_sig.return_type)
+        op_sig = op_sig.return_type
+    return param_types, op_sig
 
 
-def check_call(definitions: Dict[str, Definition],
-               type_aliases: Dict[TypeSignaturePrimitive, Set[TypeSignaturePrimitive]],
-               call: Call) -> None:
+# Returns the type of the result, which is not derived for ifElse.
+def check_call(definitions: Scope, relations: TypeRelations, call: Call) -> Optional[TypeSignature]:
     if isinstance(call.operator, Variable) and call.operator.name == "ifElse":
-        return
-    if isinstance(call.operator, Call):
-        op_sig = get_type(definitions, call.operator)
-    else:
-        assert isinstance(call.operator, Variable)
-        op = definitions[call.operator.name]
-        assert isinstance(op, (Constant, PrimitiveFunction, CompoundFunction))
-        op_sig = op.type_sig
-    arg_types = list(map(partial(get_type, definitions), call.operands))
-    assert isinstance(op_sig, TypeSignatureFunction)
-    type_assert(len(arg_types) == len(op_sig.params), "Wrong number of arguments")
-    for arg_type, param_type in zip(arg_types, op_sig.params):
-        assert_types_are_the_same(type_aliases, arg_type, param_type, "todo message")
-
-
-def get_type(definitions: Dict[str, Definition], expression: Expression) -> TypeSignature:
+        return None
+    arg_types = list(map(partial(get_type, definitions, relations), call.operands))
+    # Values of any type can be compared, as long as they can be equal at all.
+    if isinstance(call.operator, Variable) and call.operator.name == "equal" and len(arg_types) == 2:
+        assert_compatible(relations, arg_types[0], arg_types[1], "Values of these types are never equal")
+        return TypeSignaturePrimitive(BuiltInPrimitiveType.BOOLEAN)
+    param_types, result = applied_type(operator_type(definitions, relations, call.operator), len(arg_types))
+    for arg_type, param_type in zip(arg_types, param_types):
+        assert_compatible(relations, arg_type, param_type, "todo message")
+    return result
+
+
+# Results of calls are not checked against declared types in general yet, but a partial application must not
+# end up where a value is expected.
+def check_call_result(relations: TypeRelations, result: Optional[TypeSignature], declared: TypeSignature) -> None:
+    if isinstance(result, TypeSignatureFunction):
+        assert_assignable(relations, result, declared, "Partial application where a value is expected")
+
+
+# Case bodies are checked like function bodies, with the names bound by the cases narrowed to the case types.
+def check_match(definitions: Scope, relations: TypeRelations, match: Match) -> TypeSignature:
+    scrutinee_type = get_type(definitions, relations, match.scrutinee)
+    type_assert(isinstance(scrutinee_type, TypeSignaturePrimitive), "Only values can be matched")
+    assert isinstance(scrutinee_type, TypeSignaturePrimitive)
+    options = relations.leaf_types(scrutinee_type)
+    covered: Set[TypeSignaturePrimitive] = set()
+    covered_tags: Set[TypeTag] = set()
+    result: Optional[TypeSignature] = None
+    for case in match.cases:
+        type_assert(case.type_sig in options, f"{case.type_sig} is not an option of {scrutinee_type}")
+        type_assert(case.type_sig not in covered, f"Unreachable case: {case.type_sig}")
+        type_assert(type_tag(case.type_sig) not in covered_tags,
+                    f"{case.type_sig} can not be told apart from the other cases at runtime")
+        covered.add(case.type_sig)
+        covered_tags.add(type_tag(case.type_sig))
+        case_definitions = definitions if case.name is None else \
+            extend_definitions(definitions, [case.name], [case.type_sig])
+        case_type = get_type(case_definitions, relations, case.body)
+        if isinstance(case.body, Call):
+            check_call(case_definitions, relations, case.body)
+        result = case_type if result is None else relations.join(result, case_type)
+        type_assert(result is not None, "Incompatible match cases")
+    missing = sorted(map(str, options - covered))
+    type_assert(len(missing) == 0, f"Non-exhaustive match, missing: {', '.join(missing)}")
+    assert result is not None
+    return result
+
+
+def get_type(definitions: Scope, relations: TypeRelations, expression: Expression) -> TypeSignature:
     if isinstance(expression, Call):
         if isinstance(expression.operator, Variable) and expression.operator.name == "ifElse":
-            assert get_type(definitions, expression.operands[0]) == TypeSignaturePrimitive(BuiltInPrimitiveType.BOOLEAN)
-            assert get_type(definitions, expression.operands[1]) == get_type(definitions, expression.operands[2])
-            return get_type(definitions, expression.operands[1])
+            assert_assignable(relations, get_type(definitions, relations, expression.operands[0]),
+                              TypeSignaturePrimitive(BuiltInPrimitiveType.BOOLEAN), "Condition must be a Boolean")
+            joined = relations.join(get_type(definitions, relations, expression.operands[1]),
+                                    get_type(definitions, relations, expression.operands[2]))
+            type_assert(joined is not None, "Incompatible ifElse branches")
+            assert joined is not None
+            return joined
         if isinstance(expression.operator, (CompoundFunction, PrimitiveFunction)):
             return expression.operator.type_sig
-        assert isinstance(expression.operator, Variable)
-        d = definitions[expression.operator.name]
-        assert isinstance(d, (CompoundFunction, PrimitiveFunction))
-        if len(expression.operands) != len(d.parameters):
-            return TypeSignatureFunction(d.type_sig.params[len(expression.operands):], d.type_sig.return_type)
-        return d.type_sig.return_type
+        return applied_type(operator_type(definitions, relations, expression.operator), len(expression.operands))[1]
     if isinstance(expression, Variable):
         d = definitions[expression.name]
         if isinstance(d, Constant):
@@ -92,38 +235,67 @@ def get_type(definitions: Dict[str, Definition], expression: Expression) -> Type
         assert False
     if isinstance(expression, PrimitiveExpression):
         return derive_type(expression)
+    if isinstance(expression, Match):
+        return check_match(definitions, relations, expression)
     assert False
 
 
-def attach_sub_definitions(definitions: Dict[str, Definition],
-                           sub_definitions: Dict[str, Definition]) -> Dict[str, Definition]:
-    return definitions | sub_definitions
+# Checks all calls in an expression, not only the outermost one. Used for definition bodies and for entry
+# expressions, e.g. of Program.evaluate, which have no declared type to check them against.
+def check_expression(definitions: Scope, relations: TypeRelations, expression: Expression) -> TypeSignature:
+    if isinstance(expression, Match):
+        check_expression(definitions, relations, expression.scrutinee)
+        for case in expression.cases:
+            check_expression(definitions if case.name is None else
+                             extend_definitions(definitions, [case.name], [case.type_sig]), relations, case.body)
+        return check_match(definitions, relations, expression)
+    if isinstance(expression, Call):
+        if isinstance(expression.operator, Call):
+            check_expression(definitions, relations, expression.operator)
+        for operand in expression.operands:
+            check_expression(definitions, relations, operand)
+        check_call(definitions, relations, expression)
+    return get_type(definitions, relations, expression)
+
+
+# Scopes are layered instead of merged, so entering one does not copy all definitions of the enclosing scopes.
+def attach_sub_definitions(definitions: Scope,
+                           sub_definitions: Dict[str, Definition]) -> Scope:
+    return ChainMap(sub_definitions, definitions) if len(sub_definitions) > 0 else definitions
 
 
-def extend_definitions(definitions: Dict[str, Definition],
+def extend_definitions(definitions: Scope,
                        parameters: List[str],
-                       args: List[TypeSignature]) -> Dict[str, Definition]:
-    return definitions | dict(map(lambda name_and_sig: (name_and_sig[0], Constant({}, Expression(), name_and_sig[1])),
-                                  zip(parameters, args)))
+                       args: List[TypeSignature]) -> Scope:
+    return ChainMap(dict(map(lambda name_and_sig: (name_and_sig[0], Constant({}, Expression(), name_and_sig[1])),
+                             zip(parameters, args))), definitions)
 
 
-def check_definition(definitions: Dict[str, Definition],
-                     item: Definition,
-                     type_aliases: Dict[TypeSignaturePrimitive, Set[TypeSignaturePrimitive]]) -> None:
+def check_definition(definitions: Scope, item: Definition, relations: TypeRelations) -> None:
     if len(item.sub_definitions) > 0:
         for sub_def in item.sub_definitions.values():
             if isinstance(item, CompoundFunction):
                 check_definition(
                     extend_definitions(attach_sub_definitions(definitions, item.sub_definitions), item.parameters,
-                                       item.type_sig.params), sub_def, type_aliases)
+                                       item.type_sig.params), sub_def, relations)
             else:
-                check_definition(attach_sub_definitions(definitions, item.sub_definitions), sub_def, type_aliases)
+                check_definition(attach_sub_definitions(definitions, item.sub_definitions), sub_def, relations)
     if isinstance(item, Constant):
         if isinstance(item.expression, PrimitiveExpression):
-            assert_types_are_the_same(type_aliases, derive_type(item.expression), item.type_sig,
-                                      "Invalid constant type")
+            assert_assignable(relations, derive_type(item.expression), item.type_sig, "Invalid constant type")
         elif isinstance(item.expression, Call):
-            check_call(attach_sub_definitions(definitions, item.sub_definitions), type_aliases, item.expression)
+            check_call_result(relations, check_call(attach_sub_definitions(definitions, item.sub_definitions),
+                                                    relations, item.expression), item.type_sig)
+        elif isinstance(item.expression, Match):
+            assert_assignable(relations, check_match(attach_sub_definitions(definitions, item.sub_definitions),
+                                                     relations, item.expression),
+                              item.type_sig, "Invalid constant type")
+    # Release mode drops the runtime assertions, so the calls nested in a definition are checked as well.
+    if isinstance(item, Constant) and isinstance(item.expression, (Call, Match)):
+        check_expression(attach_sub_definitions(definitions, item.sub_definitions), relations, item.expression)
+    if isinstance(item, CompoundFunction) and len(item.type_sig.params) == len(item.parameters):
+        check_expression(extend_definitions(attach_sub_definitions(definitions, item.sub_definitions),
+                                            item.parameters, item.type_sig.params), relations, item.body)
     if isinstance(item, PrimitiveFunction):
         pass  # PrimitiveFunction is only instantiated from standard library. We have to trust it.
     elif isinstance(item, CompoundFunction):
@@ -131,15 +303,15 @@ def check_definition(definitions: Dict[str, Definition],
         type_assert(len(item.type_sig.params) == len(item.parameters), "Inconsistent number of parameters")
         if isinstance(item, CompoundFunction):
             if isinstance(item.body, Call):
-                check_call(
+                check_call_result(relations, check_call(
                     extend_definitions(attach_sub_definitions(definitions, item.sub_definitions), item.parameters,
-                                       item.type_sig.params), type_aliases,
-                    item.body)
-            elif isinstance(item.body, Variable):
-                type_assert(get_type(
+                                       item.type_sig.params), relations,
+                    item.body), item.type_sig.return_type)
+            elif isinstance(item.body, (Variable, Match, PrimitiveExpression)):
+                type_assert(relations.is_assignable(get_type(
                     extend_definitions(attach_sub_definitions(definitions, item.sub_definitions), item.parameters,
-                                       item.type_sig.params),
-                    item.body) == item.type_sig.return_type, "Invalid definition")
+                                       item.type_sig.params), relations,
+                    item.body), item.type_sig.return_type), "Invalid definition")
                 pass
             else:
                 assert False
@@ -147,7 +319,130 @@ def check_definition(definitions: Dict[str, Definition],
             assert False
 
 
-def check_types(definitions: Dict[str, Definition],
-                type_aliases: Dict[TypeSignaturePrimitive, Set[TypeSignaturePrimitive]]) -> None:
+# Whether every reference to the function in the expression is a call with all arguments in tail position.
+def only_tail_calls(exp: Expression, name: str, arity: int, tail: bool) -> bool:
+    if isinstance(exp, Let):
+        return all(only_tail_calls(bound, name, arity, False) for _, bound in exp.bindings) and \
+            only_tail_calls(exp.body, name, arity, tail)
+    if isinstance(exp, Match):
+        return only_tail_calls(exp.scrutinee, name, arity, False) and \
+            all(only_tail_calls(case.body, name, arity, tail) for case in exp.cases)
+    if not isinstance(exp, Call):
+        return name not in referenced_names(exp)
+    if isinstance(exp.operator, Variable) and exp.operator.name == "ifElse":
+        return only_tail_calls(exp.operands[0], name, arity, False) and \
+            all(only_tail_calls(branch, name, arity, tail) for branch in exp.operands[1:])
+    operands_ok = all(only_tail_calls(operand, name, arity, False) for operand in exp.operands)
+    if isinstance(exp.operator, Variable) and exp.operator.name == name:
+        return tail and len(exp.operands) == arity and operands_ok
+    return only_tail_calls(exp.operator, name, arity, False) and operands_ok
+
+
+def check_tail_recursion(name: str, d: CompoundFunction) -> None:
+    type_assert(only_tail_calls(d.body, name, len(d.parameters), True) and
+                all(name not in definition_references(sub_definition) for sub_definition in d.sub_definitions.values()),
+                f"{name} is annotated as tail-recursive but does not only call itself in tail position")
+
+
+# Arrays are updated in place, so each Array value bound to a name has a single owner: the function or match case
+# binding it. Called with all arguments, these built-ins only observe the array passed as their first argument.
+# Any other use consumes it, after which it can not be used anymore. Values of unions containing Array are owned
+# the same way.
+OBSERVING_BUILT_INS = {"arrayGet": 2, "arrayLength": 1, "arraySum": 1}
+
+
+def is_owned_type(relations: TypeRelations, type_sig: TypeSignature) -> bool:
+    return isinstance(type_sig, TypeSignaturePrimitive) and \
+        TypeSignaturePrimitive(BuiltInPrimitiveType.ARRAY) in relations.leaf_types(type_sig)
+
+
+# Owned names can be consumed once per path through ifElse and match. Borrowed names are owned by an enclosing
+# function or shared with local definitions, which could observe them at any time, so they can only be observed.
+class OwnershipChecker:
+    def __init__(self, relations: TypeRelations, name: str) -> None:
+        self.relations = relations
+        self.name = name
+
+    def use(self, name: str, borrowed: FrozenSet[str], consumed: Set[str], consuming: bool) -> None:
+        type_assert(name not in consumed, f"{self.name} uses {name} after consuming it")
+        type_assert(not consuming or name not in borrowed,
+                    f"{self.name} consumes {name}, which it only borrows from or shares with local definitions")
+
+    # Checks an expression whose value is consumed. Adds the names it consumes to `consumed`.
+    def check(self, exp: Expression, owned: FrozenSet[str], borrowed: FrozenSet[str], consumed: Set[str]) -> None:
+        if isinstance(exp, Variable):
+            self.use(exp.name, borrowed, consumed, True)
+            if exp.name in owned:
+                consumed.add(exp.name)
+        elif isinstance(exp, Match):
+            self.check_match(exp, owned, borrowed, consumed)
+        elif isinstance(exp, Call) and isinstance(exp.operator, Variable) and exp.operator.name == "ifElse":
+            self.check(exp.operands[0], owned, borrowed, consumed)
+            branches = [set(consumed) for _ in exp.operands[1:]]
+            for branch, branch_consumed in zip(exp.operands[1:], branches):
+                self.check(branch, owned, borrowed, branch_consumed)
+            consumed.update(*branches)
+        elif isinstance(exp, Call):
+            self.check_call(exp, owned, borrowed, consumed)
+
+    # Arguments are consumed by the call, i.e. after all of them are evaluated, so an argument can be observed by
+    # the other ones.
+    def check_call(self, call: Call, owned: FrozenSet[str], borrowed: FrozenSet[str], consumed: Set[str]) -> None:
+        self.check(call.operator, owned, borrowed, consumed)
+        observing = isinstance(call.operator, Variable) and \
+            OBSERVING_BUILT_INS.get(call.operator.name) == len(call.operands)
+        moved: Set[str] = set()
+        for i, operand in enumerate(call.operands):
+            if not isinstance(operand, Variable) or operand.name not in owned | borrowed:
+                self.check(operand, owned, borrowed, consumed)
+                continue
+            consuming = not observing or i > 0
+            self.use(operand.name, borrowed, consumed, consuming)
+            if consuming:
+                type_assert(operand.name not in moved, f"{self.name} consumes {operand.name} twice")
+                moved.add(operand.name)
+        twice = moved & consumed
+        type_assert(len(twice) == 0, f"{self.name} consumes {', '.join(sorted(twice))} twice")
+        consumed |= moved
+
+    def check_match(self, match: Match, owned: FrozenSet[str], borrowed: FrozenSet[str], consumed: Set[str]) -> None:
+        self.check(match.scrutinee, owned, borrowed, consumed)
+        branches = []
+        for case in match.cases:
+            case_owned, case_borrowed, case_consumed = owned, borrowed, set(consumed)
+            if case.name is not None:
+                case_owned, case_borrowed = owned - {case.name}, borrowed - {case.name}
+                if is_owned_type(self.relations, case.type_sig):
+                    case_owned |= {case.name}
+                case_consumed.discard(case.name)
+            self.check(case.body, case_owned, case_borrowed, case_consumed)
+            branches.append(case_consumed if case.name is None else case_consumed - {case.name})
+        consumed.update(*branches)
+
+
+def check_ownership(name: str, d: Definition, relations: TypeRelations, captured: FrozenSet[str]) -> None:
+    owned: FrozenSet[str] = frozenset()
+    if isinstance(d, CompoundFunction):
+        captured = captured - set(d.parameters)
+        owned = frozenset(parameter for parameter, type_sig in zip(d.parameters, d.type_sig.params)
+                          if is_owned_type(relations, type_sig))
+    shared = owned & set().union(*map(definition_references, d.sub_definitions.values()))
+    for sub_name, sub_definition in d.sub_definitions.items():
+        check_ownership(f"{name}.{sub_name}", sub_definition, relations, captured | owned)
+    checker = OwnershipChecker(relations, name)
+    if isinstance(d, Constant):
+        checker.check(d.expression, frozenset(), captured, set())
+    if isinstance(d, CompoundFunction):
+        checker.check(d.body, owned - shared, captured | shared, set())
+
+
+def check_types(definitions: Dict[str, Definition], type_aliases: TypeAliases) -> TypeRelations:
+    relations = TypeRelations(type_aliases, definition_types(definitions))
     for def_name, item in definitions.items():
-        check_definition(definitions, item, type_aliases)
+        check_definition(definitions, item, relations)
+    for name, d, _ in flatten_definitions(definitions, frozenset()):
+        if isinstance(d, CompoundFunction) and d.tail_recursive:
+            check_tail_recursion(name, d)
+    for name, d in definitions.items():
+        check_ownership(name, d, relations, frozenset())
+    return relations
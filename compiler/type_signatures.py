@@ -16,6 +16,13 @@ class BuiltInPrimitiveType(StrEnum):
     INTEGER = auto()
     BOOLEAN = auto()
     NONE = auto()
+    INT64 = auto()
+    FLOAT64 = auto()
+    INT64_ARRAY = auto()
+    FLOAT64_ARRAY = auto()
+    ARRAY = auto()
+    STREAM = auto()
+    MAP = auto()
 
 
 @dataclass(frozen=True)
@@ -1,8 +1,213 @@
-from typing import Dict
+from collections import ChainMap
+from dataclasses import dataclass
+from typing import Dict, List, Tuple, Optional, MutableMapping, Mapping
 
-from compiler.expressions import Definition
+from .expressions import Definition, Expression, Call, Variable, PrimitiveExpression, Constant, CompoundFunction, \
+    PrimitiveFunction, Match, MatchCase
+from .parsing import make_call
+from .type_checking import TypeRelations, TypeAliases, definition_types, derive_type
+from .type_signatures import TypeSignature, TypeSignatureFunction
 
+# Parses kept per span and type, in order of preference. Only used for reporting ambiguities.
+MAX_PARSES = 2
 
-def transform_ubiquefix(definitions: Dict[str, Definition]) -> Dict[str, Definition]:
-    # todo: implement
-    return definitions
+
+@dataclass(frozen=True)
+class Ambiguity:
+    definition: str
+    count: int
+    # The chosen parse first.
+    parses: Tuple[Expression, ...]
+
+
+# A function together with the arguments it attracted so far.
+Application = Tuple[Expression, Tuple[Expression, ...]]
+
+
+@dataclass
+class Parses:
+    type_sig: TypeSignature
+    count: int
+    applications: List[Application]
+
+
+# All parses of a span, grouped by their type.
+Cell = List[Parses]
+
+
+def to_expression(application: Application) -> Expression:
+    function, arguments = application
+    return function if len(arguments) == 0 else make_call(function, list(arguments))
+
+
+def add_parses(cell: Cell, type_sig: TypeSignature, count: int, applications: List[Application]) -> None:
+    for parses in cell:
+        if parses.type_sig == type_sig:
+            parses.count += count
+            parses.applications.extend(applications[:MAX_PARSES - len(parses.applications)])
+            return
+    cell.append(Parses(type_sig, count, applications[:MAX_PARSES]))
+
+
+# A function attracts a neighbour from either side into its first open parameter,
+# which is what partially applying it to that argument does.
+def applied_type(relations: TypeRelations, function: TypeSignature, argument: TypeSignature) \
+        -> Optional[TypeSignature]:
+    if not isinstance(function, TypeSignatureFunction) or not relations.is_assignable(argument, function.params[0]):
+        return None
+    if len(function.params) == 1:
+        return function.return_type
+    return TypeSignatureFunction(function.params[1:], function.return_type)
+
+
+def combine(relations: TypeRelations, left: Cell, right: Cell, cell: Cell) -> None:
+    for left_parses in left:
+        for right_parses in right:
+            count = left_parses.count * right_parses.count
+            prefix = applied_type(relations, left_parses.type_sig, right_parses.type_sig)
+            if prefix is not None:
+                add_parses(cell, prefix, count, [(function, arguments + (to_expression(argument),))
+                                                 for function, arguments in left_parses.applications
+                                                 for argument in right_parses.applications])
+            postfix = applied_type(relations, right_parses.type_sig, left_parses.type_sig)
+            if postfix is not None:
+                add_parses(cell, postfix, count, [(function, arguments + (to_expression(argument),))
+                                                  for function, arguments in right_parses.applications
+                                                  for argument in left_parses.applications])
+
+
+# CYK over the spans of the chain, so it takes O(n^3) combinations of cells instead of trying every bracketing.
+# Splits with longer left parts come first, so the first parse of each type is the left-associative one.
+def chain_parses(relations: TypeRelations, elements: List[Cell]) -> Cell:
+    chart: Dict[Tuple[int, int], Cell] = {(i, i + 1): cell for i, cell in enumerate(elements)}
+    for length in range(2, len(elements) + 1):
+        for start in range(len(elements) - length + 1):
+            end = start + length
+            cell: Cell = []
+            for split in range(end - 1, start, -1):
+                combine(relations, chart[start, split], chart[split, end], cell)
+            chart[start, end] = cell
+    return chart[0, len(elements)]
+
+
+def is_if_else(exp: Expression) -> bool:
+    return isinstance(exp, Call) and isinstance(exp.operator, Variable) and exp.operator.name == "ifElse"
+
+
+def definition_type(d: Definition) -> Optional[TypeSignature]:
+    if isinstance(d, (Constant, CompoundFunction, PrimitiveFunction)):
+        return d.type_sig
+    return None
+
+
+# Names in scope map to their types. Inner scopes are layered over the outer ones instead of copying them.
+Scope = MutableMapping[str, TypeSignature]
+
+
+class Resolver:
+    def __init__(self, relations: TypeRelations) -> None:
+        self.relations = relations
+        self.ambiguities: List[Ambiguity] = []
+
+    def resolve_definition(self, name: str, d: Definition, scope: Scope) -> Definition:
+        if len(d.sub_definitions) > 0:
+            scope = ChainMap({sub_name: sub_type for sub_name, sub_definition in d.sub_definitions.items()
+                              if (sub_type := definition_type(sub_definition)) is not None}, scope)
+        if isinstance(d, CompoundFunction):
+            scope = ChainMap(dict(zip(d.parameters, d.type_sig.params)), scope)
+        sub_definitions = {sub_name: self.resolve_definition(f"{name}.{sub_name}", sub_definition, scope)
+                           for sub_name, sub_definition in d.sub_definitions.items()}
+        unchanged = all(sub_definitions[sub_name] is sub_definition
+                        for sub_name, sub_definition in d.sub_definitions.items())
+        if isinstance(d, Constant):
+            expression = self.resolve(name, d.expression, scope, d.type_sig)
+            if unchanged and expression is d.expression:
+                return d
+            return Constant(sub_definitions, expression, d.type_sig)
+        if isinstance(d, CompoundFunction):
+            body = self.resolve(name, d.body, scope, d.type_sig.return_type)
+            if unchanged and body is d.body:
+                return d
+            return CompoundFunction(sub_definitions, d.type_sig, d.parameters, body, d.tail_recursive)
+        return d
+
+    # Chains that can not be typed are kept as written, so the type checker reports them.
+    def resolve(self, name: str, exp: Expression, scope: Scope, expected: Optional[TypeSignature]) -> Expression:
+        if isinstance(exp, Match):
+            return self.resolve_match(name, exp, scope, expected)
+        if not isinstance(exp, Call):
+            return exp
+        if is_if_else(exp):
+            return make_call(exp.operator, [self.resolve(name, exp.operands[0], scope, None)] +
+                             [self.resolve(name, branch, scope, expected) for branch in exp.operands[1:]])
+        cell = self.chain(name, exp, scope)
+        if cell is None:
+            return exp
+        candidates = [parses for parses in cell
+                      if expected is None or self.relations.is_assignable(parses.type_sig, expected)]
+        if len(candidates) == 0:
+            return exp
+        parses = [to_expression(application) for candidate in candidates
+                  for application in candidate.applications][:MAX_PARSES]
+        count = sum(candidate.count for candidate in candidates)
+        if count > 1:
+            self.ambiguities.append(Ambiguity(name, count, tuple(parses)))
+        return parses[0]
+
+    def resolve_match(self, name: str, match: Match, scope: Scope, expected: Optional[TypeSignature]) -> Expression:
+        scrutinee = self.resolve(name, match.scrutinee, scope, None)
+        cases = tuple(MatchCase(case.type_sig, case.name, self.resolve(
+            name, case.body, scope if case.name is None else ChainMap({case.name: case.type_sig}, scope), expected))
+                      for case in match.cases)
+        if scrutinee is match.scrutinee and all(case.body is old.body for case, old in zip(cases, match.cases)):
+            return match
+        return Match(scrutinee, cases)
+
+    def chain(self, name: str, call: Call, scope: Scope) -> Optional[Cell]:
+        elements: List[Cell] = []
+        for element in [call.operator, *call.operands]:
+            cell = self.element(name, element, scope)
+            if cell is None:
+                return None
+            elements.append(cell)
+        return chain_parses(self.relations, elements)
+
+    # Parenthesized chains contribute all of their parses, so the surrounding chain can pick by type.
+    def element(self, name: str, exp: Expression, scope: Scope) -> Optional[Cell]:
+        if isinstance(exp, Variable):
+            if exp.name not in scope:
+                return None
+            return [Parses(scope[exp.name], 1, [(exp, ())])]
+        if isinstance(exp, PrimitiveExpression):
+            return [Parses(derive_type(exp), 1, [(exp, ())])]
+        if is_if_else(exp):
+            resolved = self.resolve(name, exp, scope, None)
+            assert isinstance(resolved, Call)
+            branches = [self.element(name, branch, scope) for branch in resolved.operands[1:]]
+            if len(branches) != 2 or branches[0] is None or branches[1] is None:
+                return None
+            joined = self.relations.join(branches[0][0].type_sig, branches[1][0].type_sig)
+            return None if joined is None else [Parses(joined, 1, [(resolved, ())])]
+        if isinstance(exp, Call):
+            return self.chain(name, exp, scope)
+        return None
+
+
+# Runs before type checking. Resolves call chains in ubiquefix notation, e.g. `xs map square sum`, into calls,
+# by letting functions attract neighbouring values of matching types from both sides. Chains with several parses
+# are resolved left-associatively and reported along with the competing parses.
+def transform_ubiquefix(definitions: Dict[str, Definition], type_aliases: TypeAliases) \
+        -> Tuple[Dict[str, Definition], List[Ambiguity]]:
+    resolver = Resolver(TypeRelations(type_aliases, definition_types(definitions)))
+    scope = definition_scope(definitions)
+    return {name: resolver.resolve_definition(name, d, scope) for name, d in definitions.items()}, \
+        resolver.ambiguities
+
+
+def definition_scope(definitions: Mapping[str, Definition]) -> Dict[str, TypeSignature]:
+    return {name: type_sig for name, d in definitions.items() if (type_sig := definition_type(d)) is not None}
+
+
+# Resolves an expression outside of any definition, e.g. the entry expression of a program, in the given scope.
+def resolve_expression(relations: TypeRelations, scope: Dict[str, TypeSignature], exp: Expression) -> Expression:
+    return Resolver(relations).resolve("", exp, scope, None)
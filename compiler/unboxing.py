@@ -0,0 +1,454 @@
+from __future__ import annotations
+
+import operator
+from collections import ChainMap
+from dataclasses import dataclass, field
+from enum import auto, StrEnum
+from functools import partial
+from itertools import chain
+from typing import Any, Callable, Dict, List, Optional, Tuple, MutableMapping, Sequence, Iterator
+
+from .built_ins import UNCHECKED_IMPLEMENTATIONS, plus, minus, multiply, divide, modulo, less, greater, equal, \
+    concat, inttostr, strtoint, printline
+from .expressions import Definition, Expression, PrimitiveExpression, Call, Variable, Constant, CompoundFunction, \
+    PrimitiveFunction, PrimitiveClosure, Match, BUILT_IN_TAGS, value_tag, tag_type, share_arrays
+from .capturing import closure_captures
+from .interpreting import apply
+from .ropes import concat_texts
+from .traversing import sub_expressions, flatten_definitions, definition_expressions
+from .type_checking import TypeRelations, applied_type
+from .type_signatures import TypeSignature, TypeSignatureFunction, TypeSignaturePrimitive, BuiltInPrimitiveType
+
+# Values of these types are carried as raw Python objects: ints, bools and strings or ropes. Values of all other
+# types stay PrimitiveExpressions, and function values are NativeFunctions.
+NATIVE_TYPES = frozenset(map(TypeSignaturePrimitive, [BuiltInPrimitiveType.INTEGER, BuiltInPrimitiveType.BOOLEAN,
+                                                      BuiltInPrimitiveType.STRING]))
+
+BOOLEAN = TypeSignaturePrimitive(BuiltInPrimitiveType.BOOLEAN)
+
+# Raw objects for values of native types, Expressions otherwise.
+Value = Any
+# The names bound where code runs, see UnboxedProgram.
+Frame = Dict[str, Value]
+Code = Callable[[Frame], Value]
+Converter = Callable[[Value], Value]
+
+
+def is_native(type_sig: TypeSignature) -> bool:
+    return isinstance(type_sig, TypeSignaturePrimitive) and type_sig in NATIVE_TYPES
+
+
+class NativeFunction:
+    __slots__ = ("arity", "call")
+
+    def __init__(self, arity: int, call: Callable[..., Value]) -> None:
+        self.arity = arity
+        self.call = call
+
+
+# Returned from tail positions of a tail-recursive function instead of calling it, see invoker.
+class TailCall:
+    __slots__ = ("arguments",)
+
+    def __init__(self, arguments: Tuple[Value, ...]) -> None:
+        self.arguments = arguments
+
+
+def apply_native(function: NativeFunction, arguments: Sequence[Value]) -> Value:
+    arity = function.arity
+    if len(arguments) == arity:
+        return function.call(*arguments)
+    if len(arguments) < arity:
+        share_arrays(arguments)
+        bound = tuple(arguments)
+        return NativeFunction(arity - len(bound), lambda *rest: function.call(*bound, *rest))
+    return apply_native(function.call(*arguments[:arity]), arguments[arity:])
+
+
+def print_native(text: Value) -> None:
+    print(text)
+
+
+def str_to_int_native(text: Value) -> int:
+    return int(str(text))
+
+
+NATIVE_BUILT_INS: List[Tuple[Callable[..., PrimitiveExpression], Callable[..., Value]]] = [
+    (plus, operator.add), (minus, operator.sub), (multiply, operator.mul), (divide, operator.floordiv),
+    (modulo, operator.mod), (less, operator.lt), (greater, operator.gt), (equal, operator.eq),
+    (concat, concat_texts), (inttostr, str), (strtoint, str_to_int_native), (printline, print_native)]
+
+# Built-ins over native types only, by their checked and unchecked implementations.
+NATIVE_IMPLEMENTATIONS: Dict[Callable[..., PrimitiveExpression], Callable[..., Value]] = \
+    {impl: native for impl, native in NATIVE_BUILT_INS} | \
+    {UNCHECKED_IMPLEMENTATIONS.get(impl, impl): native for impl, native in NATIVE_BUILT_INS}
+
+
+def convert(converter: Optional[Converter], value: Value) -> Value:
+    return value if converter is None else converter(value)
+
+
+# Converters between the representation of a type in unboxed code and the one the boxed evaluator uses.
+def boxing(type_sig: TypeSignature) -> Optional[Converter]:
+    if is_native(type_sig):
+        return PrimitiveExpression
+    if isinstance(type_sig, TypeSignatureFunction):
+        return partial(boxed_function, type_sig)
+    return None
+
+
+def unboxing(type_sig: TypeSignature) -> Optional[Converter]:
+    if is_native(type_sig):
+        return operator.attrgetter("value")
+    if isinstance(type_sig, TypeSignatureFunction):
+        return partial(unboxed_function, type_sig)
+    return None
+
+
+def boxed_function(type_sig: TypeSignatureFunction, function: NativeFunction) -> Expression:
+    arguments = [unboxing(param) for param in type_sig.params]
+    result = boxing(type_sig.return_type)
+
+    def impl(*values: Expression) -> Value:
+        return convert(result, apply_native(function, [convert(c, value) for c, value in zip(arguments, values)]))
+
+    return PrimitiveClosure([f"_{i}" for i in range(len(type_sig.params))], {}, impl)
+
+
+def unboxed_function(type_sig: TypeSignatureFunction, closure: Expression) -> NativeFunction:
+    arguments = [boxing(param) for param in type_sig.params]
+    result = unboxing(type_sig.return_type)
+    return NativeFunction(len(type_sig.params), lambda *values: convert(result, apply(
+        closure, [convert(c, value) for c, value in zip(arguments, values)])))
+
+
+# Converts values of the source type where values of the target type are expected, if their representations differ.
+def coercion(source: TypeSignature, target: TypeSignature) -> Optional[Converter]:
+    if isinstance(source, TypeSignatureFunction) and isinstance(target, TypeSignatureFunction):
+        arguments = [coercion(target_param, source_param)
+                     for source_param, target_param in zip(source.params, target.params)]
+        result = coercion(source.return_type, target.return_type)
+        if result is None and all(argument is None for argument in arguments):
+            return None
+        return partial(adapted_function, len(source.params), arguments, result)
+    if isinstance(source, TypeSignatureFunction) or isinstance(target, TypeSignatureFunction) or \
+            is_native(source) == is_native(target):
+        return None
+    return PrimitiveExpression if is_native(source) else operator.attrgetter("value")
+
+
+def adapted_function(arity: int, arguments: List[Optional[Converter]], result: Optional[Converter],
+                     function: NativeFunction) -> NativeFunction:
+    return NativeFunction(arity, lambda *values: convert(result, apply_native(
+        function, [convert(c, value) for c, value in zip(arguments, values)])))
+
+
+def coerce(code: Code, source: TypeSignature, target: TypeSignature) -> Code:
+    converter = coercion(source, target)
+    if converter is None:
+        return code
+    return lambda frame: converter(code(frame))
+
+
+# Built-ins without a native implementation get their arguments boxed and their result unboxed.
+def native_implementation(d: PrimitiveFunction) -> Callable[..., Value]:
+    signature = [d.type_sig.return_type, *d.type_sig.params]
+    if d.impl in NATIVE_IMPLEMENTATIONS and all(map(is_native, signature)):
+        return NATIVE_IMPLEMENTATIONS[d.impl]
+    arguments = [boxing(param) for param in d.type_sig.params]
+    result = unboxing(d.type_sig.return_type)
+    if result is None and all(argument is None for argument in arguments):
+        return d.impl
+    impl = d.impl
+    return lambda *values: convert(result, impl(*[convert(c, value) for c, value in zip(arguments, values)]))
+
+
+class BindingKind(StrEnum):
+    # Parameters and names bound by match cases, which are stored in the frame.
+    VALUE = auto()
+    FUNCTION = auto()
+    # Evaluated on every reference, like the boxed evaluator does.
+    CONSTANT = auto()
+    # Names another frame may bind, see UnboxedProgram.
+    DYNAMIC = auto()
+
+
+@dataclass(eq=False)
+class Binding:
+    kind: BindingKind
+    type_sig: TypeSignature
+    # The value of functions that run the same, whichever frame they are called from.
+    function: Optional[NativeFunction] = None
+    parameters: List[str] = field(default_factory=list)
+    # The names a function takes from the frame of its caller, like the boxed evaluator captures them.
+    shared: Tuple[str, ...] = ()
+    # The sub-definitions, which the frames of the definition hold as these bindings.
+    subs: Dict[str, Binding] = field(default_factory=dict)
+    # Filled once the body is compiled, so definitions can refer to each other.
+    code: List[Code] = field(default_factory=list)
+    tail_recursive: bool = False
+
+
+Scope = MutableMapping[str, Binding]
+
+
+def enter(binding: Binding, caller: Frame, arguments: Sequence[Value]) -> Frame:
+    frame = {name: caller[name] for name in binding.shared if name in caller}
+    frame.update(binding.subs)
+    frame.update(zip(binding.parameters, arguments))
+    return frame
+
+
+# Calls of the function itself in tail position return a TailCall, which starts the next iteration.
+def invoker(binding: Binding, caller: Frame) -> Callable[..., Value]:
+    parameters, code = binding.parameters, binding.code
+    if binding.tail_recursive:
+        def loop(*arguments: Value) -> Value:
+            while True:
+                result = code[0](enter(binding, caller, arguments))
+                if type(result) is not TailCall:
+                    return result
+                arguments = result.arguments
+
+        return loop
+    if len(binding.shared) == 0 and len(binding.subs) == 0 and len(parameters) == 1:
+        parameter, = parameters
+        return lambda argument: code[0]({parameter: argument})
+    if len(binding.shared) == 0 and len(binding.subs) == 0 and len(parameters) == 2:
+        first, second = parameters
+        return lambda a, b: code[0]({first: a, second: b})
+    return lambda *arguments: code[0](enter(binding, caller, arguments))
+
+
+# The value of a function or constant referenced from the frame.
+def reference(binding: Binding, frame: Frame) -> Value:
+    if binding.kind == BindingKind.CONSTANT:
+        return binding.code[0](frame | binding.subs if len(binding.subs) > 0 else frame)
+    if binding.function is not None:
+        return binding.function
+    return NativeFunction(len(binding.parameters), invoker(binding, frame))
+
+
+def native_value(value: Value) -> Value:
+    return value.value if type(value) is PrimitiveExpression else value
+
+
+def boxed_value(value: Value) -> Value:
+    return value if type(value) is PrimitiveExpression else PrimitiveExpression(value)
+
+
+def call_code(call: Callable[..., Value], arguments: List[Code]) -> Code:
+    if len(arguments) == 1:
+        a, = arguments
+        return lambda frame: call(a(frame))
+    if len(arguments) == 2:
+        a, b = arguments
+        return lambda frame: call(a(frame), b(frame))
+    if len(arguments) == 3:
+        a, b, c = arguments
+        return lambda frame: call(a(frame), b(frame), c(frame))
+    return lambda frame: call(*[argument(frame) for argument in arguments])
+
+
+def bound_types(exp: Expression) -> Iterator[Tuple[str, TypeSignature]]:
+    for sub_expression in sub_expressions(exp):
+        if isinstance(sub_expression, Match):
+            yield from ((case.name, case.type_sig) for case in sub_expression.cases if case.name is not None)
+
+
+# The types of all names bound by parameters, sub-definitions and match cases.
+def local_types(definitions: Dict[str, Definition], entries: Sequence[Expression]) -> Dict[str, List[TypeSignature]]:
+    types: Dict[str, List[TypeSignature]] = {}
+    for _, d, _ in flatten_definitions(definitions, frozenset()):
+        bindings = [(name, sub_definition.type_sig) for name, sub_definition in d.sub_definitions.items()
+                    if isinstance(sub_definition, (Constant, CompoundFunction, PrimitiveFunction))]
+        if isinstance(d, CompoundFunction):
+            bindings.extend(zip(d.parameters, d.type_sig.params))
+        for exp in definition_expressions(d):
+            bindings.extend(bound_types(exp))
+        for name, type_sig in bindings:
+            types.setdefault(name, []).append(type_sig)
+    for name, type_sig in chain.from_iterable(map(bound_types, entries)):
+        types.setdefault(name, []).append(type_sig)
+    return types
+
+
+# Compiles type-checked definitions to Python closures over frames, which carry Integers, Booleans and Strings
+# unboxed. Static types decide the representation of every value, so boxing only happens where a native value
+# flows into a position of another type, e.g. a union or a struct field, or to built-ins of the boxed evaluator.
+# Names are resolved like the boxed evaluator does: a function called or referenced takes the names it uses from
+# the frame it is called or referenced in. So a name that some frame can bind, and that is not bound by the
+# definition using it, is looked up in the frame, and resolves to the global definition only if the frame lacks it.
+# Frames hold just these names, the parameters, the match-bound names and the sub-definitions in scope.
+class UnboxedProgram:
+    def __init__(self, definitions: Dict[str, Definition], relations: TypeRelations,
+                 entries: Sequence[Expression] = ()) -> None:
+        self.definitions = definitions
+        self.relations = relations
+        self.local_types = local_types(definitions, entries)
+        self.captures = closure_captures(definitions)
+        self.scope: Dict[str, Binding] = {name: self.declare(d) for name, d in definitions.items()}
+        outer = self.outer_scope(self.scope)
+        for name, d in definitions.items():
+            self.define(d, self.scope[name], outer)
+
+    def declare(self, d: Definition) -> Binding:
+        if isinstance(d, Constant):
+            return Binding(BindingKind.CONSTANT, d.type_sig,
+                           subs={name: self.declare(sub) for name, sub in d.sub_definitions.items()})
+        if isinstance(d, PrimitiveFunction):
+            return Binding(BindingKind.FUNCTION, d.type_sig, NativeFunction(len(d.parameters), native_implementation(d)),
+                           d.parameters)
+        assert isinstance(d, CompoundFunction)
+        binding = Binding(BindingKind.FUNCTION, d.type_sig, parameters=d.parameters,
+                          shared=tuple(name for name in self.captures[id(d)] if name in self.local_types),
+                          subs={name: self.declare(sub) for name, sub in d.sub_definitions.items()},
+                          tail_recursive=d.tail_recursive)
+        if len(binding.shared) == 0:
+            binding.function = NativeFunction(len(d.parameters), invoker(binding, {}))
+        return binding
+
+    # Only the names a definition binds itself resolve statically in its body, see UnboxedProgram.
+    def outer_scope(self, scope: Scope) -> Scope:
+        return ChainMap({name: Binding(BindingKind.DYNAMIC, scope[name].type_sig)
+                         for name in self.local_types if name in scope}, self.scope)
+
+    def define(self, d: Definition, binding: Binding, outer: Scope) -> None:
+        if isinstance(d, PrimitiveFunction):
+            return
+        scope: Scope = ChainMap(binding.subs, outer) if len(binding.subs) > 0 else outer
+        if isinstance(d, CompoundFunction):
+            scope = ChainMap({parameter: Binding(BindingKind.VALUE, type_sig)
+                              for parameter, type_sig in zip(d.parameters, d.type_sig.params)}, scope)
+        if len(d.sub_definitions) > 0:
+            sub_outer = self.outer_scope(scope)
+            for name, sub_definition in d.sub_definitions.items():
+                self.define(sub_definition, binding.subs[name], sub_outer)
+        if isinstance(d, Constant):
+            code, type_sig = self.compile(d.expression, scope, None)
+            binding.code.append(coerce(code, type_sig, d.type_sig))
+        if isinstance(d, CompoundFunction):
+            code, type_sig = self.compile(d.body, scope, binding if d.tail_recursive else None)
+            binding.code.append(coerce(code, type_sig, d.type_sig.return_type))
+
+    # Returns the code and the static type of the expression. Tail positions of a tail-recursive function get the
+    # binding of the function.
+    def compile(self, exp: Expression, scope: Scope, tail: Optional[Binding]) -> Tuple[Code, TypeSignature]:
+        if isinstance(exp, PrimitiveExpression):
+            type_sig = tag_type(value_tag(exp))
+            value = exp.value if is_native(type_sig) else exp
+            return lambda frame: value, type_sig
+        if isinstance(exp, Variable):
+            return self.variable(scope[exp.name], exp.name), scope[exp.name].type_sig
+        if isinstance(exp, Match):
+            return self.match(exp, scope, tail)
+        if isinstance(exp, Call):
+            if isinstance(exp.operator, Variable) and exp.operator.name == "ifElse":
+                return self.if_else(exp, scope, tail)
+            return self.call(exp, scope, tail)
+        raise RuntimeError(f"Unknown expression type to compile: {exp}")
+
+    def variable(self, binding: Binding, name: str) -> Code:
+        if binding.kind == BindingKind.VALUE:
+            return operator.itemgetter(name)
+        if binding.kind == BindingKind.DYNAMIC:
+            return self.dynamic_variable(binding, name)
+        if binding.function is not None:
+            function = binding.function
+            return lambda frame: function
+        return partial(reference, binding)
+
+    def dynamic_variable(self, binding: Binding, name: str) -> Code:
+        fallback = self.scope.get(name)
+        # The frame may bind the name with another type than the one the type checker expects here.
+        sources = self.local_types[name] + ([] if fallback is None else [fallback.type_sig])
+        converter: Optional[Converter] = None
+        if any(coercion(source, binding.type_sig) is not None for source in sources) and \
+                not isinstance(binding.type_sig, TypeSignatureFunction):
+            converter = native_value if is_native(binding.type_sig) else boxed_value
+
+        def lookup(frame: Frame) -> Value:
+            value = frame[name] if fallback is None else frame.get(name, fallback)
+            if type(value) is Binding:
+                value = reference(value, frame)
+            return value if converter is None else converter(value)
+
+        return lookup
+
+    def if_else(self, call: Call, scope: Scope, tail: Optional[Binding]) -> Tuple[Code, TypeSignature]:
+        condition_code, condition_type = self.compile(call.operands[0], scope, None)
+        condition = coerce(condition_code, condition_type, BOOLEAN)
+        then_code, then_type = self.compile(call.operands[1], scope, tail)
+        else_code, else_type = self.compile(call.operands[2], scope, tail)
+        joined = self.relations.join(then_type, else_type)
+        assert joined is not None
+        then_branch = coerce(then_code, then_type, joined)
+        else_branch = coerce(else_code, else_type, joined)
+        return lambda frame: then_branch(frame) if condition(frame) else else_branch(frame), joined
+
+    def match(self, match: Match, scope: Scope, tail: Optional[Binding]) -> Tuple[Code, TypeSignature]:
+        scrutinee, scrutinee_type = self.compile(match.scrutinee, scope, None)
+        compiled = []
+        for case in match.cases:
+            case_scope = scope if case.name is None else ChainMap({case.name: Binding(BindingKind.VALUE,
+                                                                                      case.type_sig)}, scope)
+            compiled.append(self.compile(case.body, case_scope, tail))
+        result_type = compiled[0][1]
+        for _, case_type in compiled[1:]:
+            joined = self.relations.join(result_type, case_type)
+            assert joined is not None
+            result_type = joined
+        cases: Dict[int, Tuple[Optional[str], Optional[Converter], Code]] = {
+            tag: (case.name, coercion(scrutinee_type, case.type_sig), coerce(code, case_type, result_type))
+            for (tag, case), (code, case_type) in zip(match.jump_table.items(), compiled)}
+        tag_of: Callable[[Value], int] = (lambda value: BUILT_IN_TAGS[type(value)]) if is_native(scrutinee_type) \
+            else value_tag
+
+        def run(frame: Frame) -> Value:
+            value = scrutinee(frame)
+            name, converter, body = cases[tag_of(value)]
+            if name is None:
+                return body(frame)
+            case_frame = dict(frame)
+            case_frame[name] = convert(converter, value)
+            return body(case_frame)
+
+        return run, result_type
+
+    def call(self, call: Call, scope: Scope, tail: Optional[Binding]) -> Tuple[Code, TypeSignature]:
+        binding = scope[call.operator.name] if isinstance(call.operator, Variable) else None
+        if binding is not None and binding.kind == BindingKind.FUNCTION and \
+                len(call.operands) == len(binding.parameters):
+            assert isinstance(binding.type_sig, TypeSignatureFunction)
+            arguments = self.arguments(call, scope, binding.type_sig.params)
+            if binding is tail:
+                return lambda frame: TailCall(tuple(argument(frame) for argument in arguments)), \
+                    binding.type_sig.return_type
+            if binding.function is not None:
+                return call_code(binding.function.call, arguments), binding.type_sig.return_type
+            return self.frame_call(binding, arguments), binding.type_sig.return_type
+        operator_code, operator_type = self.compile(call.operator, scope, None)
+        param_types, result_type = applied_type(operator_type, len(call.operands))
+        arguments = self.arguments(call, scope, param_types)
+        return lambda frame: apply_native(operator_code(frame), [argument(frame) for argument in arguments]), \
+            result_type
+
+    def arguments(self, call: Call, scope: Scope, param_types: Sequence[TypeSignature]) -> List[Code]:
+        return [coerce(*self.compile(operand, scope, None), param_type)
+                for operand, param_type in zip(call.operands, param_types)]
+
+    # Calls a function that takes names from the frame of the call.
+    @staticmethod
+    def frame_call(binding: Binding, arguments: List[Code]) -> Code:
+        if binding.tail_recursive:
+            return lambda frame: invoker(binding, frame)(*[argument(frame) for argument in arguments])
+        code = binding.code
+        return lambda frame: code[0](enter(binding, frame, [argument(frame) for argument in arguments]))
+
+    # Names the entry binds are resolved dynamically as well, so the definitions are compiled again if it binds
+    # names they do not.
+    def evaluate(self, exp: Expression) -> Expression:
+        if any(name not in self.local_types for name, _ in bound_types(exp)):
+            return UnboxedProgram(self.definitions, self.relations, [exp]).evaluate(exp)
+        code, type_sig = self.compile(exp, self.scope, None)
+        return convert(boxing(type_sig), code({}))  # type: ignore[no-any-return]